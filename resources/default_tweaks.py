@@ -571,6 +571,15 @@
 # Default: False
 allow_template_database_functions_in_composites = False
 
+#: Size of the cache of search results
+# calibre caches the results of recently used searches, Virtual libraries and
+# search restrictions, so that repeating them is fast. This controls the
+# maximum number of cached searches and the maximum amount of memory (in MB)
+# the cached results can use. Memory use per search is about one bit per book
+# in the library. Larger values are useful when running the Content server
+# with many different Virtual libraries or users with restrictions.
+search_result_cache_limits = {'entries': 100, 'memory_mb': 16}
+
 
 #: Change the programs that are run when opening files/URLs
 # By default, calibre passes URLs to the operating system to open using
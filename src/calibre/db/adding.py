@@ -4,12 +4,15 @@
 __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import json
 import os
 import re
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from functools import partial
+from queue import Empty
 
 from calibre import prints
 from calibre.constants import filesystem_encoding, ismacos, iswindows
@@ -240,6 +243,277 @@ def cdb_recursive_find(root, single_book_per_directory=True, compiled_rules=()):
         yield from cdb_find_in_dir(dirpath[0], single_book_per_directory, compiled_rules)
 
 
+def cover_from_opf(formats):
+    ''' Return the cover data specified by the OPF file, if any, in the list of
+    files formats '''
+    from calibre.ebooks.metadata.meta import get_metadata
+    cover_data = None
+    for fmt in formats:
+        if fmt.lower().endswith('.opf'):
+            with open(fmt, 'rb') as f:
+                mi = get_metadata(f, stream_type='opf')
+            if mi.cover_data and mi.cover_data[1]:
+                cover_data = mi.cover_data[1]
+            elif mi.cover:
+                try:
+                    with open(mi.cover, 'rb') as f:
+                        cover_data = f.read()
+                except OSError:
+                    pass
+    return cover_data
+
+
+class BulkImporter:  # {{{
+
+    '''
+    Add a large number of books to a library as a pipeline of stages. Metadata
+    is read from groups of files in a pool of worker processes, the files are
+    copied into a local staging folder by a pool of threads and the books are
+    then created in the database in batches, each batch in a single
+    transaction.
+
+    Only a bounded number of file groups are processed at a time, so memory
+    and disk usage do not depend on the number of books being added. File
+    groups that have been processed are recorded in a journal, so that an
+    interrupted import is resumed by running it again with the same
+    journal_path. The journal is deleted once the import completes.
+    '''
+
+    batch_size = 128
+    max_in_flight_per_worker = 4
+
+    def __init__(
+        self, db, journal_path=None, add_duplicates=False, callback=None, added_ids=None,
+        max_workers=None, max_copy_workers=4
+    ):
+        from calibre import detect_ncpus
+        self.db = getattr(db, 'new_api', db)
+        self.journal_path = journal_path
+        self.add_duplicates = add_duplicates
+        self.callback = callback
+        self.added_ids = set() if added_ids is None else added_ids
+        self.max_workers = max_workers or detect_ncpus()
+        self.max_in_flight = self.batch_size + self.max_workers * self.max_in_flight_per_worker
+        self.max_copy_workers = max_copy_workers
+        self.duplicates, self.failures = [], []
+        self.aborted = False
+
+    @staticmethod
+    def journal_key(formats):
+        return '\0'.join(sorted(formats))
+
+    def read_journal(self):
+        ans = set()
+        if self.journal_path:
+            try:
+                with open(self.journal_path, 'rb') as f:
+                    for line in f:
+                        try:
+                            ans.add(self.journal_key(json.loads(line)))
+                        except ValueError:
+                            pass  # partially written last line
+            except FileNotFoundError:
+                pass
+        return ans
+
+    def record_done(self, groups):
+        if self.journal_path and groups:
+            with open(self.journal_path, 'ab') as f:
+                f.write(b''.join(json.dumps(formats).encode('utf-8') + b'\n' for formats in groups))
+
+    def __call__(self, file_groups):
+        ''' Add the books in file_groups, an iterable of lists of the paths
+        to the files that make up each book. Returns the list of duplicates
+        as (mi, formats) pairs. '''
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.utils.ipc.pool import Pool
+        if self.journal_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+        done = self.read_journal()
+        file_groups = (formats for formats in file_groups if self.journal_key(formats) not in done)
+        with TemporaryDirectory('bulk-import') as tdir, ThreadPoolExecutor(
+                max_workers=self.max_copy_workers, thread_name_prefix='BulkImportCopy') as copier:
+            self.tdir, self.copier = tdir, copier
+            self.pool = Pool(max_workers=self.max_workers, name='BulkImport')
+            try:
+                self.run_pipeline(iter(enumerate(file_groups)))
+            finally:
+                self.pool.shutdown()
+                self.pool = self.copier = None
+        if not self.aborted and self.journal_path:
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+        return self.duplicates
+
+    def run_pipeline(self, file_groups):
+        from calibre.utils.ipc.pool import Failure, Pool
+        self.in_flight, self.batch = {}, []
+        exhausted = False
+        while not self.aborted:
+            if self.pool.failed:
+                failure = self.pool.terminal_failure
+                if failure.job_id is None:
+                    raise Failure(failure)
+                # A worker crashed, give up on the files that crashed it
+                # and resubmit everything else to a new pool
+                self.pool.shutdown()
+                self.fail(failure.job_id, failure.message + '\n' + (failure.tb or ''))
+                self.pool = Pool(max_workers=self.max_workers, name='BulkImport')
+                for group_id, formats in tuple(self.in_flight.items()):
+                    self.submit(group_id, formats)
+            # Only read ahead a bounded number of file groups, so that the
+            # directory walk does not race ahead of the database
+            while not exhausted and len(self.in_flight) + len(self.batch) < self.max_in_flight:
+                try:
+                    group_id, formats = next(file_groups)
+                except StopIteration:
+                    exhausted = True
+                    break
+                try:
+                    self.submit(group_id, formats)
+                except Failure:
+                    break  # the pool failed since it was checked, the group is resubmitted above
+            if not self.in_flight:
+                break
+            try:
+                worker_result = self.pool.results.get(True, 0.1)
+            except Empty:
+                continue
+            self.pool.results.task_done()
+            if worker_result.is_terminal_failure:
+                continue  # will be resubmitted to a new pool
+            group_id = worker_result.id
+            if group_id in self.in_flight:
+                self.process_result(group_id, worker_result.result)
+            if len(self.batch) >= self.batch_size:
+                self.commit_batch()
+        if self.batch and not self.aborted:
+            self.commit_batch()
+
+    def submit(self, group_id, formats):
+        self.in_flight[group_id] = formats
+        self.pool(group_id, 'calibre.ebooks.metadata.worker', 'read_metadata', formats, group_id, self.tdir)
+
+    def fail(self, group_id, details):
+        formats = self.in_flight.pop(group_id, None)
+        if formats is not None:
+            self.failures.append((formats, details))
+            self.record_done((formats,))
+
+    def process_result(self, group_id, result):
+        from io import BytesIO
+
+        from calibre.ebooks.metadata.opf2 import OPF
+        if result.err:
+            return self.fail(group_id, result.traceback)
+        paths, opf, has_cover, duplicate_info = result.value
+        try:
+            mi = OPF(BytesIO(opf), basedir=self.tdir, populate_spine=False, try_to_guess_cover=False).to_book_metadata()
+        except Exception:
+            import traceback
+            return self.fail(group_id, traceback.format_exc())
+        formats = self.in_flight.pop(group_id)
+        if mi.is_null('title'):
+            for path in paths:
+                mi.title = os.path.splitext(os.path.basename(path))[0]
+                break
+        if mi.application_id == '__calibre_dummy__':
+            mi.application_id = None
+        cover_path = os.path.join(self.tdir, f'{group_id}.cdata') if has_cover else None
+        # Start copying the files now, so that the copies overlap with reading
+        # metadata for the following groups
+        staged = {}
+        for fmt, path in create_format_map(paths).items():
+            if os.path.abspath(path).startswith(self.tdir):
+                staged[fmt] = None, path  # created by an import plugin
+            else:
+                dest = os.path.join(self.tdir, 'staged', str(group_id), os.path.basename(path))
+                staged[fmt] = self.copier.submit(self.stage, path, dest), path
+        self.batch.append((group_id, formats, mi, cover_path, staged))
+
+    @staticmethod
+    def stage(src, dest):
+        import shutil
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(src, dest)
+        return dest
+
+    def commit_batch(self):
+        import shutil
+        import traceback
+
+        from calibre.customize.ui import run_plugins_on_postadd
+        batch, self.batch = self.batch, []
+        done, entries, items = [], [], []
+        for group_id, formats, mi, cover_path, staged in batch:
+            format_map = {}
+            try:
+                for fmt, (future, path) in staged.items():
+                    format_map[fmt] = (path if future is None else future.result()), path
+                cover = None
+                if cover_path:
+                    with open(cover_path, 'rb') as f:
+                        cover = f.read()
+                    os.remove(cover_path)
+                else:
+                    cover = cover_from_opf(formats)
+            except Exception:
+                self.failures.append((formats, traceback.format_exc()))
+                done.append(formats)
+                continue
+            entries.append((mi, cover))
+            items.append((group_id, formats, mi, format_map))
+
+        book_ids = self.db.create_book_entries(entries, add_duplicates=self.add_duplicates) if entries else ()
+        for (group_id, formats, mi, format_map), book_id in zip(items, book_ids):
+            done.append(formats)
+            if book_id is None:
+                self.duplicates.append((mi, formats))
+            elif book_id is False:
+                self.failures.append((formats, _('Failed to create the book entry')))
+            else:
+                fmt_map = {}
+                for fmt, (staged_path, path) in format_map.items():
+                    try:
+                        if self.db.add_format(book_id, fmt, staged_path, run_hooks=False):
+                            fmt_map[fmt.lower()] = path
+                    except Exception:
+                        self.failures.append(([path], traceback.format_exc()))
+                run_plugins_on_postadd(self.db, book_id, fmt_map)
+                self.added_ids.add(book_id)
+            for x in (str(group_id), os.path.join('staged', str(group_id))):
+                shutil.rmtree(os.path.join(self.tdir, x), ignore_errors=True)
+            if callable(self.callback) and self.callback(mi.title):
+                self.aborted = True
+        self.record_done(done)
+# }}}
+
+
+def journal_path_for_import(db, key):
+    from hashlib import sha1
+
+    from calibre.constants import cache_dir
+    db = getattr(db, 'new_api', db)
+    name = sha1(f'{db.library_id}\0{key}'.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), 'bulk-import', name + '.journal')
+
+
+def bulk_import(db, root, single_book_per_directory=True, callback=None, added_ids=None,
+                compiled_rules=(), add_duplicates=False, resume=True):
+    ''' Like :func:`recursive_import` but uses :class:`BulkImporter`, which
+    is much faster for large numbers of books, particularly on slow
+    filesystems. If resume is True an interrupted import of the same root folder
+    into the same library continues from where it was interrupted. Note that,
+    unlike :func:`recursive_import`, the callback is only called for books
+    and import plugins are run on the files before reading metadata. '''
+    root = os.path.abspath(root)
+    journal_path = journal_path_for_import(db, f'{root}\0{single_book_per_directory}') if resume else None
+    importer = BulkImporter(db, journal_path=journal_path, add_duplicates=add_duplicates, callback=callback, added_ids=added_ids)
+    return importer(cdb_recursive_find(root, single_book_per_directory, compiled_rules))
+
+
 def add_catalog(cache, path, title, dbapi=None):
     from calibre.ebooks.metadata.book.base import Metadata
     from calibre.ebooks.metadata.meta import get_metadata
@@ -6,6 +6,7 @@
 __docformat__ = 'restructuredtext en'
 
 # Imports {{{
+import copy
 import errno
 import hashlib
 import json
@@ -16,7 +17,9 @@
 import time
 import uuid
 from contextlib import closing, suppress
+from datetime import timedelta
 from functools import partial
+from threading import Lock
 
 import apsw
 
@@ -30,6 +33,7 @@
     DEFAULT_TRASH_EXPIRY_TIME_SECONDS,
     METADATA_FILE_NAME,
     NOTES_DIR_NAME,
+    TABLES_CACHE_FILE_NAME,
     TRASH_DIR_NAME,
     TrashEntry,
 )
@@ -48,6 +52,7 @@
     SizeTable,
     UUIDTable,
 )
+from calibre.db.tables_cache import db_state_key, is_cacheable, load_tables, save_tables
 from calibre.ebooks.metadata import author_to_author_sort, title_sort
 from calibre.library.field_metadata import FieldMetadata
 from calibre.ptempfile import PersistentTemporaryFile, TemporaryFile
@@ -324,20 +329,144 @@ def annotations_for_book(cursor, book_id, fmt, user_type='local', user='viewer')
             pass
 
 
+def next_annotations_sync_seq(cursor):
+    ''' Return a new value of the server side clock used to find the
+    annotations that have changed since a client last synced. Must be called
+    in a transaction. '''
+    cursor.execute('UPDATE annotations_sync_seq SET seq = seq + 1')
+    return current_annotations_sync_seq(cursor)
+
+
+def current_annotations_sync_seq(cursor):
+    for (seq,) in cursor.execute('SELECT seq FROM annotations_sync_seq'):
+        return seq
+    return 0
+
+
+def insert_annotations(cursor, book_id, fmt, user_type, user, data, seq):
+    cursor.executemany(
+        'INSERT OR REPLACE INTO annotations (book, format, user_type, user, timestamp, annot_id, annot_type, annot_data, searchable_text, sync_seq)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            (book_id, fmt, user_type, user, timestamp_in_secs, aid, atype, annot_data, text, seq)
+            for (atype, aid), (timestamp_in_secs, annot_data, text) in data))
+    cursor.executemany(
+        'DELETE FROM annotations_tombstones WHERE book=? AND format=? AND user_type=? AND user=? AND annot_type=? AND annot_id=?',
+        ((book_id, fmt, user_type, user, atype, aid) for (atype, aid), val in data))
+
+
+def delete_annotation_rows(cursor, rowids, seq, timestamp_in_secs):
+    ''' Delete the specified annotation rows, leaving a tombstone for each, so
+    that clients that sync incrementally learn of the deletion '''
+    rows = []
+    for rowid in rowids:
+        rows.extend(cursor.execute(
+            'SELECT book, format, user_type, user, annot_type, annot_id FROM annotations WHERE id=?', (rowid,)))
+    cursor.executemany(
+        'INSERT OR REPLACE INTO annotations_tombstones (book, format, user_type, user, annot_type, annot_id, timestamp, sync_seq)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (row + (timestamp_in_secs, seq) for row in rows))
+    cursor.executemany('DELETE FROM annotations WHERE id=?', ((rowid,) for rowid in rowids))
+
+
+def annotation_tombstone(annot_type, annot_id, timestamp_in_secs):
+    ans = {'type': annot_type, 'removed': True, 'timestamp': (EPOCH + timedelta(seconds=timestamp_in_secs)).isoformat()}
+    ans['title' if annot_type == 'bookmark' else 'uuid'] = annot_id
+    return ans
+
+
 def save_annotations_for_book(cursor, book_id, fmt, annots_list, user_type='local', user='viewer'):
-    data = []
+    data = {}
     fmt = fmt.upper()
     for annot, timestamp_in_secs in annots_list:
         atype = annot['type'].lower()
         aid, text = annot_db_data(annot)
         if aid is None:
             continue
-        data.append((book_id, fmt, user_type, user, timestamp_in_secs, aid, atype, json.dumps(annot), text))
+        data[(atype, aid)] = timestamp_in_secs, json.dumps(annot), text
     cursor.execute('INSERT OR IGNORE INTO annotations_dirtied (book) VALUES (?)', (book_id,))
-    cursor.execute('DELETE FROM annotations WHERE book=? AND format=? AND user_type=? AND user=?', (book_id, fmt, user_type, user))
-    cursor.executemany(
-        'INSERT OR REPLACE INTO annotations (book, format, user_type, user, timestamp, annot_id, annot_type, annot_data, searchable_text)'
-        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', data)
+    # Only rows that actually change are written, so that they are the only
+    # ones sent to clients syncing incrementally
+    existing = {}
+    for rowid, atype, aid, annot_data in cursor.execute(
+        'SELECT id, annot_type, annot_id, annot_data FROM annotations WHERE book=? AND format=? AND user_type=? AND user=?',
+        (book_id, fmt, user_type, user)
+    ):
+        existing[(atype, aid)] = rowid, annot_data
+    removed = tuple(rowid for key, (rowid, annot_data) in existing.items() if key not in data)
+    changed = tuple((key, val) for key, val in data.items() if key not in existing or existing[key][1] != val[1])
+    if removed or changed:
+        seq = next_annotations_sync_seq(cursor)
+        if removed:
+            delete_annotation_rows(cursor, removed, seq, (utcnow() - EPOCH).total_seconds())
+        if changed:
+            insert_annotations(cursor, book_id, fmt, user_type, user, changed, seq)
+
+
+def sync_annotations_for_book(cursor, book_id, fmt, user_type, user, changes, since=0):
+    from calibre.db.annotations import safe_timestamp_sort_key
+    from calibre.utils.iso8601 import parse_iso8601
+    fmt = fmt.upper()
+    accepted, rejected = {}, {}
+    for annot in changes:
+        try:
+            atype = annot['type'].lower()
+            aid, text = annot_db_data(annot)
+            timestamp_in_secs = (parse_iso8601(annot['timestamp'], assume_utc=True) - EPOCH).total_seconds()
+        except Exception:
+            continue
+        if aid is None:
+            continue
+        key = atype, aid
+        annot_data = json.dumps(annot)
+        for (existing_data,) in cursor.execute(
+            'SELECT annot_data FROM annotations WHERE book=? AND format=? AND user_type=? AND user=? AND annot_type=? AND annot_id=?',
+            (book_id, fmt, user_type, user, atype, aid)
+        ):
+            if existing_data == annot_data:
+                break
+            try:
+                existing = json.loads(existing_data)
+            except Exception:
+                existing = None
+            if existing is not None and safe_timestamp_sort_key(existing) >= safe_timestamp_sort_key(annot):
+                # The copy on the server is newer, the client needs to get it
+                rejected[key] = existing
+                break
+        else:
+            for (removed_at,) in cursor.execute(
+                'SELECT timestamp FROM annotations_tombstones WHERE book=? AND format=? AND user_type=? AND user=? AND annot_type=? AND annot_id=?',
+                (book_id, fmt, user_type, user, atype, aid)
+            ):
+                if removed_at >= timestamp_in_secs:
+                    # Deleted on the server after the client changed it
+                    rejected[key] = annotation_tombstone(atype, aid, removed_at)
+                    break
+            else:
+                accepted[key] = timestamp_in_secs, annot_data, text
+    if accepted:
+        cursor.execute('INSERT OR IGNORE INTO annotations_dirtied (book) VALUES (?)', (book_id,))
+        insert_annotations(cursor, book_id, fmt, user_type, user, tuple(accepted.items()), next_annotations_sync_seq(cursor))
+    seq = current_annotations_sync_seq(cursor)
+    q = 'SELECT annot_type, annot_id, annot_data FROM annotations WHERE book=? AND format=? AND user_type=? AND user=?'
+    args = [book_id, fmt, user_type, user]
+    if since:
+        q += ' AND sync_seq > ?'
+        args.append(since)
+    ans = rejected
+    for atype, aid, annot_data in cursor.execute(q, args):
+        key = atype, aid
+        if key not in accepted and key not in ans:
+            try:
+                ans[key] = json.loads(annot_data)
+            except Exception:
+                pass
+    # Annotations that were deleted, rather than marked as removed, are sent
+    # as removal skeletons
+    q = 'SELECT annot_type, annot_id, timestamp FROM annotations_tombstones WHERE book=? AND format=? AND user_type=? AND user=? AND sync_seq > ?'
+    for atype, aid, removed_at in cursor.execute(q, (book_id, fmt, user_type, user, since)):
+        key = atype, aid
+        if key not in accepted and key not in ans:
+            ans[key] = annotation_tombstone(atype, aid, removed_at)
+    return seq, list(ans.values())
 
 
 def save_annotations_list_to_cursor(cursor, alist, sync_annots_user, book_id, book_fmt):
@@ -504,6 +633,12 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
 
         if not os.path.exists(os.path.dirname(self.dbpath)):
             os.makedirs(os.path.dirname(self.dbpath))
+        # The tables cache is not used for temporary copies of the database
+        self.tables_cache_path = None if (read_only or temp_db_path is not None) else os.path.join(
+            os.path.dirname(self.dbpath), TABLES_CACHE_FILE_NAME)
+        self.tables_read_from_cache = False
+        self.deferred_tables_key = None
+        self.deferred_tables_lock = Lock()
 
         self._conn = None
         if self.user_version == 0:
@@ -628,6 +763,9 @@ def initialize_prefs(self, default_prefs, restore_all_prefs, progress_callback):
         defs['styled_columns'] = {}
         defs['edit_metadata_ignore_display_order'] = False
         defs['fts_enabled'] = False
+        # Only index the most preferred format of a book, as per the input
+        # format order, once it has been indexed
+        defs['fts_skip_secondary_formats'] = False
 
         # Migrate the bool tristate tweak
         defs['bools_are_tristate'] = \
@@ -1112,6 +1250,10 @@ def fts_num_of_workers(self, num):
         if self.fts_enabled:
             self.fts.pool.num_of_workers = num
 
+    @property
+    def fts_jobs_per_second(self):
+        return self.fts.pool.jobs_per_second if self.fts_enabled else None
+
     def get_next_fts_job(self):
         return self.fts.get_next_fts_job()
 
@@ -1124,13 +1266,32 @@ def reindex_fts(self):
     def remove_dirty_fts(self, book_id, fmt):
         return self.fts.remove_dirty(book_id, fmt)
 
-    def queue_fts_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
-        return self.fts.queue_job(book_id, fmt, path, fmt_size, fmt_hash, start_time)
+    def queue_fts_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time, signature=None):
+        return self.fts.queue_job(book_id, fmt, path, fmt_size, fmt_hash, start_time, signature)
+
+    def fts_indexed_formats(self, book_id):
+        return self.fts.indexed_formats(book_id)
+
+    def fts_dirtied_formats(self, book_id):
+        return self.fts.dirtied_formats(book_id)
+
+    def requeue_fts_job(self, book_id, fmt):
+        if self.fts is not None:
+            self.fts.requeue_job(book_id, fmt)
 
     def commit_fts_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg):
         if self.fts is not None:
             return self.fts.commit_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
 
+    def commit_fts_results(self, results):
+        if self.fts is not None:
+            return self.fts.commit_results(results)
+
+    def merge_fts_segments(self, pages):
+        if self.fts is not None:
+            return self.fts.merge_segments(pages)
+        return False
+
     def fts_unindex(self, book_id, fmt=None):
         self.fts.unindex(book_id, fmt=fmt)
 
@@ -1138,10 +1299,12 @@ def reindex_fts_book(self, book_id, *fmts):
         return self.fts.dirty_book(book_id, *fmts)
 
     def fts_search(self,
-        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result
+        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result,
+        limit=None, offset=0
     ):
         yield from self.fts.search(
-            fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result)
+            fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result,
+            limit, offset)
 
     def shutdown_fts(self):
         if self.fts_enabled:
@@ -1590,11 +1753,33 @@ def last_modified(self):
 
     def read_tables(self):
         '''
-        Read all data from the db into the python in-memory tables
+        Read all data from the db into the python in-memory tables. The tables
+        cache is used instead of SQL if it is up to date, otherwise it is
+        rebuilt from the freshly read tables. It is never written from tables
+        that have been changed since they were read, as changes written to the
+        database without going through the tables would then be lost. When the
+        tables cache is used, reading the tables for custom
+        columns is deferred until their data is first used, see
+        :meth:`read_deferred_table`.
         '''
-
+        key, self.tables_read_from_cache = None, False
+        deferred = {name for name, table in iteritems(self.tables) if name.startswith('#') and is_cacheable(table)}
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
-            for table in itervalues(self.tables):
+            if self.tables_cache_path is not None:
+                self.user_version  # starts the read transaction
+                key = db_state_key(self.dbpath)
+                if key is not None:
+                    if load_tables(self.tables_cache_path, key, {
+                            name: table for name, table in iteritems(self.tables) if name not in deferred}):
+                        for name, table in iteritems(self.tables):
+                            if name in deferred:
+                                self.defer_reading(table)
+                            elif not is_cacheable(table):
+                                table.read(self)
+                        self.tables_read_from_cache = True
+                        self.deferred_tables_key = key
+                        return
+            for name, table in iteritems(self.tables):
                 try:
                     table.read(self)
                 except Exception:
@@ -1602,6 +1787,54 @@ def read_tables(self):
                     import pprint
                     pprint.pprint(table.metadata)
                     raise
+        if key is not None:
+            self.save_tables_cache(key)
+
+    def defer_reading(self, table):
+        table.deferred_reader = self.read_deferred_table
+
+    def read_deferred_table(self, table):
+        '''
+        Read the data for a table whose reading was deferred. Called on first
+        access to the data, which can happen in any thread holding the read
+        lock, so reading is serialized with a separate lock.
+
+        The data is loaded from the tables cache with the key the other tables
+        were loaded with, so it is from the same state of the database, even
+        if other programs have changed the database since. Changes made by
+        this connection are never missed, as changing a table reads it first.
+        If the tables cache has been replaced in the meantime, the data is read
+        from the database, and so includes any changes by other programs.
+        '''
+        with self.deferred_tables_lock:
+            if table.deferred_reader is None:
+                return  # Read by another thread while we were waiting for the lock
+            # Read into a copy, so that other threads never see partially read data
+            fresh = copy.copy(table)
+            fresh.deferred_reader = None
+            with self.conn:
+                self.user_version  # starts the read transaction
+                if self.tables_cache_path is None or not load_tables(
+                        self.tables_cache_path, self.deferred_tables_key, {table.name: fresh}):
+                    fresh.read(self)
+            existing = vars(table)
+            for k, v in tuple(iteritems(vars(fresh))):
+                if k not in existing:
+                    setattr(table, k, v)
+            table.deferred_reader = None
+
+    def read_deferred_tables(self):
+        for table in tuple(itervalues(self.tables)):
+            if table.deferred_reader is not None:
+                table.deferred_reader(table)
+
+    def save_tables_cache(self, key):
+        try:
+            save_tables(self.tables_cache_path, key, self.tables)
+        except Exception:
+            import traceback
+            prints('Failed to save the tables cache to:', self.tables_cache_path)
+            traceback.print_exc()
 
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
@@ -2175,12 +2408,14 @@ def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=F
                 shutil.copyfileobj(stream, d)
         return os.path.relpath(dest, bookdir).replace(os.sep, '/')
 
-    def write_backup(self, path, raw):
+    def write_backup(self, path, raw, create_dirs=True):
         path = os.path.abspath(os.path.join(self.library_path, path, METADATA_FILE_NAME))
         try:
             with open(path, 'wb') as f:
                 f.write(raw)
         except OSError:
+            if not create_dirs:
+                raise
             exc_info = sys.exc_info()
             try:
                 os.makedirs(os.path.dirname(path))
@@ -2420,6 +2655,9 @@ def dirty_books(self, book_ids):
     def mark_book_as_clean(self, book_id):
         self.execute('DELETE FROM metadata_dirtied WHERE book=?', (book_id,))
 
+    def mark_books_as_clean(self, book_ids):
+        self.executemany('DELETE FROM metadata_dirtied WHERE book=?', ((x,) for x in book_ids))
+
     def get_ids_for_custom_book_data(self, name):
         return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
@@ -2431,6 +2669,11 @@ def save_annotations_list(self, book_id, book_fmt, sync_annots_user, alist):
         with conn:
             save_annotations_list_to_cursor(conn.cursor(), alist, sync_annots_user, book_id, book_fmt)
 
+    def sync_annotations(self, book_id, fmt, user_type, user, changes, since=0):
+        conn = self.conn
+        with conn:
+            return sync_annotations_for_book(conn.cursor(), book_id, fmt, user_type, user, changes, since)
+
     def search_annotations(self,
         fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, annotation_type,
         restrict_to_book_ids, restrict_to_user, ignore_removed=False
@@ -2503,7 +2746,7 @@ def delete_annotations(self, annot_ids):
                 try:
                     annot_data = json.loads(raw_annot_data)
                 except Exception:
-                    removals.append((annot_id,))
+                    removals.append(annot_id)
                     continue
                 now = utcnow()
                 new_annot = {'removed': True, 'timestamp': ts, 'type': annot_type}
@@ -2513,23 +2756,30 @@ def delete_annotations(self, annot_ids):
                 else:
                     new_annot['title'] = annot_data['title']
                 replacements.append((json.dumps(new_annot), timestamp, annot_id))
-        if replacements:
-            self.executemany("UPDATE annotations SET annot_data=?, timestamp=?, searchable_text='' WHERE id=?", replacements)
-        if removals:
-            self.executemany('DELETE FROM annotations WHERE id=?', removals)
+        if not replacements and not removals:
+            return
+        with self.conn:
+            cursor = self.conn.cursor()
+            seq = next_annotations_sync_seq(cursor)
+            if replacements:
+                self.executemany("UPDATE annotations SET annot_data=?, timestamp=?, searchable_text='', sync_seq=? WHERE id=?", (
+                    (annot_data, timestamp, seq, annot_id) for annot_data, timestamp, annot_id in replacements))
+            if removals:
+                delete_annotation_rows(cursor, removals, seq, timestamp)
 
     def update_annotations(self, annot_id_map):
         now = utcnow()
         ts = now.isoformat()
         timestamp = (now - EPOCH).total_seconds()
         with self.conn:
+            seq = next_annotations_sync_seq(self.conn.cursor())
             for annot_id, annot in annot_id_map.items():
                 atype = annot['type']
                 aid, text = annot_db_data(annot)
                 if aid is not None:
                     annot['timestamp'] = ts
-                    self.execute('UPDATE annotations SET annot_data=?, timestamp=?, annot_type=?, searchable_text=?, annot_id=? WHERE id=?',
-                        (json.dumps(annot), timestamp, atype, text, aid, annot_id))
+                    self.execute('UPDATE annotations SET annot_data=?, timestamp=?, annot_type=?, searchable_text=?, annot_id=?, sync_seq=? WHERE id=?',
+                        (json.dumps(annot), timestamp, atype, text, aid, seq, annot_id))
 
     def all_annotations(self, restrict_to_user=None, limit=None, annotation_type=None, ignore_removed=False, restrict_to_book_ids=None):
         ls = json.loads
@@ -2651,7 +2901,7 @@ def map_data(x):
     def get_top_level_move_items(self, all_paths):
         items = set(os.listdir(self.library_path))
         paths = set(all_paths)
-        paths.update({'metadata.db', 'full-text-search.db', 'metadata_db_prefs_backup.json', NOTES_DIR_NAME})
+        paths.update({'metadata.db', 'full-text-search.db', 'metadata_db_prefs_backup.json', NOTES_DIR_NAME, TABLES_CACHE_FILE_NAME})
         path_map = {x:x for x in paths}
         if not self.is_case_sensitive:
             for x in items:
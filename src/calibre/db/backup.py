@@ -8,7 +8,10 @@
 import sys
 import traceback
 import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from threading import Event, Thread
+from time import monotonic
 
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 
@@ -27,9 +30,19 @@ class MetadataBackup(Thread):
     Continuously backup changed metadata into OPF files
     in the book directory. This class runs in its own
     thread.
+
+    When batch_size is larger than one, up to that many dirtied books are
+    backed up at a time: their OPFs are rendered by a pool of max_workers
+    threads and written using up to max_io_workers threads. Batches follow
+    each other without pause until no dirtied books are left, throttled by
+    scheduling_interval only while the database is busy.
     '''
 
-    def __init__(self, db, interval=2, scheduling_interval=0.1):
+    # The backup rate is calculated over this many of the most recently
+    # backed up books
+    rate_sample_size = 512
+
+    def __init__(self, db, interval=2, scheduling_interval=0.1, batch_size=100, max_workers=2, max_io_workers=4):
         Thread.__init__(self)
         self.daemon = True
         self._db = weakref.ref(getattr(db, 'new_api', db))
@@ -37,6 +50,12 @@ def __init__(self, db, interval=2, scheduling_interval=0.1):
         self.interval = interval
         self.scheduling_interval = scheduling_interval
         self.check_dirtied_annotations = 0
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_io_workers = max_io_workers
+        self.num_written = self.num_failed = 0
+        self.completion_times = deque(maxlen=self.rate_sample_size)
+        self.executor = None
 
     @property
     def db(self):
@@ -52,24 +71,134 @@ def wait(self, interval):
         if self.stop_running.wait(interval):
             raise Abort()
 
+    @property
+    def queue_depth(self):
+        ''' The number of books waiting to be backed up '''
+        try:
+            return self.db.dirty_queue_length()
+        except Exception:
+            return 0
+
+    @property
+    def rate(self):
+        ''' The number of books backed up per second recently, or None if
+        too few books have been backed up recently to tell '''
+        times = tuple(self.completion_times)
+        if len(times) < 2 or monotonic() - times[-1] > 60:
+            return None
+        return (len(times) - 1) / max(times[-1] - times[0], 0.001)
+
+    def stats(self):
+        return {'queue_depth': self.queue_depth, 'rate': self.rate, 'written': self.num_written, 'failed': self.num_failed}
+
+    def record_done(self, num_written=1):
+        self.num_written += num_written
+        now = monotonic()
+        self.completion_times.extend(now for i in range(min(num_written, self.rate_sample_size)))
+
     def run(self):
-        while not self.stop_running.is_set():
-            try:
-                self.wait(self.interval)
-                self.do_one()
-            except Abort:
-                break
+        try:
+            while not self.stop_running.is_set():
+                try:
+                    self.wait(self.interval)
+                    if self.batch_size > 1:
+                        self.do_batch()
+                    else:
+                        self.do_one()
+                except Abort:
+                    break
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
 
-    def do_one(self):
+    def check_annotations(self):
         self.check_dirtied_annotations += 1
         if self.check_dirtied_annotations > 2:
             self.check_dirtied_annotations = 0
             try:
                 self.db.check_dirtied_annotations()
+            except Abort:
+                raise
             except Exception:
                 if self.stop_running.is_set() or self.db.is_closed:
-                    return
+                    return False
+                traceback.print_exc()
+        return True
+
+    def do_batch(self):
+        if not self.check_annotations():
+            return
+        while True:
+            try:
+                book_ids = self.db.get_dirtied_books(self.batch_size)
+            except Abort:
+                raise
+            except Exception:
+                # Happens during interpreter shutdown
+                return
+            if not book_ids or not self.backup_books(book_ids) or len(book_ids) < self.batch_size:
+                return
+            # Only give the GUI or server a chance to do something if they
+            # are actually waiting for the database
+            self.wait(self.scheduling_interval if self.db.is_busy else 0)
+
+    def render(self, item):
+        book_id, mi, sequence = item
+        try:
+            return metadata_to_opf(mi)
+        except Exception:
+            prints('Failed to convert to opf for id:', book_id)
+            traceback.print_exc()
+
+    def backup_books(self, book_ids):
+        ''' Backup the specified books, returning the number backed up '''
+        db = self.db
+        items, clean = [], {}
+        for book_id in book_ids:
+            self.wait(0)
+            try:
+                mi, sequence = db.get_metadata_for_dump(book_id)
+            except Exception:
+                prints('Failed to get backup metadata for id:', book_id)
                 traceback.print_exc()
+                self.num_failed += 1
+                continue
+            if mi is None:
+                clean[book_id] = sequence
+            else:
+                items.append((book_id, mi, sequence))
+        if items:
+            if self.max_workers > 1 and len(items) > 1:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='BackupRenderer')
+                rendered = tuple(self.executor.map(self.render, items))
+            else:
+                rendered = tuple(map(self.render, items))
+            self.wait(0)
+            raw_map, sequences = {}, {}
+            for (book_id, mi, sequence), raw in zip(items, rendered):
+                if raw is None:
+                    # Conversion errors are not retried, same as for a single book
+                    clean[book_id] = sequence
+                    self.num_failed += 1
+                else:
+                    raw_map[book_id] = raw
+                    sequences[book_id] = sequence
+            failed = db.write_backups(raw_map, max_workers=self.max_io_workers) if raw_map else set()
+            if failed:
+                prints('Failed to write backup metadata for ids:', sorted(failed))
+                self.num_failed += len(failed)
+            written = {book_id: sequence for book_id, sequence in sequences.items() if book_id not in failed}
+            clean.update(written)
+            self.record_done(len(written))
+        if clean:
+            db.clear_dirtied_books(clean)
+        return len(clean)
+
+    def do_one(self):
+        if not self.check_annotations():
+            return
 
         try:
             book_id = self.db.get_a_dirtied_book()
@@ -129,6 +258,7 @@ def do_one(self):
                 return
 
         self.db.clear_dirtied(book_id, sequence)
+        self.record_done()
 
     def break_cycles(self):
         # Legacy compatibility
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, Kovid Goyal <kovid at kovidgoyal.net>'
+
+from collections.abc import Set
+from itertools import compress
+
+BIT_POSITIONS = tuple(tuple(i for i in range(8) if byte & (1 << i)) for byte in range(256))
+
+
+class Bitmap(Set):
+    '''
+    An immutable set of non-negative integers (book ids) stored as the bits
+    of a python integer. Since book ids are small and dense, this uses about
+    one bit per book in the library instead of ~50 bytes per member for a
+    python set, and intersection/union/difference of two bitmaps are done
+    a machine word at a time.
+
+    Operations with ordinary sets are supported, the set is converted to a
+    bitmap first. Use :meth:`as_set` to get a python set.
+    '''
+
+    __slots__ = ('_raw', 'bits')
+
+    def __init__(self, book_ids=()):
+        self._raw = None
+        if isinstance(book_ids, Bitmap):
+            self.bits = book_ids.bits
+            return
+        if not isinstance(book_ids, (set, frozenset, list, tuple, dict)):
+            book_ids = tuple(book_ids)
+        if not book_ids:
+            self.bits = 0
+            return
+        buf = bytearray((max(book_ids) >> 3) + 1)
+        for book_id in book_ids:
+            if book_id < 0:
+                raise ValueError(f'Book ids must not be negative, got: {book_id}')
+            buf[book_id >> 3] |= 1 << (book_id & 7)
+        self.bits = int.from_bytes(buf, 'little')
+        self._raw = bytes(buf)
+
+    @classmethod
+    def from_int(cls, bits):
+        ans = cls.__new__(cls)
+        ans.bits = bits
+        ans._raw = None
+        return ans
+
+    @property
+    def raw(self):
+        ' The bitmap as little endian bytes, cached as bitmaps are immutable '
+        if self._raw is None:
+            bits = self.bits
+            self._raw = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+        return self._raw
+
+    @classmethod
+    def coerce(cls, x):
+        ' Return x as a Bitmap, without copying if it is already one '
+        return x if isinstance(x, Bitmap) else cls(x)
+
+    @property
+    def nbytes(self):
+        ' Approximate memory used by this bitmap '
+        return (self.bits.bit_length() + 7) // 8 + 32
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, book_id):
+        try:
+            return book_id >= 0 and (self.raw[book_id >> 3] >> (book_id & 7)) & 1 == 1
+        except (IndexError, TypeError):
+            return False
+
+    def __iter__(self):
+        raw = self.raw
+        positions = BIT_POSITIONS
+        for i in compress(range(len(raw)), raw):
+            base = i << 3
+            for p in positions[raw[i]]:
+                yield base + p
+
+    def as_set(self):
+        return set(self)
+
+    # Must hash the same as an equal frozenset
+    __hash__ = Set._hash
+
+    def __eq__(self, other):
+        if isinstance(other, Bitmap):
+            return self.bits == other.bits
+        return Set.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __and__(self, other):
+        if not isinstance(other, Bitmap):
+            if not isinstance(other, Set):
+                return NotImplemented
+            other = Bitmap(other)
+        return Bitmap.from_int(self.bits & other.bits)
+    __rand__ = __and__
+
+    def __or__(self, other):
+        if not isinstance(other, Bitmap):
+            if not isinstance(other, Set):
+                return NotImplemented
+            other = Bitmap(other)
+        return Bitmap.from_int(self.bits | other.bits)
+    __ror__ = __or__
+
+    def __xor__(self, other):
+        if not isinstance(other, Bitmap):
+            if not isinstance(other, Set):
+                return NotImplemented
+            other = Bitmap(other)
+        return Bitmap.from_int(self.bits ^ other.bits)
+    __rxor__ = __xor__
+
+    def __sub__(self, other):
+        if not isinstance(other, Bitmap):
+            if not isinstance(other, Set):
+                return NotImplemented
+            other = Bitmap(other)
+        return Bitmap.from_int(self.bits & ~other.bits)
+
+    def __rsub__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return Bitmap(other) - self
+
+    def __le__(self, other):
+        if isinstance(other, Bitmap):
+            return self.bits & ~other.bits == 0
+        return Set.__le__(self, other)
+
+    def __ge__(self, other):
+        if isinstance(other, Bitmap):
+            return other.bits & ~self.bits == 0
+        return Set.__ge__(self, other)
+
+    def __lt__(self, other):
+        return self <= other and self != other
+
+    def __gt__(self, other):
+        return self >= other and self != other
+
+    def intersection(self, *others):
+        ans = self
+        for x in others:
+            ans = ans & Bitmap.coerce(x)
+        return ans
+
+    def union(self, *others):
+        ans = self
+        for x in others:
+            ans = ans | Bitmap.coerce(x)
+        return ans
+
+    def difference(self, *others):
+        ans = self
+        for x in others:
+            ans = ans - Bitmap.coerce(x)
+        return ans
+
+    def issubset(self, other):
+        return self <= Bitmap.coerce(other)
+
+    def issuperset(self, other):
+        return self >= Bitmap.coerce(other)
+
+    def isdisjoint(self, other):
+        return self.bits & Bitmap.coerce(other).bits == 0
+
+    def copy(self):
+        return self
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({sorted(self)!r})'
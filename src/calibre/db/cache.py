@@ -5,7 +5,9 @@
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import copy
 import hashlib
+import heapq
 import operator
 import os
 import random
@@ -15,6 +17,7 @@
 import weakref
 from collections import defaultdict
 from collections.abc import Iterable, MutableSet, Set
+from contextlib import nullcontext
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from queue import Queue
@@ -27,15 +30,19 @@
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd, run_plugins_on_postdelete, run_plugins_on_postimport
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
-from calibre.db.categories import get_categories
+from calibre.db.bitmap import Bitmap
+from calibre.db.categories import CategoryCache, get_categories
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, NOTES_DIR_NAME
+from calibre.db.duplicate_index import DuplicateIndex
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
-from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
+from calibre.db.frame import MetadataFrame
+from calibre.db.lazy import BatchProxyMetadata, FormatMetadata, FormatsList, ProxyMetadata
 from calibre.db.listeners import EventDispatcher, EventType
-from calibre.db.locking import DowngradeLockError, LockingError, SafeReadLock, create_locks, try_lock
+from calibre.db.locking import DowngradeLockError, LockingError, NullLock, ReadOnlyLock, SafeReadLock, VersionedSnapshots, create_locks, try_lock
 from calibre.db.notes.connect import copy_marked_up_text
 from calibre.db.search import Search
+from calibre.db.sort_index import SortIndex
 from calibre.db.tables import VirtualTable
 from calibre.db.utils import type_safe_sort_key_function
 from calibre.db.write import get_series_values, uniq
@@ -71,12 +78,29 @@ def read_api(f):
     return f
 
 
+def in_memory_read_api(f):
+    ''' A read API that uses only the in-memory tables, so that it can be
+    called on read snapshots without locking, see :meth:`Cache.read_snapshot` '''
+    f = read_api(f)
+    f.is_in_memory = True
+    return f
+
+
 def write_api(f):
     f = api(f)
     f.is_read_api = False
     return f
 
 
+def tracked_write_api(f):
+    ''' A write API that either does not change the in-memory tables or itself
+    marks the tables it changes, so that it invalidates only the changed parts of
+    read snapshots, see :meth:`Cache.read_snapshot` '''
+    f = write_api(f)
+    f.invalidates_snapshots = False
+    return f
+
+
 def wrap_simple(lock, func):
     @wraps(func)
     def call_func_with_lock(*args, **kwargs):
@@ -146,6 +170,7 @@ class Cache:
     '''
     EventType = EventType
     fts_indexing_sleep_time = 4  # seconds
+    is_read_snapshot = False
 
     def __init__(self, backend, library_database_instance=None):
         self.shutting_down = False
@@ -158,7 +183,11 @@ def __init__(self, backend, library_database_instance=None):
         self.event_dispatcher = EventDispatcher()
         self.fields = {}
         self.composites = {}
-        self.read_lock, self.write_lock = create_locks()
+        self.read_lock, self.write_lock = create_locks(on_write=self._invalidate_read_snapshot)
+        # Used for changes that do not touch the in-memory tables or that
+        # invalidate read snapshots themselves
+        self.tracked_write_lock = self.write_lock.variant()
+        self.snapshots = VersionedSnapshots(self.read_lock, self._create_read_snapshot)
         self.format_metadata_cache = defaultdict(dict)
         self.formatter_template_cache = {}
         self.dirtied_cache = {}
@@ -170,6 +199,9 @@ def __init__(self, backend, library_database_instance=None):
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        self.sort_index = SortIndex()
+        self.duplicate_index = DuplicateIndex()
+        self.category_cache = CategoryCache()
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -182,7 +214,10 @@ def __init__(self, backend, library_database_instance=None):
                 # Save original function
                 setattr(self, '_'+name, func)
                 # Wrap it in a lock
-                lock = self.read_lock if ira else self.write_lock
+                if ira:
+                    lock = self.read_lock
+                else:
+                    lock = self.write_lock if getattr(func, 'invalidates_snapshots', True) else self.tracked_write_lock
                 setattr(self, name, wrap_simple(lock, func))
 
         self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
@@ -205,6 +240,67 @@ def dbpath(self):
     def is_fat_filesystem(self):
         return self.backend.is_fat_filesystem
 
+    # Read snapshots {{{
+    def _invalidate_read_snapshot(self):
+        self.snapshots.invalidate()
+
+    def _create_read_snapshot(self, previous, changed_fields):
+        from calibre.db.snapshot import snapshot_fields
+        snap = copy.copy(self)
+        snap.is_read_snapshot = True
+        snap.snapshot_version = self.snapshots.version + 1
+        snap.read_lock = NullLock()
+        snap.write_lock = snap.tracked_write_lock = ReadOnlyLock()
+        snap.snapshots = None
+        snap.database_instance = weakref.ref(snap)
+        for name in dir(self.__class__):
+            func = getattr(self.__class__, name)
+            ira = getattr(func, 'is_read_api', None)
+            if ira is not None:
+                func = func.__get__(snap)
+                if ira and not getattr(func, 'is_in_memory', False):
+                    # Reads from the database or the filesystem are not part of
+                    # the snapshot, so they must use the shared lock of the cache
+                    func = wrap_simple(self.read_lock, func)
+                setattr(snap, '_' + name, func)
+                setattr(snap, name, func if ira else wrap_simple(snap.write_lock, func))
+        snap.fields = snapshot_fields(self.fields, None if previous is None else previous.fields, changed_fields, snap.database_instance)
+        snap.composites = {k: snap.fields[k] for k in self.composites}
+        snap.dirtied_cache = self.dirtied_cache.copy()
+        snap.format_metadata_cache = defaultdict(dict)
+        snap.formatter_template_cache = {}
+        snap.link_maps_cache = {}
+        snap.extra_files_cache = {}
+        snap.vls_for_books_cache = snap.vls_for_books_lib_in_process = None
+        snap.vls_cache_lock = Lock()
+        snap.sort_index = SortIndex()
+        snap.duplicate_index = DuplicateIndex()
+        snap.category_cache = CategoryCache()
+        snap._search_api = Search(snap, 'saved_searches', self.field_metadata.get_search_terms())
+        return snap
+
+    @api
+    def read_snapshot(self):
+        '''
+        Return an immutable snapshot of this cache that can be used exactly like
+        the cache for reading, but which never blocks waiting for writers when
+        reading the in-memory tables, since it uses no locks for them. Writes
+        are not allowed and raise a LockingError. The snapshot reflects the
+        state of the in-memory tables as of the last time a snapshot could be
+        refreshed without waiting, so it may not reflect changes that are in
+        progress. Data that is read directly from the database or the
+        filesystem, such as formats and annotations, is not part of the
+        snapshot and is read with the shared lock of the cache held, as usual.
+        Snapshots are refreshed lazily, copying only the tables that have
+        changed, at the cost of keeping a second copy of the tables in memory.
+
+        If the current thread holds the write lock, returns this cache itself.
+        '''
+        if self.is_read_snapshot:
+            return self
+        return self.snapshots.get() or self
+    # }}}
+
     @property
     def safe_read_lock(self):
         ''' A safe read lock is a lock that does nothing if the thread already
@@ -272,14 +368,31 @@ def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
-        for field in itervalues(self.composites):
-            field.clear_caches(book_ids=book_ids)
+    def clear_composite_caches(self, book_ids=None, changed_fields=None):
+        if book_ids is None or changed_fields is None:
+            for field in itervalues(self.composites):
+                field.clear_caches(book_ids=book_ids)
+            return
+        # Only clear the columns whose templates read one of the changed
+        # fields, directly or via another composite column
+        changed_fields = frozenset(changed_fields)
+        deps = {name: field.dependencies(self.field_metadata) for name, field in iteritems(self.composites)}
+
+        def affected(name, seen):
+            d = deps.get(name)
+            if d is None or not changed_fields.isdisjoint(d):
+                return True
+            seen.add(name)
+            return any(affected(x, seen) for x in d if x in deps and x not in seen)
+
+        for name, field in iteritems(self.composites):
+            if affected(name, set()):
+                field.clear_caches(book_ids=book_ids)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, changed_fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, changed_fields)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
@@ -314,7 +427,11 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
             self.format_metadata_cache.clear()
         if search_cache:
             self._clear_search_caches(book_ids)
+        if not book_ids:
+            self.category_cache.invalidate()
         self._clear_link_map_cache(book_ids)
+        self.sort_index.invalidate(book_ids)
+        self.duplicate_index.invalidate(book_ids)
 
     @write_api
     def clear_link_map_cache(self, book_ids=None):
@@ -333,7 +450,13 @@ def reload_from_db(self, clear_caches=True):
             self._search_api.saved_searches.load_from_db()
             for field in itervalues(self.fields):
                 if hasattr(field, 'table'):
+                    # Tables whose reading was deferred are read now as well, so
+                    # that all tables reflect the same state of the database
+                    field.table.deferred_reader = None
                     field.table.read(self.backend)  # Reread data from metadata.db
+        self.sort_index.invalidate()
+        self.duplicate_index.invalidate()
+        self.category_cache.invalidate()
 
     @property
     def field_metadata(self):
@@ -493,7 +616,7 @@ def fts_start_measuring_rate(self, measure=True):
         self.fts_measuring_rate = monotonic() if measure else None
         self.fts_num_done_since_start = 0
 
-    def _update_fts_indexing_numbers(self, job_time=None):
+    def _update_fts_indexing_numbers(self, job_time=None, num_done=1):
         # this is called when new formats are added and when a format is
         # indexed, but NOT when books or formats are deleted, so total may not
         # be up to date.
@@ -502,7 +625,7 @@ def _update_fts_indexing_numbers(self, job_time=None):
         if not nl:
             self._fts_start_measuring_rate(measure=False)
         if job_time is not None and self.fts_measuring_rate is not None:
-            self.fts_num_done_since_start += 1
+            self.fts_num_done_since_start += num_done
         if (self.fts_indexing_left, self.fts_indexing_total) != (nl, nt) or job_time is not None:
             self.fts_indexing_left = nl
             self.fts_indexing_total = nt
@@ -510,9 +633,16 @@ def _update_fts_indexing_numbers(self, job_time=None):
 
     @read_api
     def fts_indexing_progress(self):
+        ''' Return (number of formats left to index, total number of books,
+        indexing rate in formats per second). The rate is measured since the
+        last call to :meth:`fts_start_measuring_rate` if any, otherwise it is
+        the recent rate at which the worker processes are completing jobs.
+        It is None when not yet known. '''
         rate = None
         if self.fts_measuring_rate is not None and self.fts_num_done_since_start > 4:
             rate = self.fts_num_done_since_start / (monotonic() - self.fts_measuring_rate)
+        elif self.fts_measuring_rate is None and self.fts_indexing_left:
+            rate = self.backend.fts_jobs_per_second
         return self.fts_indexing_left, self.fts_indexing_total, rate
 
     @write_api
@@ -547,14 +677,25 @@ def do_one():
                 book_id, fmt = self.backend.get_next_fts_job()
                 if book_id is None:
                     return False
-                path = self._format_abspath(book_id, fmt)
+                path = None
+                if self.backend.prefs['fts_skip_secondary_formats']:
+                    fmt_to_index = self._fts_format_to_index(book_id, fmt, is_fmt_extractable)
+                    if fmt_to_index is not None:
+                        fmt = fmt_to_index
+                        path = self._format_abspath(book_id, fmt)
+                else:
+                    path = self._format_abspath(book_id, fmt)
             if not path or not is_fmt_extractable(fmt):
-                with self.write_lock:
+                with self.tracked_write_lock:
                     self.backend.remove_dirty_fts(book_id, fmt)
                     self._update_fts_indexing_numbers()
                 return True
 
-            with self.read_lock, open(path, 'rb') as src, PersistentTemporaryFile(suffix=f'.{fmt.lower()}') as pt:
+            # The worker reads the format file in place, except on Windows,
+            # where open files cannot be renamed or deleted, so a copy is used
+            # to avoid locking the book folder while the text is extracted
+            read_in_place = not iswindows
+            with self.read_lock, open(path, 'rb') as src, (nullcontext() if read_in_place else PersistentTemporaryFile(suffix=f'.{fmt.lower()}')) as pt:
                 sz = 0
                 h = hashlib.sha1()
                 while True:
@@ -563,9 +704,13 @@ def do_one():
                         break
                     sz += len(chunk)
                     h.update(chunk)
-                    pt.write(chunk)
-            with self.write_lock:
-                queued = self.backend.queue_fts_job(book_id, fmt, pt.name, sz, h.hexdigest(), start_time)
+                    if pt is not None:
+                        pt.write(chunk)
+                st = os.fstat(src.fileno())
+                signature = (st.st_size, st.st_mtime_ns) if read_in_place else None
+            with self.tracked_write_lock:
+                queued = self.backend.queue_fts_job(
+                    book_id, fmt, path if read_in_place else pt.name, sz, h.hexdigest(), start_time, signature)
                 if not queued:  # means a dirtied book was removed from the dirty list because the text has not changed
                     self._update_fts_indexing_numbers(monotonic() - start_time)
                 return self.backend.fts_has_idle_workers
@@ -589,20 +734,55 @@ def loop_while_more_available():
                 break
             loop_while_more_available()
 
-    @write_api
+    def _fts_format_to_index(self, book_id, fmt, is_fmt_extractable):
+        ''' Used when only the preferred format of each book is indexed.
+        Returns None if a format of the book that is preferred to fmt has
+        already been indexed, otherwise the most preferred format that is
+        waiting to be indexed. '''
+        order = {f.upper(): i for i, f in enumerate(prefs['input_format_order'])}
+        rank = order.get(fmt.upper(), len(order))
+        preferred = sorted((f for f in self._formats(book_id) if order.get(f, len(order)) < rank and is_fmt_extractable(f)), key=order.__getitem__)
+        if not preferred:
+            return fmt
+        if not self.backend.fts_indexed_formats(book_id).isdisjoint(preferred):
+            return None
+        dirtied = self.backend.fts_dirtied_formats(book_id)
+        for f in preferred:
+            if f in dirtied:
+                return f
+        return fmt
+
+    @tracked_write_api
     def queue_next_fts_job(self):
         if not self.backend.fts_enabled:
             return
         self.fts_job_queue.put(True)
         self._update_fts_indexing_numbers()
 
-    @write_api
+    @tracked_write_api
     def commit_fts_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg, start_time):
         ans = self.backend.commit_fts_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
         self._update_fts_indexing_numbers(monotonic() - start_time)
         return ans
 
-    @write_api
+    @tracked_write_api
+    def commit_fts_results(self, results):
+        ''' Commit many FTS results in a single transaction. Each result is a
+        tuple: (book_id, fmt, fmt_size, fmt_hash, text, err_msg, start_time) '''
+        if not results:
+            return
+        self.backend.commit_fts_results(tuple(r[:-1] for r in results))
+        self._update_fts_indexing_numbers(monotonic() - min(r[-1] for r in results), num_done=len(results))
+
+    @tracked_write_api
+    def requeue_fts_job(self, book_id, fmt):
+        self.backend.requeue_fts_job(book_id, fmt)
+
+    @tracked_write_api
+    def merge_fts_segments(self, pages=256):
+        return self.backend.merge_fts_segments(pages)
+
+    @tracked_write_api
     def reindex_fts_book(self, book_id, *fmts):
         if not self.is_fts_enabled():
             return
@@ -625,7 +805,7 @@ def reindex_fts(self):
             self._queue_next_fts_job()
         return fts
 
-    @write_api
+    @tracked_write_api
     def set_fts_num_of_workers(self, num):
         existing = self.backend.fts_num_of_workers
         if num != existing:
@@ -635,7 +815,7 @@ def set_fts_num_of_workers(self, num):
             return True
         return False
 
-    @write_api
+    @tracked_write_api
     def set_fts_speed(self, slow=True):
         orig = self.fts_indexing_sleep_time
         if slow:
@@ -649,7 +829,7 @@ def set_fts_speed(self, slow=True):
             self._fts_start_measuring_rate()
         return changed
 
-    @write_api  # we need to use write locking as SQLITE gives a locked table error if multiple FTS queries are made at the same time
+    @tracked_write_api  # we need to use write locking as SQLITE gives a locked table error if multiple FTS queries are made at the same time
     def fts_search(
         self,
         fts_engine_query,
@@ -661,7 +841,11 @@ def fts_search(
         return_text=True,
         result_type=tuple,
         process_each_result=None,
+        limit=None,
+        offset=0,
     ):
+        ''' Search the full text of books. Results are in order of relevance,
+        use limit and offset to get only a page of them. '''
         return result_type(self.backend.fts_search(
             fts_engine_query,
             use_stemming=use_stemming,
@@ -671,6 +855,8 @@ def fts_search(
             return_text=return_text,
             restrict_to_book_ids=restrict_to_book_ids,
             process_each_result=process_each_result,
+            limit=limit,
+            offset=offset,
         ))
 
     # }}}
@@ -715,7 +901,7 @@ def items_with_notes_in_book(self, book_id: int) -> dict[str, dict[int, str]]:
                 ans[k] = v
         return ans
 
-    @write_api
+    @tracked_write_api
     def set_notes_for(self, field, item_id, doc: str, searchable_text: str = copy_marked_up_text, resource_hashes=(), remove_unused_resources=False) -> int:
         '''
         Set the notes document. If the searchable text is different from the document, specify it as searchable_text. If the document
@@ -726,7 +912,7 @@ def set_notes_for(self, field, item_id, doc: str, searchable_text: str = copy_ma
         self.event_dispatcher(EventType.notes_changed, field, frozenset({item_id}))
         return ans
 
-    @write_api
+    @tracked_write_api
     def add_notes_resource(self, path_or_stream_or_data, name: str, mtime: float = None) -> int:
         ' Add the specified resource so it can be referenced by notes and return its content hash '
         return self.backend.add_notes_resource(path_or_stream_or_data, name, mtime)
@@ -741,7 +927,7 @@ def notes_resources_used_by(self, field, item_id):
         ' Return the set of resource hashes of all resources used by the note for the specified item '
         return frozenset(self.backend.notes_resources_used_by(field, item_id))
 
-    @write_api
+    @tracked_write_api
     def unretire_note_for(self, field, item_id) -> int:
         ' Unretire a previously retired note for the specified item. Notes are retired when an item is removed from the database '
         ans = self.backend.unretire_note_for(field, item_id)
@@ -753,7 +939,7 @@ def export_note(self, field, item_id) -> str:
         ' Export the note as a single HTML document with embedded images as data: URLs '
         return self.backend.export_note(field, item_id)
 
-    @write_api
+    @tracked_write_api
     def import_note(self, field, item_id, path_to_html_file, path_is_data=False):
         ' Import a previously exported note or an arbitrary HTML file as the note for the specified item '
         if path_is_data:
@@ -770,7 +956,7 @@ def import_note(self, field, item_id, path_to_html_file, path_is_data=False):
         self.event_dispatcher(EventType.notes_changed, field, frozenset({item_id}))
         return ans
 
-    @write_api  # we need to use write locking as SQLITE gives a locked table error if multiple FTS queries are made at the same time
+    @tracked_write_api  # we need to use write locking as SQLITE gives a locked table error if multiple FTS queries are made at the same time
     def search_notes(
         self,
         fts_engine_query='',
@@ -817,7 +1003,7 @@ def add_listener(self, event_callback_function, check_already_added=False):
     def remove_listener(self, event_callback_function):
         self.event_dispatcher.remove_listener(event_callback_function)
 
-    @read_api
+    @in_memory_read_api
     def field_for(self, name, book_id, default_value=None):
         '''
         Return the value of the field ``name`` for the book identified
@@ -849,7 +1035,7 @@ def field_for(self, name, book_id, default_value=None):
         except (KeyError, IndexError):
             return default_value
 
-    @read_api
+    @in_memory_read_api
     def fast_field_for(self, field_obj, book_id, default_value=None):
         ' Same as field_for, except that it avoids the extra lookup to get the field object '
         if field_obj.is_composite:
@@ -861,13 +1047,13 @@ def fast_field_for(self, field_obj, book_id, default_value=None):
         except (KeyError, IndexError):
             return default_value
 
-    @read_api
+    @in_memory_read_api
     def all_field_for(self, field, book_ids, default_value=None):
         ' Same as field_for, except that it operates on multiple books at once '
         field_obj = self.fields[field]
         return {book_id:self._fast_field_for(field_obj, book_id, default_value=default_value) for book_id in book_ids}
 
-    @read_api
+    @in_memory_read_api
     def composite_for(self, name, book_id, mi=None, default_value=''):
         try:
             f = self.fields[name]
@@ -879,7 +1065,7 @@ def composite_for(self, name, book_id, mi=None, default_value=''):
         else:
             return f._render_composite_with_cache(book_id, mi, mi.formatter, mi.template_cache)
 
-    @read_api
+    @in_memory_read_api
     def field_ids_for(self, name, book_id):
         '''
         Return the ids (as a tuple) for the values that the field ``name`` has on the book
@@ -891,7 +1077,7 @@ def field_ids_for(self, name, book_id):
         except (KeyError, IndexError):
             return ()
 
-    @read_api
+    @in_memory_read_api
     def books_for_field(self, name, item_id):
         '''
         Return all the books associated with the item identified by
@@ -905,21 +1091,21 @@ def books_for_field(self, name, item_id):
         except (KeyError, IndexError):
             return set()
 
-    @read_api
+    @in_memory_read_api
     def all_book_ids(self, type=frozenset):
         '''
         Frozen set of all known book ids.
         '''
         return type(self.fields['uuid'].table.book_col_map)
 
-    @read_api
+    @in_memory_read_api
     def all_field_ids(self, name):
         '''
         Frozen set of ids for all values in the field ``name``.
         '''
         return frozenset(iter(self.fields[name]))
 
-    @read_api
+    @in_memory_read_api
     def all_field_names(self, field):
         ''' Frozen set of all fields names (should only be used for many-one and many-many fields) '''
         if field == 'formats':
@@ -930,7 +1116,7 @@ def all_field_names(self, field):
         except AttributeError:
             raise ValueError(f'{field} is not a many-one or many-many field')
 
-    @read_api
+    @in_memory_read_api
     def get_usage_count_by_id(self, field):
         ''' Return a mapping of id to usage count for all values of the specified
         field, which must be a many-one or many-many field. '''
@@ -939,7 +1125,7 @@ def get_usage_count_by_id(self, field):
         except AttributeError:
             raise ValueError(f'{field} is not a many-one or many-many field')
 
-    @read_api
+    @in_memory_read_api
     def get_id_map(self, field):
         ''' Return a mapping of id numbers to values for the specified field.
         The field must be a many-one or many-many field, otherwise a ValueError
@@ -951,13 +1137,13 @@ def get_id_map(self, field):
                 return self.fields[field].table.book_col_map.copy()
             raise ValueError(f'{field} is not a many-one or many-many field')
 
-    @read_api
+    @in_memory_read_api
     def get_item_name(self, field, item_id):
         ''' Return the item name for the item specified by item_id in the
         specified field. See also :meth:`get_id_map`.'''
         return self.fields[field].table.id_map[item_id]
 
-    @read_api
+    @in_memory_read_api
     def get_item_id(self, field, item_name, case_sensitive=False):
         ''' Return the item id for item_name or None if not found.
         This function is very slow if doing lookups for multiple names use either get_item_ids() or get_item_name_map().
@@ -968,7 +1154,7 @@ def get_item_id(self, field, item_name, case_sensitive=False):
             for v in d.values():
                 return v
 
-    @read_api
+    @in_memory_read_api
     def get_item_ids(self, field, item_names, case_sensitive=False):
         ' Return a dict mapping item_name to the item id or None '
         field = self.fields[field]
@@ -976,14 +1162,14 @@ def get_item_ids(self, field, item_names, case_sensitive=False):
             return field.item_ids_for_names(self.backend, item_names, case_sensitive)
         return dict.fromkeys(item_names)
 
-    @read_api
+    @in_memory_read_api
     def get_item_name_map(self, field, normalize_func=None):
         ' Return mapping of item values to ids '
         if normalize_func is None:
             return {v:k for k, v in self.fields[field].table.id_map.items()}
         return {normalize_func(v):k for k, v in self.fields[field].table.id_map.items()}
 
-    @read_api
+    @in_memory_read_api
     def author_data(self, author_ids=None):
         '''
         Return author data as a dictionary with keys: name, sort, link
@@ -1058,7 +1244,7 @@ def format_db_size(self, book_id, fmt):
         field = self.fields['formats']
         return field.format_size(book_id, fmt)
 
-    @read_api
+    @in_memory_read_api
     def pref(self, name, default=None, namespace=None):
         ' Return the value for the specified preference or the value specified as ``default`` if the preference is not set. '
         if namespace is not None:
@@ -1117,7 +1303,7 @@ def get_metadata(self, book_id,
 
         return mi
 
-    @read_api
+    @in_memory_read_api
     def get_proxy_metadata(self, book_id):
         ''' Like :meth:`get_metadata` except that it returns a ProxyMetadata
         object that only reads values from the database on demand. This is much
@@ -1125,6 +1311,36 @@ def get_proxy_metadata(self, book_id):
         accessed from the returned metadata object. '''
         return ProxyMetadata(self, book_id)
 
+    @in_memory_read_api
+    def metadata_frame(self, book_ids, fields, default_value=None):
+        '''
+        Return the values of the specified fields for the specified books as
+        a :class:`calibre.db.frame.MetadataFrame`, which stores one column of
+        values per field. The values are the same as those returned by
+        :meth:`field_for`, but are read one field at a time, so this is much
+        faster than calling :meth:`field_for` or :meth:`get_proxy_metadata`
+        for every book. Composite columns are rendered for all books whose
+        values are not cached, reading the fields their templates use in one
+        pass. Unknown fields have ``default_value`` for every book.
+        '''
+        book_ids = tuple(book_ids)
+        get_metadata = None
+        columns = {}
+        for name in fields:
+            try:
+                field = self.fields[name]
+            except KeyError:
+                columns[name] = (default_value,) * len(book_ids)
+                continue
+            if field.is_composite:
+                if get_metadata is None:
+                    get_metadata = BatchProxyMetadata(self)
+                vals = field.column_for_books(book_ids, get_metadata=get_metadata)
+            else:
+                vals = field.column_for_books(book_ids, field.default_value if field.is_multiple else default_value)
+            columns[name] = tuple(vals)
+        return MetadataFrame(book_ids, columns)
+
     @api
     def cover(self, book_id,
             as_file=False, as_image=False, as_path=False, as_pixmap=False):
@@ -1422,8 +1638,8 @@ def newly_added_book_ids(self, count=5, book_ids=None) -> list[int]:
     def size_stats(self) -> dict[str, int]:
         return self.backend.size_stats()
 
-    @read_api
-    def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
+    @in_memory_read_api
+    def multisort(self, fields, ids_to_sort=None, virtual_fields=None, use_sort_index=True):
         '''
         Return a list of sorted book ids. If ids_to_sort is None, all book ids
         are returned.
@@ -1431,20 +1647,31 @@ def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
         fields must be a list of 2-tuples of the form (field_name,
         ascending=True or False). The most significant field is the first
         2-tuple.
+
+        When use_sort_index is True, the sort is done using ranks that are
+        cached per field in :attr:`sort_index` and only re-calculated for books
+        whose metadata has changed.
         '''
         ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
-        get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
+        get_metadata = BatchProxyMetadata(self)
+        lang_map = None
         virtual_fields = virtual_fields or {}
 
         fm = {'title':'sort', 'authors':'author_sort'}
 
         def sort_key_func(field):
             'Handle series type fields, virtual fields and the id field'
+            nonlocal lang_map
+            if lang_map is None:
+                lang_map = self.fields['languages'].book_value_map
             idx = field + '_index'
             is_series = idx in self.fields
             try:
-                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                field_obj = self.fields[fm.get(field, field)]
+                if field_obj.is_composite:
+                    # Render the values for all books at once, so they are cached when sorting
+                    field_obj.render_for_books(ids_to_sort, get_metadata)
+                func = field_obj.sort_keys_for_books(get_metadata, lang_map)
             except KeyError:
                 if field == 'id':
                     return IDENTITY
@@ -1458,9 +1685,21 @@ def skf(book_id):
                 return skf
             return func
 
+        def is_indexable(field):
+            # Composite and virtual fields can change without the books
+            # being modified, so their ranks cannot be kept around
+            f = self.fields.get(fm.get(field, field))
+            return f is not None and not f.is_composite and f.name != 'ondevice' and field not in virtual_fields
+
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
 
+        if use_sort_index:
+            try:
+                return self.sort_index.multisort(ids_to_sort, fields, sort_key_func, is_indexable)
+            except Exception:
+                pass  # Fall back to comparing sort keys, with its type safe fallbacks
+
         if len(fields) == 1:
             keyfunc = sort_key_func(fields[0][0])
             reverse = not fields[0][1]
@@ -1517,8 +1756,8 @@ def __ge__(self, other):
 
         return sorted(ids_to_sort, key=SortKey)
 
-    @read_api
-    def search(self, query, restriction='', virtual_fields=None, book_ids=None):
+    @in_memory_read_api
+    def search(self, query, restriction='', virtual_fields=None, book_ids=None, as_bitmap=False):
         '''
         Search the database for the specified query, returning a set of matched book ids.
 
@@ -1529,28 +1768,37 @@ def search(self, query, restriction='', virtual_fields=None, book_ids=None):
 
         :param book_ids: If not None, a set of book ids for which books will
             be searched instead of searching all books.
+
+        :param as_bitmap: If True, return a read-only :class:`calibre.db.bitmap.Bitmap`
+            instead of a set. This is much cheaper for cached searches and
+            restrictions when the result is only used for membership tests or
+            intersections.
         '''
-        return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
+        ans = self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids, as_bitmap=as_bitmap)
+        # Cached results are shared, so give callers a set they can change
+        return set(ans) if type(ans) is frozenset else ans
 
-    @read_api
-    def books_in_virtual_library(self, vl, search_restriction=None, virtual_fields=None):
-        ' Return the set of books in the specified virtual library '
+    @in_memory_read_api
+    def books_in_virtual_library(self, vl, search_restriction=None, virtual_fields=None, as_bitmap=False):
+        ' Return the set of books in the specified virtual library, as a :class:`calibre.db.bitmap.Bitmap` if as_bitmap is True '
         vl = self._pref('virtual_libraries', {}).get(vl) if vl else None
         if not vl and not search_restriction:
-            return self.all_book_ids()
-        # We utilize the search restriction cache to speed this up
-        srch = partial(self._search, virtual_fields=virtual_fields)
-        if vl:
-            if search_restriction:
-                return frozenset(srch('', vl) & srch('', search_restriction))
-            return frozenset(srch('', vl))
-        return frozenset(srch('', search_restriction))
+            return Bitmap(self._all_book_ids()) if as_bitmap else self._all_book_ids()
+        # We utilize the search restriction cache to speed this up, the
+        # cached results are bitmaps and are intersected as such
+        if vl and search_restriction:
+            srch = partial(self._search, virtual_fields=virtual_fields, as_bitmap=True)
+            ans = srch('', vl) & srch('', search_restriction)
+        else:
+            # Cached results are decoded to a frozenset only once per entry
+            ans = self._search_api(self, '', vl or search_restriction, virtual_fields=virtual_fields, as_bitmap=as_bitmap)
+        return ans if as_bitmap or isinstance(ans, frozenset) else frozenset(ans)
 
-    @read_api
+    @in_memory_read_api
     def number_of_books_in_virtual_library(self, vl=None, search_restriction=None):
         if not vl and not search_restriction:
             return len(self.fields['uuid'].table.book_col_map)
-        return len(self.books_in_virtual_library(vl, search_restriction))
+        return len(self.books_in_virtual_library(vl, search_restriction, as_bitmap=True))
 
     @api
     def get_categories(self, sort='name', book_ids=None, already_fixed=None,
@@ -1567,22 +1815,29 @@ def get_categories(self, sort='name', book_ids=None, already_fixed=None,
                 raise
             with self.write_lock:
                 self.fields[bad_field].table.fix_link_table(self.backend)
+                self.category_cache.invalidate((bad_field,))
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
+            if changed_fields is not None:
+                changed_fields = frozenset(changed_fields) | {'last_modified'}
             if self.composites:
-                self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+                self._clear_composite_caches(book_ids, changed_fields)
+            self.snapshots.invalidate(changed_fields)
+            self._clear_search_caches(book_ids, changed_fields)
+            # All metadata changes, including set_field(), end up here
+            self.sort_index.invalidate(book_ids)
+            self.duplicate_index.invalidate(book_ids)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1611,7 +1866,7 @@ def check_dirtied_annotations(self):
             self.dirtied_sequence = max(itervalues(new_dirtied)) + 1
             self.dirtied_cache.update(new_dirtied)
 
-    @write_api
+    @tracked_write_api
     def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_update=True):
         '''
         Set the values of the field specified by ``name``. Returns the set of all book ids that were affected by the change.
@@ -1646,19 +1901,37 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
                     simap[k] = sid
             book_id_to_val_map = bimap
 
+        # Tag browser categories are updated for the changed books only
+        category_state = self.category_cache.state_for_books(self, book_id_to_val_map, (name,))
+        case_duplicates_fixed = f.table.case_duplicates_fixed
         dirtied = f.writer.set_books(
             book_id_to_val_map, self.backend, allow_case_change=allow_case_change)
+        if f.table.case_duplicates_fixed != case_duplicates_fixed:
+            # Items were merged, changing books that are not in book_id_to_val_map
+            self.category_cache.invalidate((name,))
+        self.category_cache.update(self, category_state)
 
+        changed_fields = {name}
         if is_series and simap:
             sf = self.fields[f.name+'_index']
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
+            changed_fields.add(sf.name)
 
         if dirtied:
             if update_path and do_path_update:
                 self._update_path(dirtied, mark_as_dirtied=False)
-            self._mark_as_dirty(dirtied)
+                changed_fields |= {'path', 'formats'}
+            # The writers for these fields also update their sort fields
+            if name == 'title':
+                changed_fields.add('sort')
+            elif name == 'authors':
+                changed_fields.add('author_sort')
+            self._mark_as_dirty(dirtied, changed_fields=changed_fields)
             self._clear_link_map_cache(dirtied)
             self.event_dispatcher(EventType.metadata_changed, name, dirtied)
+        else:
+            # The writer may still have changed the case of items
+            self.snapshots.invalidate(changed_fields)
         return dirtied
 
     @write_api
@@ -1681,6 +1954,21 @@ def get_a_dirtied_book(self):
             return random.choice(tuple(self.dirtied_cache))
         return None
 
+    @read_api
+    def get_dirtied_books(self, limit=None):
+        ''' Return the ids of up to limit dirtied books, the ones that were
+        dirtied earliest first. '''
+        if limit is None or limit >= len(self.dirtied_cache):
+            return sorted(self.dirtied_cache, key=self.dirtied_cache.__getitem__)
+        return heapq.nsmallest(limit, self.dirtied_cache, key=self.dirtied_cache.__getitem__)
+
+    @property
+    def is_busy(self):
+        ''' True if other threads, such as the GUI or the server, are
+        currently waiting to use this database. Background tasks use this to
+        throttle themselves. '''
+        return self.read_lock.is_contended
+
     def _metadata_as_object_for_dump(self, book_id):
         mi = self._get_metadata(book_id)
         # Always set cover to cover.jpg. Even if cover doesn't exist,
@@ -1728,6 +2016,61 @@ def write_backup(self, book_id, raw):
 
         self.backend.write_backup(path, raw)
 
+    @api
+    def write_backups(self, book_id_to_raw_map, max_workers=4):
+        ''' Write the OPF backups for many books, using up to max_workers
+        threads for the file I/O. The files are written without holding any
+        lock, so that readers and writers are not blocked while they are
+        written. Returns the set of book ids for which writing failed. '''
+        paths = {}
+        with self.safe_read_lock:
+            for book_id in book_id_to_raw_map:
+                try:
+                    paths[book_id] = self._field_for('path', book_id).replace('/', os.sep)
+                except Exception:
+                    pass
+        moved = set()
+
+        def write(book_id):
+            try:
+                self.backend.write_backup(paths[book_id], book_id_to_raw_map[book_id], create_dirs=False)
+            except FileNotFoundError:
+                # The folder of the book was moved or removed after its path
+                # was read, or is missing
+                moved.add(book_id)
+            except Exception:
+                traceback.print_exc()
+                return book_id
+
+        if max_workers < 2 or len(paths) < 2:
+            failed = tuple(map(write, paths))
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(paths)), thread_name_prefix='BackupWriter') as executor:
+                failed = tuple(executor.map(write, paths))
+        failed = {book_id for book_id in failed if book_id is not None}
+        for book_id in moved:
+            # Write at the current location of the book with the lock held,
+            # creating the folder if needed
+            try:
+                self.write_backup(book_id, book_id_to_raw_map[book_id])
+            except Exception:
+                traceback.print_exc()
+                failed.add(book_id)
+        return failed
+
+    @write_api
+    def clear_dirtied_books(self, book_id_to_sequence_map):
+        ''' Clear the dirtied indicator for many books at once, see :meth:`clear_dirtied` '''
+        clean = []
+        for book_id, sequence in book_id_to_sequence_map.items():
+            dc_sequence = self.dirtied_cache.get(book_id, None)
+            if dc_sequence is None or sequence is None or dc_sequence == sequence:
+                clean.append(book_id)
+                self.dirtied_cache.pop(book_id, None)
+        if clean:
+            self.backend.mark_books_as_clean(clean)
+
     @read_api
     def dirty_queue_length(self):
         return len(self.dirtied_cache)
@@ -2073,7 +2416,7 @@ def get_next_series_num_for(self, series, field='series', current_indices=False)
         sf = self.fields[field]
         if series:
             q = icu_lower(series)
-            for val, book_ids in sf.iter_searchable_values(self._get_proxy_metadata, frozenset(self._all_book_ids())):
+            for val, book_ids in sf.iter_searchable_values(BatchProxyMetadata(self), frozenset(self._all_book_ids())):
                 if q == icu_lower(val):
                     books = book_ids
                     break
@@ -2097,18 +2440,30 @@ def author_sort_from_authors(self, authors, key_func=icu_lower):
             result.append(author_to_author_sort(aut) if aid is None else table.asort_map[aid])
         return ' & '.join(_f for _f in result if _f)
 
-    @read_api
+    def _data_for_duplicate_index(self, book_ids):
+        title_map = self.fields['title'].table.book_col_map
+        ff = self._field_for
+        for book_id in book_ids:
+            title = title_map.get(book_id) or ''
+            if isbytestring(title):
+                title = as_unicode(title)
+            yield book_id, title, ff('authors', book_id), ff('languages', book_id), ff('identifiers', book_id)
+
+    def _up_to_date_duplicate_index(self):
+        ''' Return :attr:`duplicate_index` after updating it for any books that
+        have changed. The caller must hold the index's lock. '''
+        self.duplicate_index.ensure(self.fields['title'].table.book_col_map, self._data_for_duplicate_index)
+        return self.duplicate_index
+
+    @in_memory_read_api
     def data_for_has_book(self):
         ''' Return data suitable for use in :meth:`has_book`. This can be used for an
         implementation of :meth:`has_book` in a worker process without access to the
         db. '''
-        try:
-            return {icu_lower(title) for title in itervalues(self.fields['title'].table.book_col_map)}
-        except TypeError:
-            # Some non-unicode titles in the db
-            return {icu_lower(as_unicode(title)) for title in itervalues(self.fields['title'].table.book_col_map)}
+        with self.duplicate_index.lock:
+            return self._up_to_date_duplicate_index().titles()
 
-    @read_api
+    @in_memory_read_api
     def has_book(self, mi):
         ''' Return True iff the database contains an entry with the same title
         as the passed in Metadata object. The comparison is case-insensitive.
@@ -2118,12 +2473,18 @@ def has_book(self, mi):
             if isbytestring(title):
                 title = title.decode(preferred_encoding, 'replace')
             q = icu_lower(title).strip()
-            for title in itervalues(self.fields['title'].table.book_col_map):
-                if q == icu_lower(title):
-                    return True
+            with self.duplicate_index.lock:
+                return bool(self._up_to_date_duplicate_index().books_with_title(q))
         return False
 
     @read_api
+    def books_with_identifier(self, typ, val):
+        ''' Return the ids of all books that have the identifier typ:val, for
+        example: :code:`books_with_identifier('isbn', '9780316225205')` '''
+        with self.duplicate_index.lock:
+            return set(self._up_to_date_duplicate_index().books_with_identifier(typ, val))
+
+    @in_memory_read_api
     def has_id(self, book_id):
         ' Return True iff the specified book_id exists in the db '
         return book_id in self.fields['title'].table.book_col_map
@@ -2185,9 +2546,31 @@ def create_book_entry(self, mi, cover=None, add_duplicates=True, force_id=None,
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        self.duplicate_index.invalidate((book_id,))
 
         return book_id
 
+    @write_api
+    def create_book_entries(self, entries, add_duplicates=True, apply_import_tags=True):
+        '''
+        Create entries for many books at once, in a single transaction. entries
+        must be an iterable of 2-tuples of the form :code:`(mi, cover)`, see
+        :meth:`create_book_entry`.
+
+        Returns a list with an item for every entry, the id of the newly
+        created book, None if the book was not created because it is a
+        duplicate or False if creating it failed.
+        '''
+        ans = []
+        with self.backend.conn:  # Much faster than autocommit mode when creating many books
+            for mi, cover in entries:
+                try:
+                    ans.append(self._create_book_entry(mi, cover=cover, add_duplicates=add_duplicates, apply_import_tags=apply_import_tags))
+                except Exception:
+                    traceback.print_exc()
+                    ans.append(False)
+        return ans
+
     @api
     def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False, run_hooks=True, dbapi=None):
         '''
@@ -2234,6 +2617,10 @@ def remove_books(self, book_ids, permanent=False):
                     self.backend.write_backup(path, raw)
                 except Exception:
                     traceback.print_exc()
+        # The in-memory tables must match the database before the books are
+        # deleted from it, so that unused items can be found and removed
+        self.backend.read_deferred_tables()
+        category_state = self.category_cache.state_for_books(self, book_ids)
         self.backend.remove_books(path_map, permanent=permanent)
         for field in itervalues(self.fields):
             try:
@@ -2242,13 +2629,14 @@ def remove_books(self, book_ids, permanent=False):
                 continue  # Some fields like ondevice do not have tables
             else:
                 table.remove_books(book_ids, self.backend)
+        self.category_cache.update(self, category_state)
         self._search_api.discard_books(book_ids)
         self._clear_caches(book_ids=book_ids, template_cache=False, search_cache=False)
         for cc in self.cover_caches:
             cc.invalidate(book_ids)
         self.event_dispatcher(EventType.books_removed, book_ids)
 
-    @read_api
+    @in_memory_read_api
     def author_sort_strings_for_books(self, book_ids):
         val_map = {}
         for book_id in book_ids:
@@ -2356,6 +2744,7 @@ def rename_items(self, field, item_id_to_new_name_map, change_index=True, restri
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
             self._mark_as_dirty(affected_books)
             self._clear_link_map_cache(affected_books)
+            self.category_cache.invalidate((field,))
         self.event_dispatcher(EventType.items_renamed, field, affected_books, id_map)
         return affected_books, id_map
 
@@ -2376,10 +2765,11 @@ def remove_items(self, field, item_ids, restrict_to_book_ids=None):
             else:
                 self._mark_as_dirty(affected_books)
             self._clear_link_map_cache(affected_books)
+            self.category_cache.invalidate((field.name,))
         self.event_dispatcher(EventType.items_removed, field, affected_books, item_ids)
         return affected_books
 
-    @write_api
+    @tracked_write_api
     def add_custom_book_data(self, name, val_map, delete_first=False):
         ''' Add data for name where val_map is a map of book_ids to values. If
         delete_first is True, all previously stored data for name will be
@@ -2397,7 +2787,7 @@ def get_custom_book_data(self, name, book_ids=(), default=None):
         default for it. '''
         return self.backend.get_custom_book_data(name, book_ids, default)
 
-    @write_api
+    @tracked_write_api
     def delete_custom_book_data(self, name, book_ids=()):
         ''' Delete data for name. By default deletes all data, if you only want
         to delete data for some book ids, pass in a list of book ids. '''
@@ -2416,11 +2806,11 @@ def conversion_options(self, book_id, fmt='PIPE'):
     def has_conversion_options(self, ids, fmt='PIPE'):
         return self.backend.has_conversion_options(ids, fmt)
 
-    @write_api
+    @tracked_write_api
     def delete_conversion_options(self, book_ids, fmt='PIPE'):
         return self.backend.delete_conversion_options(book_ids, fmt)
 
-    @write_api
+    @tracked_write_api
     def set_conversion_options(self, options, fmt='PIPE'):
         ''' options must be a map of the form {book_id:conversion_options} '''
         return self.backend.set_conversion_options(options, fmt)
@@ -2640,7 +3030,7 @@ def set_link_map(self, field, value_to_link_map, only_set_if_no_existing_link=Fa
         self.event_dispatcher(EventType.links_changed, field, frozenset(id_to_link_map))
         return changed_books
 
-    @read_api
+    @in_memory_read_api
     def lookup_by_uuid(self, uuid):
         return self.fields['uuid'].table.lookup_by_uuid(uuid)
 
@@ -2663,15 +3053,15 @@ def set_custom_column_metadata(self, num, name=None, label=None, is_editable=Non
                 self.backend.prefs.set('update_all_last_mod_dates_on_start', True)
         return changed
 
-    @read_api
+    @in_memory_read_api
     def get_books_for_category(self, category, item_id_or_composite_value):
         f = self.fields[category]
         if hasattr(f, 'get_books_for_val'):
             # Composite field
-            return f.get_books_for_val(item_id_or_composite_value, self._get_proxy_metadata, self._all_book_ids())
+            return f.get_books_for_val(item_id_or_composite_value, BatchProxyMetadata(self), self._all_book_ids())
         return self._books_for_field(f.name, int(item_id_or_composite_value))
 
-    @read_api
+    @in_memory_read_api
     def split_if_is_multiple_composite(self, f, val):
         '''
         If f is a composite column lookup key and the column is is_multiple then
@@ -2713,40 +3103,18 @@ def update_data_for_find_identical_books(self, book_id, data):
     def find_identical_books(self, mi, search_restriction='', book_ids=None):
         ''' Finds books that have a superset of the authors in mi and the same
         title (title is fuzzy matched). See also :meth:`data_for_find_identical_books`. '''
-        from calibre.db.utils import fuzzy_title
-        identical_book_ids = set()
         langq = tuple(x for x in map(canonicalize_lang, mi.languages or ()) if x and x != 'und')
-        if mi.authors:
-            try:
-                quathors = mi.authors[:20]  # Too many authors causes parsing of the search expression to fail
-                query = ' and '.join('authors:"={}"'.format(a.replace('"', '')) for a in quathors)
-                qauthors = mi.authors[20:]
-            except ValueError:
-                return identical_book_ids
+        if not mi.authors or mi.title is None:
+            return set()
+        with self.duplicate_index.lock:
+            identical_book_ids = self._up_to_date_duplicate_index().identical_books(mi.title, mi.authors, langq)
+        if identical_book_ids and (search_restriction or book_ids is not None):
             try:
-                book_ids = self._search(query, restriction=search_restriction, book_ids=book_ids)
+                identical_book_ids = set(self._search('', restriction=search_restriction, book_ids=identical_book_ids if book_ids is None else (
+                    identical_book_ids & set(book_ids))))
             except Exception:
                 traceback.print_exc()
-                return identical_book_ids
-            if qauthors and book_ids:
-                matches = set()
-                qauthors = {icu_lower(x) for x in qauthors}
-                for book_id in book_ids:
-                    aut = self._field_for('authors', book_id)
-                    if aut:
-                        aut = {icu_lower(x) for x in aut}
-                        if aut.issuperset(qauthors):
-                            matches.add(book_id)
-                book_ids = matches
-
-            for book_id in book_ids:
-                fbook_title = self._field_for('title', book_id)
-                fbook_title = fuzzy_title(fbook_title)
-                mbook_title = fuzzy_title(mi.title)
-                if fbook_title == mbook_title:
-                    bl = self._field_for('languages', book_id)
-                    if not langq or not bl or bl == langq:
-                        identical_book_ids.add(book_id)
+                return set()
         return identical_book_ids
 
     @read_api
@@ -2838,6 +3206,7 @@ def close(self):
                 return
             self.close_called = True
             self.shutting_down = True
+            self.snapshots.clear()
             self.event_dispatcher.close()
             self._shutdown_fts()
             try:
@@ -2953,7 +3322,7 @@ def restore_book(self, book_id, mi, last_modified, path, formats, annotations=()
         if annotations:
             self._restore_annotations(book_id, annotations)
 
-    @read_api
+    @in_memory_read_api
     def virtual_libraries_for_books(self, book_ids, virtual_fields=None):
         # use a primitive lock to ensure that only one thread is updating
         # the cache and that recursive calls don't do the update. This
@@ -2997,7 +3366,7 @@ def virtual_libraries_for_books(self, book_ids, virtual_fields=None):
             r[b] = self.vls_for_books_cache.get(b, default)
         return r
 
-    @read_api
+    @in_memory_read_api
     def user_categories_for_books(self, book_ids, proxy_metadata_map=None):
         ''' Return the user categories for the specified books.
         proxy_metadata_map is optional and is useful for a performance boost,
@@ -3108,7 +3477,7 @@ def get_last_read_positions(self, book_id, fmt, user):
             ans.append({'device':device, 'cfi': cfi, 'epoch':epoch, 'pos_frac':pos_frac})
         return ans
 
-    @write_api
+    @tracked_write_api
     def set_last_read_position(self, book_id, fmt, user='_', device='_', cfi=None, epoch=None, pos_frac=0):
         fmt = fmt.upper()
         device = device or '_'
@@ -3271,21 +3640,21 @@ def search_annotations(
             ignore_removed
         ))
 
-    @write_api
+    @tracked_write_api
     def delete_annotations(self, annot_ids):
         '''
         Delete annotations with the specified ids.
         '''
         self.backend.delete_annotations(annot_ids)
 
-    @write_api
+    @tracked_write_api
     def update_annotations(self, annot_id_map):
         '''
         Update annotations.
         '''
         self.backend.update_annotations(annot_id_map)
 
-    @write_api
+    @tracked_write_api
     def restore_annotations(self, book_id, annotations):
         from calibre.utils.date import EPOCH
         from calibre.utils.iso8601 import parse_iso8601
@@ -3298,14 +3667,14 @@ def restore_annotations(self, book_id, annotations):
         for (user_type, user, fmt), annots_list in iteritems(umap):
             self._set_annotations_for_book(book_id, fmt, annots_list, user_type=user_type, user=user)
 
-    @write_api
+    @tracked_write_api
     def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
         '''
         Set all annotations for the specified book_id, fmt, user_type and user.
         '''
         self.backend.set_annotations_for_book(book_id, fmt, annots_list, user_type, user)
 
-    @write_api
+    @tracked_write_api
     def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
         '''
         Merge the specified annotations into the existing annotations for book_id, fm, user_type, and user.
@@ -3321,6 +3690,24 @@ def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local
                 alist.append((annot, ts))
         self._set_annotations_for_book(book_id, fmt, alist, user_type=user_type, user=user)
 
+    @tracked_write_api
+    def sync_annotations(self, book_id, fmt, changes=(), since=0, user_type='local', user='viewer'):
+        '''
+        Incrementally synchronize the annotations for book_id, fmt, user_type and user
+        with a client. ``changes`` is the list of annotations changed by the
+        client since it last synced, removed annotations must be sent as
+        removal skeletons. Annotations are matched by uuid (title for
+        bookmarks) and the newer version of an annotation wins. ``since``
+        is the value returned by the previous sync or zero for a full sync.
+
+        Returns a pair ``(seq, annotations)`` where annotations is the list of
+        annotations changed on the server after ``since`` that the client does
+        not have and ``seq`` must be passed as ``since`` for the next sync.
+        The work done is proportional to the number of changes, not the number
+        of annotations.
+        '''
+        return self.backend.sync_annotations(book_id, fmt, user_type, user, changes, since)
+
     @write_api
     def save_annotations_list(self, book_id: int, book_fmt: str, sync_annots_user: str, alist: list[dict]) -> None:
         self.backend.save_annotations_list(book_id, book_fmt, sync_annots_user, alist)
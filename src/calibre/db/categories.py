@@ -8,7 +8,10 @@
 import copy
 from collections import OrderedDict
 from functools import partial
+from threading import Lock
 
+from calibre.db.fields import CategoryAggregate
+from calibre.db.lazy import BatchProxyMetadata
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.icu import collation_order, sort_key
@@ -90,6 +93,123 @@ def find_categories(field_metadata):
             yield (category, cat['is_multiple'].get('cache_to_list', None), True)
 
 
+def rating_field_for(category, fm):
+    ' The field whose values are used for the average rating of the items in category '
+    return category if fm[category]['datatype'] == 'rating' else 'rating'
+
+
+def rating_for(field, book_id):
+    return field.for_book(book_id, default_value=0) or 0
+
+
+class LazyBookValueMap:
+
+    ' The book_value_map of a field, which is only created if it is actually used '
+
+    __slots__ = ('field', 'value_map')
+
+    def __init__(self, field):
+        self.field, self.value_map = field, None
+
+    def get(self, book_id, default=None):
+        if self.value_map is None:
+            self.value_map = self.field.book_value_map
+        return self.value_map.get(book_id, default)
+
+
+class CategoryCache:
+
+    '''
+    The books and rating totals for the items of the Tag Browser categories,
+    for the last few sets of books that categories were requested for. It is
+    updated as books are changed, added and removed, so that changing a few
+    books does not require counting every item of every category again.
+
+    Categories that can change without going through
+    :meth:`calibre.db.cache.Cache.set_field`, such as formats, and composite
+    columns are not cached.
+    '''
+
+    def __init__(self, size=4):
+        self.size = size
+        self.lock = Lock()
+        # Map of book_ids (None for all books) to {category: {item_id: CategoryAggregate}}
+        self.scopes = OrderedDict()
+
+    @staticmethod
+    def is_cacheable(category, fm):
+        return category not in ('formats', 'news') and fm[category]['datatype'] != 'composite'
+
+    def aggregates(self, dbcache, category, book_ids, book_rating_map):
+        with self.lock:
+            scope = self.scopes.pop(book_ids, None)
+            if scope is None:
+                scope = {}
+            self.scopes[book_ids] = scope
+            while len(self.scopes) > self.size:
+                self.scopes.popitem(last=False)
+            ans = scope.get(category)
+            if ans is None:
+                ans = scope[category] = dbcache.fields[category].category_aggregates(book_rating_map, book_ids)
+            return ans
+
+    def state_for_books(self, dbcache, book_ids, fields=None):
+        '''
+        The items and ratings of book_ids in the cached categories that depend
+        on any of fields (all categories if None). Must be called before the
+        books are changed, and the result passed to :meth:`update` afterwards.
+        '''
+        with self.lock:
+            categories = {c for scope in self.scopes.values() for c in scope}
+        if not categories:
+            return None
+        fm, ans = dbcache.field_metadata, {}
+        for category in categories:
+            rf = rating_field_for(category, fm)
+            if fields is None or category in fields or rf in fields:
+                f, rf = dbcache.fields[category], dbcache.fields[rf]
+                ans[category] = {book_id: (tuple(f.ids_for_book(book_id)), rating_for(rf, book_id)) for book_id in book_ids}
+        return ans
+
+    def update(self, dbcache, state):
+        ' Update the cached categories for changes to books. state must come from :meth:`state_for_books` '
+        if not state:
+            return
+        fm = dbcache.field_metadata
+        with self.lock:
+            for category, old in state.items():
+                f, rf = dbcache.fields[category], dbcache.fields[rating_field_for(category, fm)]
+                new = {book_id: (f.ids_for_book(book_id), rating_for(rf, book_id)) for book_id in old}
+                for scope_book_ids, scope in self.scopes.items():
+                    aggregates = scope.get(category)
+                    if aggregates is None:
+                        continue
+                    for book_id, (old_items, old_rating) in old.items():
+                        if scope_book_ids is not None and book_id not in scope_book_ids:
+                            continue
+                        for item_id in old_items:
+                            agg = aggregates.get(item_id)
+                            if agg is not None:
+                                agg.discard(book_id, old_rating)
+                                if not agg.book_ids:
+                                    del aggregates[item_id]
+                        new_items, rating = new[book_id]
+                        for item_id in new_items:
+                            agg = aggregates.get(item_id)
+                            if agg is None:
+                                agg = aggregates[item_id] = CategoryAggregate()
+                            agg.add(book_id, rating)
+
+    def invalidate(self, categories=None):
+        with self.lock:
+            if categories is None:
+                self.scopes.clear()
+            else:
+                for scope in self.scopes.values():
+                    for category in categories:
+                        scope.pop(category, None)
+
+
 def create_tag_class(category, fm):
     cat = fm[category]
     dt = cat['datatype']
@@ -220,18 +340,17 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
 
     hierarchical_categories = frozenset(dbcache.pref('categories_using_hierarchy', ()))
     fm = dbcache.field_metadata
-    book_rating_map = dbcache.fields['rating'].book_value_map
-    lang_map = dbcache.fields['languages'].book_value_map
+    # Creating these maps is slow for large libraries and they are not needed
+    # if all categories are cached
+    book_rating_map = LazyBookValueMap(dbcache.fields['rating'])
+    lang_map = LazyBookValueMap(dbcache.fields['languages'])
 
     categories = OrderedDict()
-    book_ids = frozenset(book_ids) if book_ids else book_ids
-    pm_cache = {}
-
-    def get_metadata(book_id):
-        ans = pm_cache.get(book_id)
-        if ans is None:
-            ans = pm_cache[book_id] = dbcache._get_proxy_metadata(book_id)
-        return ans
+    book_ids = None if book_ids is None else frozenset(book_ids)
+    category_cache = dbcache.category_cache
+    # Shared by all composite categories, so that the metadata for a book is
+    # only read once
+    get_metadata = BatchProxyMetadata(dbcache)
 
     bids = None
     uncollapsed_categories = () if uncollapsed_categories is None else uncollapsed_categories
@@ -253,11 +372,14 @@ def get_metadata(book_id):
             dt = cat['datatype']
             if dt == 'rating':
                 if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
+                    brm = LazyBookValueMap(dbcache.fields[category])
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
+            aggregates = None
+            if CategoryCache.is_cacheable(category, fm):
+                aggregates = category_cache.aggregates(dbcache, category, book_ids, brm)
             cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
+                tag_class, brm, lang_map, book_ids, aggregates=aggregates)
             if (category != 'authors' and dt == 'text' and
                 cat['is_multiple'] and cat['display'].get('is_names', False)):
                 for item in cats:
@@ -8,8 +8,17 @@
 from optparse import OptionGroup, OptionValueError
 
 from calibre import prints
-from calibre.db.adding import cdb_find_in_dir, cdb_recursive_find, compile_rule, create_format_map, run_import_plugins, run_import_plugins_before_metadata
-from calibre.db.utils import find_identical_books
+from calibre.db.adding import (
+    BulkImporter,
+    cdb_find_in_dir,
+    cdb_recursive_find,
+    compile_rule,
+    cover_from_opf,
+    create_format_map,
+    journal_path_for_import,
+    run_import_plugins,
+    run_import_plugins_before_metadata,
+)
 from calibre.ebooks.metadata import MetaInformation, string_to_authors
 from calibre.ebooks.metadata.book.serialize import read_cover, serialize_cover
 from calibre.ebooks.metadata.meta import get_metadata, metadata_from_formats
@@ -31,18 +40,9 @@ def empty(db, notify_changes, is_remote, args):
     return ids, bool(duplicates)
 
 
-def cached_identical_book_data(db, request_id):
-    key = db.library_id, request_id
-    if getattr(cached_identical_book_data, 'key', None) != key:
-        cached_identical_book_data.key = key
-        cached_identical_book_data.ans = db.data_for_find_identical_books()
-    return cached_identical_book_data.ans
-
-
 def do_adding(db, request_id, notify_changes, is_remote, mi, format_map, add_duplicates, oautomerge):
     identical_book_list, added_ids, updated_ids = set(), set(), set()
     duplicates = []
-    identical_books_data = None
 
     def add_format(book_id, fmt):
         db.add_format(book_id, fmt, format_map[fmt], replace=True, run_hooks=False)
@@ -56,8 +56,7 @@ def add_book():
         duplicates.extend(duplicates_)
 
     if oautomerge != 'disabled' or not add_duplicates:
-        identical_books_data = cached_identical_book_data(db, request_id)
-        identical_book_list = find_identical_books(mi, identical_books_data)
+        identical_book_list = db.find_identical_books(mi)
 
     if oautomerge != 'disabled':
         if identical_book_list:
@@ -94,10 +93,6 @@ def add_book():
             duplicates.append((mi, format_map))
         else:
             add_book()
-    if added_ids and identical_books_data is not None:
-        for book_id in added_ids:
-            db.update_data_for_find_identical_books(book_id, identical_books_data)
-
     if is_remote:
         notify_changes(books_added(added_ids))
         if updated_ids:
@@ -244,24 +239,20 @@ def do_add(
             if dups:
                 file_duplicates.append((book_title, book))
 
-        dir_dups = []
+        dir_dups, dir_failures = [], []
         scanner = cdb_recursive_find if recurse else cdb_find_in_dir
         for dpath in dirs:
+            if recurse and not dbctx.is_remote and oautomerge == 'disabled':
+                # Use the much faster bulk import pipeline for local libraries
+                importer = BulkImporter(
+                    dbctx.db, journal_path=journal_path_for_import(dbctx.db, f'{dpath}\0{one_book_per_directory}'),
+                    add_duplicates=add_duplicates, added_ids=added_ids)
+                for mi, formats in importer(scanner(dpath, one_book_per_directory, compiled_rules)):
+                    dir_dups.append((mi.title, formats))
+                dir_failures.extend(importer.failures)
+                continue
             for formats in scanner(dpath, one_book_per_directory, compiled_rules):
-                cover_data = None
-                for fmt in formats:
-                    if fmt.lower().endswith('.opf'):
-                        with open(fmt, 'rb') as f:
-                            mi = get_metadata(f, stream_type='opf')
-                            if mi.cover_data and mi.cover_data[1]:
-                                cover_data = mi.cover_data[1]
-                            elif mi.cover:
-                                try:
-                                    with open(mi.cover, 'rb') as f:
-                                        cover_data = f.read()
-                                except OSError:
-                                    pass
-
+                cover_data = cover_from_opf(formats)
                 book_title, ids, mids, dups = dbctx.run(
                         'add', 'format_group', tuple(map(dbctx.path, formats)), add_duplicates, oautomerge, request_id, cover_data)
                 if book_title is not None:
@@ -272,6 +263,13 @@ def do_add(
 
         sys.stdout = sys.__stdout__
 
+        if dir_failures:
+            prints(_('The following books could not be added:'), file=sys.stderr)
+            for formats, details in dir_failures:
+                for path in formats:
+                    prints('   ', path, file=sys.stderr)
+                prints(details, file=sys.stderr)
+
         if dir_dups or file_duplicates:
             prints(
                 _(
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, Kovid Goyal <kovid at kovidgoyal.net>'
+
+from array import array
+from collections.abc import ItemsView, MutableMapping, ValuesView
+from itertools import compress
+
+MISSING, PRESENT, IS_NONE = 0, 1, 2
+PYTHON_TYPE_FOR_TYPECODE = {'q': int, 'd': float}
+
+
+class DenseItems(ItemsView):
+
+    __slots__ = ()
+
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class DenseValues(ValuesView):
+
+    __slots__ = ()
+
+    def __iter__(self):
+        return self._mapping.iter_values()
+
+
+class DenseBookMap(MutableMapping):
+    '''
+    A mapping of book_id -> value that stores its values in flat arrays indexed
+    by book_id. Book ids are small, mostly contiguous integers so this uses a
+    fraction of the memory of a dict with the same contents. When typecode is
+    specified values of exactly that type are stored unboxed in an
+    :class:`array.array`, storing a value of any other type transparently
+    switches to storing python objects. Keys that are not small non-negative
+    integers are stored in an ordinary dict.
+
+    Iteration is in ascending order of book_id rather than insertion order.
+    '''
+
+    __slots__ = ('count', 'data', 'sparse', 'state', 'typecode')
+
+    def __init__(self, items=(), typecode=None):
+        self.typecode = typecode
+        self.data = [] if typecode is None else array(typecode)
+        self.state = bytearray()
+        self.sparse = {}
+        self.count = 0
+        if items:
+            if not isinstance(items, (list, tuple)):
+                items = tuple(items.items() if hasattr(items, 'items') else items)
+            if items:
+                try:
+                    max_id = max(k for k, v in items)
+                except TypeError:
+                    max_id = 0
+                # Dont allocate space for a few outliers with very large ids
+                size = min(max_id + 1, 2 * len(items) + 4096)
+                if size > 0:
+                    self._grow(size)
+            for k, v in items:
+                self[k] = v
+
+    def _grow(self, size):
+        extra = size - len(self.state)
+        if extra > 0:
+            self.state.extend(bytes(extra))
+            if self.typecode is None:
+                self.data.extend((None,) * extra)
+            else:
+                self.data.frombytes(bytes(extra * self.data.itemsize))
+            # Lookups only use sparse for keys beyond the arrays, so keys
+            # that were too large for the arrays when set must be moved into them
+            for k in tuple(self.sparse):
+                if type(k) is int and 0 <= k < size:
+                    self[k] = self.sparse.pop(k)
+
+    def _demote(self):
+        ' Switch to storing python objects '
+        if self.typecode is not None:
+            self.data = self.data.tolist()
+            self.typecode = None
+
+    def __getitem__(self, book_id):
+        try:
+            if book_id < 0:
+                raise IndexError(book_id)
+            s = self.state[book_id]
+        except (IndexError, TypeError):
+            return self.sparse[book_id]
+        if s == PRESENT:
+            return self.data[book_id]
+        if s == IS_NONE:
+            return None
+        raise KeyError(book_id)
+
+    def get(self, book_id, default=None):
+        try:
+            if book_id < 0:
+                raise IndexError(book_id)
+            s = self.state[book_id]
+        except (IndexError, TypeError):
+            return self.sparse.get(book_id, default)
+        if s == PRESENT:
+            return self.data[book_id]
+        return None if s == IS_NONE else default
+
+    def __contains__(self, book_id):
+        try:
+            if book_id < 0:
+                raise IndexError(book_id)
+            return self.state[book_id] != MISSING
+        except (IndexError, TypeError):
+            return book_id in self.sparse
+
+    def __setitem__(self, book_id, val):
+        state = self.state
+        if type(book_id) is not int or book_id < 0 or book_id >= len(state) + max(4096, len(state)):
+            self.sparse[book_id] = val
+            return
+        if book_id >= len(state):
+            self._grow(max(book_id + 1, len(state) + len(state) // 4 + 16))
+        if state[book_id] == MISSING:
+            self.count += 1
+        if val is None:
+            state[book_id] = IS_NONE
+            if self.typecode is None:
+                self.data[book_id] = None
+            return
+        if self.typecode is not None and type(val) is not PYTHON_TYPE_FOR_TYPECODE[self.typecode]:
+            self._demote()
+        self.data[book_id] = val
+        state[book_id] = PRESENT
+
+    def __delitem__(self, book_id):
+        try:
+            if book_id < 0:
+                raise IndexError(book_id)
+            s = self.state[book_id]
+        except (IndexError, TypeError):
+            del self.sparse[book_id]
+            return
+        if s == MISSING:
+            raise KeyError(book_id)
+        self.state[book_id] = MISSING
+        if self.typecode is None:
+            self.data[book_id] = None
+        self.count -= 1
+
+    def pop(self, book_id, *default):
+        try:
+            ans = self[book_id]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[book_id]
+        return ans
+
+    def __len__(self):
+        return self.count + len(self.sparse)
+
+    def __iter__(self):
+        yield from compress(range(len(self.state)), self.state)
+        yield from tuple(self.sparse)
+
+    def iter_items(self):
+        data, state = self.data, self.state
+        for book_id in compress(range(len(state)), state):
+            yield book_id, (data[book_id] if state[book_id] == PRESENT else None)
+        yield from tuple(self.sparse.items())
+
+    def iter_values(self):
+        data, state = self.data, self.state
+        for book_id in compress(range(len(state)), state):
+            yield data[book_id] if state[book_id] == PRESENT else None
+        yield from tuple(self.sparse.values())
+
+    def items(self):
+        return DenseItems(self)
+
+    def values(self):
+        return DenseValues(self)
+
+    def update(self, other=(), **kwargs):
+        items = other.items() if hasattr(other, 'items') else other
+        for k, v in items:
+            self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def clear(self):
+        self.__init__(typecode=self.typecode)
+
+    def copy(self):
+        ' Return a copy as an ordinary dict, for use in other processes/threads '
+        return dict(self.iter_items())
+
+    def clone(self):
+        ' Return a copy that uses the same compact storage '
+        ans = self.__class__.__new__(self.__class__)
+        ans.typecode, ans.count = self.typecode, self.count
+        ans.data = self.data[:]
+        ans.state = bytearray(self.state)
+        ans.sparse = dict(self.sparse)
+        return ans
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.copy()!r})'
+
+
+def intern_values(pairs):
+    ' Share a single instance for identical values, for example, repeated strings in a column '
+    pool = {}
+    for k, v in pairs:
+        if type(v) is str:
+            v = pool.setdefault(v, v)
+        yield k, v
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, Kovid Goyal <kovid at kovidgoyal.net>'
+
+from collections import defaultdict
+from threading import Lock
+
+from calibre.utils.icu import lower as icu_lower
+
+
+class DuplicateIndex:
+    '''
+    Persistent index used to detect duplicate books, by :meth:`calibre.db.cache.Cache.has_book`,
+    :meth:`calibre.db.cache.Cache.find_identical_books` and friends. Books are
+    indexed by their lower cased title, their fuzzy title and their
+    identifiers, so checking a book for duplicates only needs to look at the
+    few books that share its title instead of every book in the library.
+
+    The index is built on first use. After that, books whose metadata changes
+    are invalidated and re-indexed lazily on the next query.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.is_built = False
+        self.keys = {}
+        self.stale = set()
+        self.title_map = defaultdict(set)
+        self.fuzzy_title_map = defaultdict(set)
+        self.identifier_map = defaultdict(set)
+
+    def invalidate(self, book_ids=None):
+        with self.lock:
+            if book_ids is None:
+                self.clear()
+            elif self.is_built:
+                self.stale.update(book_ids)
+
+    def remove(self, book_id):
+        k = self.keys.pop(book_id, None)
+        if k is not None:
+            title, fuzzy_title, authors, languages, identifiers = k
+            for m, key in ((self.title_map, title), (self.fuzzy_title_map, fuzzy_title)):
+                s = m[key]
+                s.discard(book_id)
+                if not s:
+                    del m[key]
+            for key in identifiers:
+                s = self.identifier_map[key]
+                s.discard(book_id)
+                if not s:
+                    del self.identifier_map[key]
+
+    def add(self, book_id, title, authors, languages, identifiers):
+        from calibre.db.utils import fuzzy_title
+        title = title or ''
+        k = self.keys[book_id] = (
+            icu_lower(title), fuzzy_title(title), frozenset(icu_lower(a) for a in authors or ()),
+            tuple(languages or ()), frozenset((icu_lower(t), v) for t, v in (identifiers or {}).items()))
+        self.title_map[k[0]].add(book_id)
+        self.fuzzy_title_map[k[1]].add(book_id)
+        for key in k[4]:
+            self.identifier_map[key].add(book_id)
+
+    def ensure(self, all_book_ids, data_for_books):
+        '''
+        Bring the index up to date. data_for_books(book_ids) must yield
+        (book_id, title, authors, languages, identifiers) for the specified
+        books. Must be called with self.lock held.
+        '''
+        if self.is_built:
+            if not self.stale:
+                return
+            book_ids, self.stale = self.stale, set()
+            for book_id in book_ids:
+                self.remove(book_id)
+            book_ids = tuple(book_id for book_id in book_ids if book_id in all_book_ids)
+        else:
+            book_ids = all_book_ids
+        try:
+            for x in data_for_books(book_ids):
+                self.add(*x)
+        except Exception:
+            # Do not leave a partially built index around
+            self.clear()
+            raise
+        self.is_built = True
+
+    def books_with_title(self, title):
+        ' Return the ids of books whose title is the same as title ignoring case '
+        return self.title_map.get(icu_lower(title), set())
+
+    def titles(self):
+        return set(self.title_map)
+
+    def books_with_identifier(self, typ, val):
+        return self.identifier_map.get((icu_lower(typ), val), set())
+
+    def identical_books(self, title, authors, languages):
+        '''
+        Return the ids of books that have the same fuzzy title as title, have
+        all the specified authors and, if both books specify languages, the
+        same languages.
+        '''
+        from calibre.db.utils import fuzzy_title
+        candidates = self.fuzzy_title_map.get(fuzzy_title(title or ''))
+        if not candidates or not authors:
+            return set()
+        authors = frozenset(icu_lower(a) for a in authors)
+        languages = tuple(languages or ())
+        ans = set()
+        for book_id in candidates:
+            title, ftitle, bauthors, blanguages, identifiers = self.keys[book_id]
+            if bauthors.issuperset(authors) and (not languages or not blanguages or blanguages == languages):
+                ans.add(book_id)
+        return ans
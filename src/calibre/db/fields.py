@@ -5,12 +5,14 @@
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import re
 import sys
 from collections import Counter, defaultdict
 from collections.abc import Iterable
 from functools import partial
 from threading import Lock
 
+from calibre.db.lazy import ProxyMetadata, field_dependencies
 from calibre.db.tables import MANY_MANY, MANY_ONE, ONE_ONE, null
 from calibre.db.utils import atof, force_to_bool
 from calibre.db.write import Writer
@@ -22,6 +24,7 @@
 from polyglot.builtins import iteritems
 
 rendering_composite_name = '__rendering_composite__'
+template_word_pat = re.compile(r'#?\w+')
 
 
 def bool_sort_key(bools_are_tristate):
@@ -51,6 +54,104 @@ def IDENTITY(x):
     return x
 
 
+def freeze(val):
+    ' Return a hashable version of val, a value read from ProxyMetadata '
+    if isinstance(val, (list, tuple)):
+        return tuple(map(freeze, val))
+    if isinstance(val, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in val.items()))
+    if isinstance(val, set):
+        return frozenset(val)
+    return val
+
+
+class TemplateState:
+
+    '''
+    What is known about the template of a composite column. names is the set
+    of the ProxyMetadata attributes the template has read so far, or None if
+    its result can depend on something else. memo maps the values of those
+    attributes to the result, so books with the same values share a result.
+    '''
+
+    __slots__ = ('deps', 'funcs', 'hits', 'key_names', 'memo', 'misses', 'names', 'template')
+
+    def __init__(self, template, funcs):
+        self.template, self.funcs = template, funcs
+        self.names = self.memo = None
+        self.key_names, self.deps = (), False
+        self.hits = self.misses = 0
+        if not template.startswith('python:'):
+            for word in template_word_pat.findall(template):
+                if not getattr(funcs.get(word), 'is_deterministic', True):
+                    break
+            else:
+                self.names, self.memo = set(), {}
+
+    def add_names(self, names):
+        self.names |= names
+        self.key_names = tuple(sorted(self.names))
+        self.deps = False
+        if self.memo is not None:
+            self.memo.clear()
+
+    def remember(self, key, val, limit=4096):
+        memo = self.memo
+        self.misses += 1
+        if self.misses >= 1024 and self.hits * 16 < self.misses:
+            # Nearly every book has different values, do not waste memory
+            self.memo = None
+            return
+        if len(memo) >= limit:
+            memo.clear()
+        memo[key] = val
+
+
+class CategoryAggregate:
+
+    ' The books that use an item in a Tag Browser category and the total of their ratings '
+
+    __slots__ = ('book_ids', 'frozen', 'rating_count', 'rating_sum')
+
+    def __init__(self, book_ids=None, book_rating_map=None):
+        self.book_ids = set() if book_ids is None else book_ids
+        self.frozen = None
+        self.rating_sum = self.rating_count = 0
+        if book_rating_map is not None:
+            for book_id in self.book_ids:
+                r = book_rating_map.get(book_id, 0)
+                if r > 0:
+                    self.rating_sum += r
+                    self.rating_count += 1
+
+    @property
+    def avg_rating(self):
+        return self.rating_sum / self.rating_count if self.rating_count else 0
+
+    @property
+    def frozen_book_ids(self):
+        ' An immutable copy of book_ids, shared by all users of this aggregate until the books change '
+        if self.frozen is None:
+            self.frozen = frozenset(self.book_ids)
+        return self.frozen
+
+    def add(self, book_id, rating):
+        if book_id not in self.book_ids:
+            self.book_ids.add(book_id)
+            self.frozen = None
+            if rating > 0:
+                self.rating_sum += rating
+                self.rating_count += 1
+
+    def discard(self, book_id, rating):
+        if book_id in self.book_ids:
+            self.book_ids.discard(book_id)
+            self.frozen = None
+            if rating > 0:
+                self.rating_sum -= rating
+                self.rating_count -= 1
+
+
 class InvalidLinkTable(Exception):
 
     def __init__(self, name):
@@ -128,6 +229,21 @@ def for_book(self, book_id, default_value=None):
         '''
         raise NotImplementedError()
 
+    def column_for_books(self, book_ids, default_value=None):
+        '''
+        Return a list of the values of this field for the books identified by
+        book_ids, in the same order. ``default_value`` is used for books that
+        have no value.
+        '''
+        fb = self.for_book
+        ans = []
+        for book_id in book_ids:
+            try:
+                ans.append(fb(book_id, default_value))
+            except (KeyError, IndexError):
+                ans.append(default_value)
+        return ans
+
     def ids_for_book(self, book_id):
         '''
         Return a tuple of items ids for items associated with the book
@@ -169,32 +285,52 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         '''
         raise NotImplementedError()
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def category_aggregates(self, book_rating_map, book_ids=None):
+        '''
+        Return a dict mapping the id of every item used by at least one of
+        book_ids (all books if None) to a :class:`CategoryAggregate`.
+        '''
+        ans = {}
+        if not self.is_many:
+            return ans
+        for item_id, item_book_ids in iteritems(self.table.col_book_map):
+            item_book_ids = set(item_book_ids) if book_ids is None else item_book_ids.intersection(book_ids)
+            if item_book_ids:
+                ans[item_id] = CategoryAggregate(item_book_ids, book_rating_map)
+        return ans
+
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, aggregates=None):
+        '''
+        Return the Tag Browser items for this field. If aggregates, as
+        returned by :meth:`category_aggregates`, is specified, it is used
+        instead of counting the books and ratings for every item.
+        '''
         ans = []
         if not self.is_many:
             return ans
 
         id_map = self.table.id_map
         special_sort = hasattr(self, 'category_sort_value')
-        for item_id, item_book_ids in iteritems(self.table.col_book_map):
-            if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
-            if item_book_ids:
-                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
-                                            book_id in item_book_ids) if r > 0)
-                avg = sum(ratings)/len(ratings) if ratings else 0
-                try:
-                    name = self.category_formatter(id_map[item_id])
-                except KeyError:
-                    # db has entries in the link table without entries in the
-                    # id table, for example, see
-                    # https://bugs.launchpad.net/bugs/1218783
-                    raise InvalidLinkTable(self.name)
-                sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
-                    if special_sort else name)
-                c = tag_class(name, id=item_id, sort=sval, avg=avg,
-                              id_set=item_book_ids, count=len(item_book_ids))
-                ans.append(c)
+        if aggregates is None:
+            aggregates, cached = self.category_aggregates(book_rating_map, book_ids), False
+        else:
+            # The aggregates are cached and so must not be changed by the users of
+            # the tags, give them immutable sets, shared between calls
+            cached = True
+        for item_id, agg in iteritems(aggregates):
+            item_book_ids = agg.frozen_book_ids if cached else agg.book_ids
+            try:
+                name = self.category_formatter(id_map[item_id])
+            except KeyError:
+                # db has entries in the link table without entries in the
+                # id table, for example, see
+                # https://bugs.launchpad.net/bugs/1218783
+                raise InvalidLinkTable(self.name)
+            sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
+                if special_sort else name)
+            c = tag_class(name, id=item_id, sort=sval, avg=agg.avg_rating,
+                          id_set=item_book_ids, count=len(item_book_ids))
+            ans.append(c)
         return ans
 
 
@@ -203,6 +339,10 @@ class OneToOneField(Field):
     def for_book(self, book_id, default_value=None):
         return self.table.book_col_map.get(book_id, default_value)
 
+    def column_for_books(self, book_ids, default_value=None):
+        bcmg = self.table.book_col_map.get
+        return [bcmg(book_id, default_value) for book_id in book_ids]
+
     def ids_for_book(self, book_id):
         return (book_id,)
 
@@ -243,6 +383,8 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
 
         self._render_cache = {}
         self._lock = Lock()
+        self._template_fields = None, frozenset()
+        self._template_state = None
         m = self.metadata
         self._composite_name = '#' + m['label']
         try:
@@ -298,16 +440,59 @@ def bool_sort_key(self, val):
 
     def __render_composite(self, book_id, mi, formatter, template_cache):
         ' INTERNAL USE ONLY. DO NOT USE THIS OUTSIDE THIS CLASS! '
-        db = self.db_weakref()
-        ans = formatter.safe_format(
-            self.metadata['display']['composite_template'], mi, _('TEMPLATE ERROR'),
-            mi, column_name=self._composite_name, template_cache=template_cache,
-            template_functions=self.get_template_functions(),
-            global_vars={rendering_composite_name:'1'}, database=db).strip()
+        template = self.metadata['display']['composite_template']
+        funcs = self.get_template_functions()
         with self._lock:
+            st = self._template_state
+            if st is None or st.template != template or st.funcs is not funcs:
+                st = self._template_state = TemplateState(template, funcs)
+            if st.names is not None and not isinstance(mi, ProxyMetadata):
+                # Cannot find out which fields are read from other kinds of
+                # Metadata objects
+                st.names = st.memo = None
+            tracked, names, memo = st.names is not None, st.key_names, st.memo
+        if not tracked:
+            ans = self.__format(template, mi, formatter, template_cache, funcs)
+            with self._lock:
+                self._render_cache[book_id] = ans
+            return ans
+
+        accessed, key = set(), None
+        outer = mi.track_access(accessed)
+        try:
+            if memo is not None:
+                try:
+                    key = tuple(freeze(getattr(mi, name)) for name in names)
+                    hash(key)
+                except Exception:
+                    key = None
+                else:
+                    with self._lock:
+                        ans = memo.get(key)
+                        if ans is not None:
+                            st.hits += 1
+                            self._render_cache[book_id] = ans
+                            return ans
+            ans = self.__format(template, mi, formatter, template_cache, funcs)
+        finally:
+            mi.track_access(outer)
+        with self._lock:
+            if st is self._template_state and st.names is not None:
+                if not accessed.issubset(st.names):
+                    st.add_names(accessed)
+                elif key is not None and st.memo is memo and names is st.key_names:
+                    st.remember(key, ans)
             self._render_cache[book_id] = ans
         return ans
 
+    def __format(self, template, mi, formatter, template_cache, funcs):
+        ' INTERNAL USE ONLY. DO NOT USE THIS OUTSIDE THIS CLASS! '
+        return formatter.safe_format(
+            template, mi, _('TEMPLATE ERROR'),
+            mi, column_name=self._composite_name, template_cache=template_cache,
+            template_functions=funcs,
+            global_vars={rendering_composite_name:'1'}, database=self.db_weakref()).strip()
+
     def _render_composite_with_cache(self, book_id, mi, formatter, template_cache):
         ''' INTERNAL USE ONLY. DO NOT USE METHOD DIRECTLY. INSTEAD USE
          db.composite_for() OR mi.get(). Those methods make sure there is no
@@ -323,10 +508,29 @@ def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
                 self._render_cache.clear()
+                self._template_state = None
             else:
+                # The memo does not need to be cleared, as it is keyed by
+                # the values that were read
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
 
+    def dependencies(self, field_metadata):
+        '''
+        The names of the fields, including other composite columns, that the
+        values in the render cache were calculated from, or None if they can
+        depend on something else, such as the current date.
+        '''
+        with self._lock:
+            st = self._template_state
+            if st is None:
+                return frozenset()
+            if st.names is None:
+                return None
+            if st.deps is False:
+                st.deps = field_dependencies(st.names, field_metadata)
+            return st.deps
+
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
             ans = self._render_cache.get(book_id, None)
@@ -335,6 +539,41 @@ def get_value_with_cache(self, book_id, get_metadata):
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
         return ans
 
+    @property
+    def template_fields(self):
+        ''' The names that could refer to fields in the template of this
+        column. Used to read the values of those fields for many books at once,
+        so it does not matter if it contains names that are not fields. '''
+        template = self.metadata['display'].get('composite_template') or ''
+        ans = self._template_fields
+        if ans[0] != template:
+            ans = self._template_fields = template, frozenset(template_word_pat.findall(template))
+        return ans[1]
+
+    def render_for_books(self, book_ids, get_metadata):
+        '''
+        Return a dict mapping each of book_ids to the value of this column. If
+        get_metadata has a prefetch() method, it is used to read the values of
+        the fields used by the template for all books that are not in the
+        render cache at once, instead of one book at a time.
+        '''
+        with self._lock:
+            rcg = self._render_cache.get
+            ans = {book_id: rcg(book_id) for book_id in book_ids}
+        missing = [book_id for book_id, val in iteritems(ans) if val is None]
+        if missing:
+            prefetch = getattr(get_metadata, 'prefetch', None)
+            if prefetch is not None and len(missing) > 1:
+                prefetch(missing, self.template_fields)
+            for book_id in missing:
+                mi = get_metadata(book_id)
+                ans[book_id] = self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
+        return ans
+
+    def column_for_books(self, book_ids, default_value=None, get_metadata=None):
+        vals = self.render_for_books(book_ids, get_metadata)
+        return [vals[book_id] for book_id in book_ids]
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         gv = self.get_value_with_cache
         sk = self._sort_key
@@ -345,8 +584,7 @@ def sort_keys_for_books(self, get_metadata, lang_map):
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         val_map = defaultdict(set)
         splitter = self.splitter
-        for book_id in candidates:
-            vals = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, vals in iteritems(self.render_for_books(candidates, get_metadata)):
             vals = (vv.strip() for vv in vals.split(splitter)) if splitter else (vals,)
             found = False
             for v in vals:
@@ -363,8 +601,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
     def iter_counts(self, candidates, get_metadata=None):
         val_map = defaultdict(set)
         splitter = self.splitter
-        for book_id in candidates:
-            vals = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, vals in iteritems(self.render_for_books(candidates, get_metadata)):
             if splitter:
                 length = len([vv.strip() for vv in vals.split(splitter) if vv.strip()])
             elif vals.strip():
@@ -378,8 +615,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
                                  is_multiple, get_metadata):
         ans = []
         id_map = defaultdict(set)
-        for book_id in book_ids:
-            val = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, val in iteritems(self.render_for_books(book_ids, get_metadata)):
             vals = [x.strip() for x in val.split(is_multiple)] if is_multiple else [val]
             for val in vals:
                 if val:
@@ -396,8 +632,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
     def get_books_for_val(self, value, get_metadata, book_ids):
         is_multiple = self.table.metadata['is_multiple'].get('cache_to_list', None)
         ans = set()
-        for book_id in book_ids:
-            val = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, val in iteritems(self.render_for_books(book_ids, get_metadata)):
             vals = {x.strip() for x in val.split(is_multiple)} if is_multiple else [val]
             if value in vals:
                 ans.add(book_id)
@@ -456,6 +691,8 @@ def for_book(self, book_id, default_value=None):
                 loc.append(_('Card B'))
         return ', '.join(loc) + ((f' ({count} books)') if count > 1 else '')
 
+    column_for_books = Field.column_for_books
+
     def __iter__(self):
         return iter(())
 
@@ -502,6 +739,14 @@ def for_book(self, book_id, default_value=None):
             ans = default_value
         return ans
 
+    def column_for_books(self, book_ids, default_value=None):
+        bcmg, id_map = self.table.book_col_map.get, self.table.id_map
+        ans = []
+        for book_id in book_ids:
+            item_id = bcmg(book_id)
+            ans.append(default_value if item_id is None else id_map[item_id])
+        return ans
+
     def ids_for_book(self, book_id):
         id_ = self.table.book_col_map.get(book_id, None)
         if id_ is None:
@@ -562,6 +807,18 @@ def for_book(self, book_id, default_value=None):
             ans = default_value
         return ans
 
+    def column_for_books(self, book_ids, default_value=None):
+        bcmg, id_map, sort_alpha = self.table.book_col_map.get, self.table.id_map, self.table.sort_alpha
+        ans = []
+        for book_id in book_ids:
+            ids = bcmg(book_id)
+            if ids:
+                vals = tuple(id_map[i] for i in ids)
+                ans.append(tuple(sorted(vals, key=sort_key)) if sort_alpha else vals)
+            else:
+                ans.append(default_value)
+        return ans
+
     def ids_for_book(self, book_id):
         return self.table.book_col_map.get(book_id, ())
 
@@ -620,6 +877,8 @@ def for_book(self, book_id, default_value=None):
                 ids = default_value
         return ids
 
+    column_for_books = Field.column_for_books
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         'Sort by identifier keys'
         bcmg = self.table.book_col_map.get
@@ -633,9 +892,13 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=()):
             if val:
                 yield val, {book_id}
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, aggregates=None):
         ans = []
 
+        if aggregates is not None:
+            for id_key, agg in iteritems(aggregates):
+                ans.append(tag_class(id_key, id_set=agg.frozen_book_ids, count=len(agg.book_ids)))
+            return ans
         for id_key, item_book_ids in iteritems(self.table.col_book_map):
             if book_ids is not None:
                 item_book_ids = item_book_ids.intersection(book_ids)
@@ -670,6 +933,8 @@ class FormatsField(ManyToManyField):
     def for_book(self, book_id, default_value=None):
         return self.table.book_col_map.get(book_id, default_value)
 
+    column_for_books = Field.column_for_books
+
     def format_fname(self, book_id, fmt):
         return self.table.fname_map[book_id][fmt.upper()]
 
@@ -687,7 +952,9 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         for val, book_ids in iteritems(val_map):
             yield val, book_ids
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, aggregates=None):
+        # Formats change without going through set_field(), so they are
+        # always counted and aggregates is ignored
         ans = []
 
         for fmt, item_book_ids in iteritems(self.table.col_book_map):
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, Kovid Goyal <kovid at kovidgoyal.net>'
+
+
+class MetadataFrame:
+
+    '''
+    The values of some fields for some books, stored as one column per field.
+    Created by :meth:`calibre.db.cache.Cache.metadata_frame`. Columns are
+    tuples in the same order as :attr:`book_ids`. Use :meth:`column_map` or
+    :meth:`row` to get the values for a particular book.
+    '''
+
+    __slots__ = ('_row_map', 'book_ids', 'columns')
+
+    def __init__(self, book_ids, columns):
+        self.book_ids = book_ids
+        self.columns = columns
+        self._row_map = None
+
+    @property
+    def fields(self):
+        return tuple(self.columns)
+
+    def __len__(self):
+        return len(self.book_ids)
+
+    def __iter__(self):
+        return iter(self.book_ids)
+
+    def __contains__(self, book_id):
+        return book_id in self.row_map
+
+    def __getitem__(self, field):
+        ' The column of values for field '
+        return self.columns[field]
+
+    @property
+    def row_map(self):
+        ' Map of book_id to the index of its row '
+        if self._row_map is None:
+            self._row_map = {book_id: i for i, book_id in enumerate(self.book_ids)}
+        return self._row_map
+
+    def column_map(self, field):
+        ' Map of book_id to the value of field for that book '
+        return dict(zip(self.book_ids, self.columns[field]))
+
+    def row(self, book_id):
+        ' Map of field name to the value of that field for book_id '
+        i = self.row_map[book_id]
+        return {field: column[i] for field, column in self.columns.items()}
+
+    def value(self, field, book_id):
+        return self.columns[field][self.row_map[book_id]]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(books={len(self.book_ids)}, fields={self.fields!r})'
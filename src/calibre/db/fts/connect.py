@@ -4,16 +4,19 @@
 
 import builtins
 import hashlib
+import json
 import os
+import re
 import sys
+from collections.abc import Set
 from contextlib import suppress
-from itertools import count
 from threading import Lock
 
 import apsw
 
 from calibre.db import FTSQueryError
 from calibre.db.annotations import unicode_normalize
+from calibre.db.bitmap import Bitmap
 from calibre.utils.date import EPOCH, utcnow
 
 from .pool import Pool
@@ -25,13 +28,22 @@ def print(*args, **kwargs):
     builtins.print(*args, **kwargs)
 
 
+def text_hash_for(text):
+    # Differences only in whitespace, common between the text extracted from
+    # different formats of the same book, are ignored
+    return hashlib.sha1(re.sub(r'\s+', ' ', text).strip().encode('utf-8')).hexdigest()
+
+
 class FTS:
 
+    # Restrictions to more than these many books are applied to the results
+    # of the query rather than in the query
+    max_restriction_in_query = 4096
+
     def __init__(self, dbref):
         self.dbref = dbref
         self.pool = Pool(dbref)
         self.init_lock = Lock()
-        self.temp_table_counter = count()
 
     def initialize(self, conn):
         needs_dirty = False
@@ -102,6 +114,8 @@ def add_text(self, book_id, fmt, text, text_hash='', fmt_size=0, fmt_hash='', er
         conn = self.get_connection()
         ts = (utcnow() - EPOCH).total_seconds()
         fmt = fmt.upper()
+        if err_msg or text:
+            self.move_shared_text(conn, book_id, fmt)
         if err_msg:
             conn.execute(
                 'INSERT OR REPLACE INTO fts_db.books_text '
@@ -109,14 +123,39 @@ def add_text(self, book_id, fmt, text, text_hash='', fmt_size=0, fmt_hash='', er
                 '(?, ?, ?, ?, ?, ?)', (
                     book_id, ts, fmt, fmt_size, fmt_hash, err_msg))
         elif text:
+            text_size = len(text)
+            if text_hash:
+                for x in conn.get(
+                    "SELECT id FROM fts_db.books_text WHERE text_hash=? AND searchable_text != '' AND NOT (book=? AND format=?) LIMIT 1",
+                    (text_hash, book_id, fmt)
+                ):
+                    text = ''  # the same text is already indexed for another format, refer to it
             conn.execute(
                 'INSERT OR REPLACE INTO fts_db.books_text '
                 '(book, timestamp, format, format_size, format_hash, searchable_text, text_size, text_hash) VALUES '
                 '(?, ?, ?, ?, ?, ?, ?, ?)', (
-                    book_id, ts, fmt, fmt_size, fmt_hash, text, len(text), text_hash))
+                    book_id, ts, fmt, fmt_size, fmt_hash, text, text_size, text_hash))
         else:
             conn.execute('DELETE FROM fts_db.dirtied_formats WHERE book=? AND format=?', (book_id, fmt))
 
+    def move_shared_text(self, conn, book_id, fmt):
+        # The row for book_id, fmt is about to be replaced. INSERT OR REPLACE
+        # does not run delete triggers so if other formats refer to its text,
+        # move the text to one of them here.
+        conn.execute('''
+            UPDATE fts_db.books_text SET searchable_text=(SELECT searchable_text FROM fts_db.books_text WHERE book=? AND format=?) WHERE id=(
+                SELECT dup.id FROM fts_db.books_text AS src JOIN fts_db.books_text AS dup ON dup.text_hash = src.text_hash
+                WHERE src.book=? AND src.format=? AND src.text_hash != '' AND src.searchable_text != '' AND dup.id != src.id AND dup.searchable_text=''
+                LIMIT 1)''', (book_id, fmt, book_id, fmt))
+
+    def indexed_formats(self, book_id):
+        conn = self.get_connection()
+        return {x[0] for x in conn.execute("SELECT format FROM fts_db.books_text WHERE book=? AND err_msg='' AND text_hash != ''", (book_id,))}
+
+    def dirtied_formats(self, book_id):
+        conn = self.get_connection()
+        return {x[0] for x in conn.execute('SELECT format FROM fts_db.dirtied_formats WHERE book=? AND in_progress=FALSE', (book_id,))}
+
     def get_next_fts_job(self):
         conn = self.get_connection()
         for book_id, fmt in conn.get('SELECT book,format FROM fts_db.dirtied_formats WHERE in_progress=FALSE ORDER BY id'):
@@ -127,38 +166,74 @@ def commit_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg=''):
         conn = self.get_connection()
         text_hash = ''
         if text:
-            text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            text_hash = text_hash_for(text)
             for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND text_hash=?', (book_id, fmt, text_hash)):
                 text = ''
                 break
         self.add_text(book_id, fmt, text, text_hash, fmt_size, fmt_hash, err_msg)
 
-    def queue_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
+    def commit_results(self, results):
+        ''' Commit many results, each a tuple of the arguments to
+        :meth:`commit_result`, in a single transaction. FTS5 buffers the
+        index updates for the whole transaction in memory, so this is much
+        faster than committing them one by one. '''
+        conn = self.get_connection()
+        with conn:
+            for result in results:
+                self.commit_result(*result)
+
+    def merge_segments(self, pages=256):
+        ''' Do one step of merging the b-tree segments of the full text
+        indices. Automatic merging is turned off, as otherwise it happens
+        during every commit, see :meth:`calibre.db.fts.pool.Pool.merge_segments`.
+        Returns True if there is more merging to be done. '''
+        conn = self.get_connection()
+        more = False
+        for table in ('books_fts', 'books_fts_stemmed'):
+            before = conn.totalchanges()
+            conn.execute(f"INSERT INTO fts_db.{table}({table}, rank) VALUES('merge', ?)", (pages,))
+            if conn.totalchanges() - before > 1:
+                more = True
+        return more
+
+    def queue_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time, signature=None):
         conn = self.get_connection()
         fmt = fmt.upper()
         for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND format_size=? AND format_hash=?', (
                 book_id, fmt, fmt_size, fmt_hash)):
             break
         else:
-            self.pool.add_job(book_id, fmt, path, fmt_size, fmt_hash, start_time)
+            self.pool.add_job(book_id, fmt, path, fmt_size, fmt_hash, start_time, signature)
             conn.execute('UPDATE fts_db.dirtied_formats SET in_progress=TRUE WHERE book=? AND format=?', (book_id, fmt))
             return True
         self.remove_dirty(book_id, fmt)
-        with suppress(OSError):
-            os.remove(path)
+        if signature is None:
+            with suppress(OSError):
+                os.remove(path)
         return False
 
+    def requeue_job(self, book_id, fmt):
+        conn = self.get_connection()
+        conn.execute('UPDATE fts_db.dirtied_formats SET in_progress=FALSE WHERE book=? AND format=?', (book_id, fmt.upper()))
+
     def search(self,
         fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids,
-        return_text=True, process_each_result=None
+        return_text=True, process_each_result=None, limit=None, offset=0
     ):
-        if restrict_to_book_ids is not None and not restrict_to_book_ids:
+        if (restrict_to_book_ids is not None and not restrict_to_book_ids) or (limit is not None and limit < 1):
             return
         fts_engine_query = unicode_normalize(fts_engine_query)
         fts_table = 'books_fts' + ('_stemmed' if use_stemming else '')
-        data = []
+        conn = self.get_connection()
+        # Small restrictions are passed to SQLite as a single JSON array,
+        # large ones are applied to the matches instead, as building a lookup
+        # table for them would cost more than the MATCH itself
+        post_filter = None
+        if restrict_to_book_ids and len(restrict_to_book_ids) > self.max_restriction_in_query:
+            post_filter = restrict_to_book_ids if isinstance(restrict_to_book_ids, Set) else Bitmap(restrict_to_book_ids)
+        text, data = '', []
         if return_text:
-            text = 'books_text.searchable_text'
+            text = 'src.searchable_text'
             if highlight_start is not None and highlight_end is not None:
                 if snippet_size is not None:
                     text = f'''snippet("{fts_table}", 0, ?, ?, '…', {max(1, min(snippet_size, 64))})'''
@@ -166,36 +241,56 @@ def search(self,
                     text = f'''highlight("{fts_table}", 0, ?, ?)'''
                 data.append(highlight_start)
                 data.append(highlight_end)
-            text = ', ' + text
-        else:
-            text = ''
-        query = 'SELECT {0}.id, {0}.book, {0}.format {1} FROM {0} '.format('books_text', text)
-        query += f' JOIN {fts_table} ON fts_db.books_text.id = {fts_table}.rowid'
+        # src is the row whose text matched, each match is reported for src
+        # and for all formats that share its text
+        match_join = f' FROM fts_db.books_text AS src JOIN {fts_table} ON src.id = {fts_table}.rowid'
+        text_query = None
+        if text and post_filter is not None:
+            # Most matches may be filtered out, so only select the matching
+            # row here and compute the text for the matches that are kept
+            text_query = f'SELECT {text}{match_join} WHERE src.id = ? AND "{fts_table}" MATCH ?'
+            text_data = tuple(data)
+            text, data = 'src.id', []
+        query = 'SELECT books_text.id, books_text.book, books_text.format' + (', ' + text if text else '') + match_join
+        query += (
+            " JOIN fts_db.books_text AS books_text ON books_text.id = src.id OR"
+            " (src.text_hash != '' AND books_text.text_hash = src.text_hash AND books_text.searchable_text = '')")
         query += ' WHERE '
-        conn = self.get_connection()
-        temp_table_name = ''
-        if restrict_to_book_ids:
-            temp_table_name = f'fts_restrict_search_{next(self.temp_table_counter)}'
-            conn.execute(f'CREATE TABLE temp.{temp_table_name}(x INTEGER)')
-            conn.executemany(f'INSERT INTO temp.{temp_table_name} VALUES (?)', tuple((x,) for x in restrict_to_book_ids))
-            query += f' fts_db.books_text.book IN temp.{temp_table_name} AND '
+        if restrict_to_book_ids and post_filter is None:
+            query += ' books_text.book IN (SELECT value FROM json_each(?)) AND '
+            data.append(json.dumps(list(restrict_to_book_ids)))
         query += f' "{fts_table}" MATCH ?'
         data.append(fts_engine_query)
         query += f' ORDER BY {fts_table}.rank '
-        if temp_table_name:
-            query += f'; DROP TABLE temp.{temp_table_name}'
+        if post_filter is None and (limit is not None or offset):
+            query += ' LIMIT ? OFFSET ?'
+            data.extend((-1 if limit is None else limit, offset))
+            offset, limit = 0, None
         try:
             for record in conn.execute(query, tuple(data)):
+                if post_filter is not None and record[1] not in post_filter:
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                if limit is not None:
+                    limit -= 1
+                if not return_text:
+                    text = ''
+                elif text_query is None:
+                    text = record[3]
+                else:
+                    text = next(conn.execute(text_query, text_data + (record[3], fts_engine_query)))[0]
                 result = {
                     'id': record[0],
                     'book_id': record[1],
                     'format': record[2],
-                    'text': record[3] if return_text else '',
+                    'text': text,
                 }
                 if process_each_result is not None:
                     result = process_each_result(result)
                 ret = yield result
-                if ret is True:
+                if ret is True or limit == 0:
                     break
         except apsw.SQLError as e:
             raise FTSQueryError(fts_engine_query, query, e) from e
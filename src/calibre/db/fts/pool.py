@@ -2,58 +2,150 @@
 # License: GPL v3 Copyright: 2022, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import json
 import os
 import subprocess
 import sys
 import traceback
-from contextlib import suppress
-from queue import Queue
+from collections import deque
+from contextlib import contextmanager, suppress
+from queue import Empty, Queue
 from threading import Event, Thread
 from time import monotonic
 
 from calibre import detect_ncpus, human_readable
+from calibre.ptempfile import PersistentTemporaryFile
 from calibre.utils.ipc.simple_worker import start_pipe_worker
 
 check_for_work = object()
 quit = object()
 
 
+def file_signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
 class Job:
 
-    def __init__(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
+    def __init__(self, book_id, fmt, path, fmt_size, fmt_hash, start_time, signature=None):
         self.book_id = book_id
         self.fmt = fmt
         self.fmt_size = fmt_size
         self.fmt_hash = fmt_hash
         self.path = path
         self.start_time = start_time
+        # When path is the format file in the library, read in place, this is
+        # its signature when it was hashed. When it is None, path is a
+        # temporary copy of the format file owned by this job.
+        self.signature = signature
+
+    @property
+    def is_in_place(self):
+        return self.signature is not None
+
+    @property
+    def has_changed(self):
+        try:
+            return file_signature(self.path) != self.signature
+        except OSError:
+            return True
 
 
 class Result:
 
-    def __init__(self, job, err_msg=''):
+    def __init__(self, job, err_msg='', text=''):
         self.book_id = job.book_id
         self.fmt = job.fmt
         self.fmt_size = job.fmt_size
         self.fmt_hash = job.fmt_hash
         self.ok = not bool(err_msg)
         self.start_time = job.start_time
-        if self.ok:
-            with open(job.path + '.txt', 'rb') as src:
-                try:
-                    self.text = src.read().decode('utf-8', 'replace')
-                except Exception:
-                    self.ok = False
-                    self.text = traceback.format_exc()
-        else:
-            self.text = err_msg
+        self.text = text if self.ok else err_msg
+        # Set when the format file changed while it was being read, so the
+        # result must be discarded and the format indexed again
+        self.requeue = False
+
+
+class Extractor:
+
+    ''' A worker process that stays running and extracts the text from many
+    files, one after the other. See :func:`calibre.db.fts.text.serve` '''
+
+    def __init__(self, code_to_exec):
+        self.process = start_pipe_worker(
+            code_to_exec,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.PIPE, priority='low',
+        )
+        self.responses = Queue()
+        self.reader_thread = Thread(name='FTSExtractorReader', daemon=True, target=self.read_responses, args=(self.process.stdout, self.responses))
+        self.reader_thread.start()
+        self.recycle = False
+
+    @staticmethod
+    def read_responses(stdout, responses):
+        with suppress(Exception):
+            for line in stdout:
+                msg = json.loads(line)
+                if 'text' in msg:
+                    msg['text'] = stdout.read(msg['text']).decode('utf-8', 'replace')
+                responses.put(msg)
+        responses.put(None)
+
+    @property
+    def is_alive(self):
+        return not self.recycle and self.process.poll() is None
+
+    def send(self, path, error_path):
+        self.process.stdin.write(json.dumps({'path': path, 'error_path': error_path}).encode('utf-8') + b'\n')
+        self.process.stdin.flush()
+
+    def response(self, timeout):
+        ''' Return the next chunk of text or the status for the last path
+        sent, None if the process died or raise Empty if there is no response
+        within timeout seconds '''
+        ans = self.responses.get(timeout=timeout)
+        if ans is not None and ans.get('recycle'):
+            self.recycle = True
+        return ans
+
+    def shutdown(self, timeout=1):
+        with suppress(OSError):
+            self.process.stdin.close()
+        with suppress(subprocess.TimeoutExpired):
+            self.process.wait(timeout)
+        if self.process.returncode is None:
+            self.kill()
+        with suppress(OSError):
+            self.process.stdout.close()
+
+    def kill(self):
+        with suppress(OSError):
+            self.process.kill()
+        with suppress(subprocess.TimeoutExpired):
+            self.process.wait(1)
+
+
+def read_error(path):
+    with suppress(OSError), open(path, 'rb') as f:
+        return f.read().decode('utf-8', 'replace')
+    return ''
 
 
 class Worker(Thread):
 
-    code_to_exec = 'from calibre.db.fts.text import main; main({!r})'
+    code_to_exec = 'from calibre.db.fts.text import main; main({!r}, {!r})'
+    persistent_code_to_exec = 'from calibre.db.fts.text import serve; serve({!r}, {!r})'
     max_duration = 30  # minutes
     poll_interval = 0.1  # seconds
+    # When True text is extracted by a long lived worker process instead of
+    # starting a new process for every file.
+    persistent = True
+    # A persistent worker process is replaced by a fresh one after it has
+    # extracted text from this many files or its memory usage exceeds this
+    # many bytes, to guard against leaks in the input plugins
+    max_jobs_per_process = 1000
+    max_memory_per_process = 1024 * 1024 * 1024
 
     def __init__(self, jobs_queue, supervise_queue):
         super().__init__(name='FTSWorker', daemon=True)
@@ -62,8 +154,20 @@ def __init__(self, jobs_queue, supervise_queue):
         self.supervise_queue = supervise_queue
         self.keep_going = True
         self.working = False
+        self.extractor = None
 
     def run(self):
+        try:
+            self.process_jobs()
+        finally:
+            self.shutdown_extractor()
+
+    def shutdown_extractor(self):
+        if self.extractor is not None:
+            self.extractor.shutdown()
+            self.extractor = None
+
+    def process_jobs(self):
         while self.keep_going:
             x = self.jobs_queue.get()
             if x is quit:
@@ -81,44 +185,120 @@ def run(self):
             finally:
                 self.working = False
 
-    def run_job(self, job):
-        time_limit = monotonic() + (self.max_duration * 60)
-        txtpath = job.path + '.txt'
-        errpath = job.path + '.error'
+    @contextmanager
+    def job_files(self, job):
+        ''' The paths to write the text and errors for job to. They are
+        removed when done, along with the temporary copy of the format file,
+        if any. '''
+        if job.is_in_place:
+            with PersistentTemporaryFile(suffix='.fts') as pt:
+                pass
+            base = pt.name
+        else:
+            base = job.path
+        txtpath, errpath = base + '.txt', base + '.error'
         try:
-            with open(errpath, 'wb') as error:
-                p = start_pipe_worker(
-                    self.code_to_exec.format(job.path),
-                    stdout=subprocess.DEVNULL, stderr=error, stdin=subprocess.DEVNULL, priority='low',
-                )
-                while self.keep_going and monotonic() <= time_limit:
-                    with suppress(subprocess.TimeoutExpired):
-                        p.wait(self.poll_interval)
-                        break
-                if p.returncode is None:
-                    p.kill()
-                    if not self.keep_going:
-                        return
-                    return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
-                        job.fmt, human_readable(job.fmt_size)))
-                if os.path.exists(txtpath):
-                    return Result(job)
-            with open(errpath, 'rb') as f:
-                err = f.read().decode('utf-8', 'replace')
-                return Result(job, err)
+            yield txtpath, errpath
         finally:
-            with suppress(OSError):
-                os.remove(job.path)
-            with suppress(OSError):
-                os.remove(txtpath)
-            with suppress(OSError):
-                os.remove(errpath)
+            for path in (base, txtpath, errpath):
+                with suppress(OSError):
+                    os.remove(path)
+
+    def run_job(self, job):
+        with self.job_files(job) as (txtpath, errpath):
+            if self.persistent:
+                res = self.run_job_in_extractor(job, errpath)
+            else:
+                res = self.run_job_in_new_process(job, txtpath, errpath)
+        if res is not None and job.is_in_place and job.has_changed:
+            res.requeue = True
+        return res
+
+    def took_too_long(self, job):
+        return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
+            job.fmt, human_readable(job.fmt_size)))
+
+    def run_job_in_extractor(self, job, errpath):
+        time_limit = monotonic() + (self.max_duration * 60)
+        if self.extractor is not None and not self.extractor.is_alive:
+            self.shutdown_extractor()
+        if self.extractor is None:
+            self.extractor = Extractor(self.persistent_code_to_exec.format(self.max_jobs_per_process, self.max_memory_per_process))
+        self.extractor.send(job.path, errpath)
+        chunks = []
+        response = Empty
+        while self.keep_going and monotonic() <= time_limit:
+            try:
+                response = self.extractor.response(self.poll_interval)
+            except Empty:
+                continue
+            if response is None or 'text' not in response:
+                break
+            chunks.append(response['text'])
+            response = Empty
+        if response is Empty:
+            self.extractor.kill()
+            self.extractor = None
+            if not self.keep_going:
+                return
+            return self.took_too_long(job)
+        if response is None:
+            self.extractor.kill()
+            rc = self.extractor.process.returncode
+            self.extractor = None
+            return Result(job, read_error(errpath) or _('The worker process crashed with return code: {}').format(rc))
+        if response['ok']:
+            return Result(job, text=''.join(chunks))
+        return Result(job, read_error(errpath) or _('Failed to extract text from the {} file').format(job.fmt))
+
+    def run_job_in_new_process(self, job, txtpath, errpath):
+        time_limit = monotonic() + (self.max_duration * 60)
+        with open(errpath, 'wb') as error:
+            p = start_pipe_worker(
+                self.code_to_exec.format(job.path, txtpath),
+                stdout=subprocess.DEVNULL, stderr=error, stdin=subprocess.DEVNULL, priority='low',
+            )
+            while self.keep_going and monotonic() <= time_limit:
+                with suppress(subprocess.TimeoutExpired):
+                    p.wait(self.poll_interval)
+                    break
+            if p.returncode is None:
+                p.kill()
+                if not self.keep_going:
+                    return
+                return self.took_too_long(job)
+        if os.path.exists(txtpath):
+            with open(txtpath, 'rb') as src:
+                return Result(job, text=src.read().decode('utf-8', 'replace'))
+        return Result(job, read_error(errpath))
 
 
 class Pool:
 
+    # The indexing rate is calculated from the completion times of these many
+    # of the most recent jobs, ignoring jobs older than rate_window seconds
+    rate_sample_size = 64
+    rate_window = 120
+    # Results are committed to the db in batches, each in a single
+    # transaction, once there are commit_batch_size of them, their text is
+    # larger than commit_batch_text_size or the oldest of them has been
+    # waiting for commit_interval seconds
+    commit_batch_size = 32
+    commit_batch_text_size = 16 * 1024 * 1024
+    commit_interval = 1  # seconds
+    # The segments of the full text indices are merged, merge_pages at a
+    # time, when there is no indexing going on or after merge_every_batches
+    # batches have been committed
+    merge_pages = 256
+    merge_every_batches = 16
+
     def __init__(self, dbref):
         self.max_workers = 1
+        self.completion_times = deque(maxlen=self.rate_sample_size)
+        self.pending_results = []
+        self.pending_text_size = 0
+        self.commit_deadline = None
+        self.batches_since_merge = 0
         self.jobs_queue = Queue()
         self.supervise_queue = Queue()
         self.workers = []
@@ -170,6 +350,16 @@ def num_of_workers(self, num):
             elif num < len(self.workers):
                 self.shrink_workers()
 
+    @property
+    def jobs_per_second(self):
+        ''' The number of jobs completed per second recently or None if too
+        few jobs have completed recently to tell '''
+        now = monotonic()
+        times = [t for t in tuple(self.completion_times) if now - t <= self.rate_window]
+        if len(times) < 5:
+            return None
+        return (len(times) - 1) / max(times[-1] - times[0], 0.001)
+
     @property
     def num_of_idle_workers(self):
         return sum(0 if w.working else 1 for w in self.workers)
@@ -178,12 +368,12 @@ def check_for_work(self):
         self.initialize()
         self.supervise_queue.put(check_for_work)
 
-    def add_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
+    def add_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time, signature=None):
         self.initialize()
-        job = Job(book_id, fmt, path, fmt_size, fmt_hash, start_time)
+        job = Job(book_id, fmt, path, fmt_size, fmt_hash, start_time, signature)
         self.jobs_queue.put(job)
 
-    def commit_result(self, result):
+    def result_as_args(self, result):
         text = result.text
         err_msg = ''
         if not result.ok:
@@ -191,9 +381,22 @@ def commit_result(self, result):
             print(text, file=sys.stderr)
             err_msg = text
             text = ''
+        return result.book_id, result.fmt, result.fmt_size, result.fmt_hash, text, err_msg, result.start_time
+
+    def commit_result(self, result):
+        db = self.dbref()
+        if db is not None:
+            db.commit_fts_result(*self.result_as_args(result))
+
+    def commit_results(self, results):
         db = self.dbref()
         if db is not None:
-            db.commit_fts_result(result.book_id, result.fmt, result.fmt_size, result.fmt_hash, text, err_msg, result.start_time)
+            db.commit_fts_results(tuple(map(self.result_as_args, results)))
+
+    def requeue(self, result):
+        db = self.dbref()
+        if db is not None:
+            db.requeue_fts_job(result.book_id, result.fmt)
 
     def shutdown(self):
         if self.initialized.is_set():
@@ -219,16 +422,62 @@ def do_check_for_work(self):
         if db is not None:
             db.queue_next_fts_job()
 
+    @property
+    def is_idle(self):
+        return not self.pending_results and self.jobs_queue.empty() and not any(w.working for w in self.workers)
+
+    def add_pending_result(self, result):
+        if not self.pending_results:
+            self.commit_deadline = monotonic() + self.commit_interval
+        self.pending_results.append(result)
+        self.pending_text_size += len(result.text)
+
+    @property
+    def commit_due(self):
+        return bool(self.pending_results) and (
+            len(self.pending_results) >= self.commit_batch_size or self.pending_text_size >= self.commit_batch_text_size or
+            monotonic() >= self.commit_deadline)
+
+    def commit_pending_results(self):
+        results = self.pending_results
+        self.pending_results, self.pending_text_size, self.commit_deadline = [], 0, None
+        self.batches_since_merge += 1
+        self.commit_results(results)
+
+    def merge_segments(self):
+        # Stop merging as soon as there is something else to do, it will be
+        # resumed the next time the pool is idle
+        db = self.dbref()
+        while db is not None and self.keep_going and self.supervise_queue.empty():
+            if not db.merge_fts_segments(self.merge_pages):
+                self.batches_since_merge = 0
+                break
+
     def supervise(self):
+        # Results that have not yet been committed when the pool is shutdown
+        # are discarded, their formats remain dirtied and will be indexed
+        # again the next time the library is opened.
         while self.keep_going:
-            x = self.supervise_queue.get()
+            timeout = None if self.commit_deadline is None else max(0, self.commit_deadline - monotonic())
+            try:
+                x = self.supervise_queue.get(timeout=timeout)
+            except Empty:
+                x = None
             try:
                 if x is check_for_work:
                     self.do_check_for_work()
                 elif x is quit:
                     break
                 elif isinstance(x, Result):
-                    self.commit_result(x)
+                    if x.requeue:
+                        self.requeue(x)
+                    else:
+                        self.completion_times.append(monotonic())
+                        self.add_pending_result(x)
                     self.do_check_for_work()
+                if self.commit_due:
+                    self.commit_pending_results()
+                if self.batches_since_merge and (self.batches_since_merge >= self.merge_every_batches or self.is_idle):
+                    self.merge_segments()
             except Exception:
                 traceback.print_exc()
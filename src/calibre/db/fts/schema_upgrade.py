@@ -30,6 +30,28 @@ def __init__(self, conn):
             conn.execute('COMMIT')
         self.conn = None
 
+    def upgrade_version_1(self):
+        # Merging of the index segments is done by the indexer when it is
+        # idle rather than during every commit
+        for table in ('books_fts', 'books_fts_stemmed'):
+            self.conn.execute(f"INSERT INTO fts_db.{table}({table}, rank) VALUES('automerge', 0)")
+
+    def upgrade_version_2(self):
+        # Formats whose text is the same as that of another format only refer
+        # to it, by having the same text_hash and empty searchable_text. When
+        # the format that has the text is removed, the text is moved to one
+        # of the formats that refer to it.
+        self.conn.execute('''
+CREATE INDEX IF NOT EXISTS fts_db.books_text_hash_idx ON books_text (text_hash);
+
+CREATE TRIGGER fts_db.books_text_shared_delete_trg AFTER DELETE ON fts_db.books_text
+WHEN OLD.text_hash != '' AND OLD.searchable_text != ''
+BEGIN
+    UPDATE books_text SET searchable_text=OLD.searchable_text WHERE id=(
+        SELECT id FROM books_text WHERE text_hash=OLD.text_hash AND searchable_text='' LIMIT 1);
+END;
+''')
+
     @property
     def user_version(self):
         return self.conn.get('PRAGMA fts_db.user_version', all=False) or 0
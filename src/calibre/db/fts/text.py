@@ -66,17 +66,38 @@ def is_fmt_ok(input_fmt):
 
 
 def pdftotext(path):
+    return ''.join(pdftotext_chunks(path))
+
+
+def pdftotext_chunks(path, chunk_size=1024 * 1024):
+    # Chunks are split at line breaks so that they can be normalized
+    # independently
+    import codecs
     import subprocess
 
     from calibre.ebooks.pdf.pdftohtml import PDFTOTEXT, popen
     from calibre.utils.cleantext import clean_ascii_chars
     cmd = [PDFTOTEXT] + '-enc UTF-8 -nodiag -eol unix'.split() + [os.path.basename(path), '-']
     p = popen(cmd, cwd=os.path.dirname(path), stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
-    raw = p.stdout.read()
-    p.stdout.close()
-    if p.wait() != 0:
-        return ''
-    return clean_ascii_chars(raw).decode('utf-8', 'replace')
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pending = ''
+    try:
+        while True:
+            raw = p.stdout.read(chunk_size)
+            pending += decoder.decode(clean_ascii_chars(raw), final=not raw)
+            if not raw:
+                break
+            text, sep, pending = pending.rpartition('\n')
+            if sep:
+                yield text + sep
+    finally:
+        p.stdout.close()
+        rc = p.wait()
+    if rc != 0:
+        # The text yielded so far may be incomplete, so it must not be used
+        raise ValueError(f'{PDFTOTEXT} failed with return code: {rc}')
+    if pending:
+        yield pending
 
 
 def can_extract_text(pathtoebook: str, input_fmt: str, exit_stack: contextlib.ExitStack) -> tuple[str, str]:
@@ -102,33 +123,107 @@ def is_fmt_extractable(input_fmt: str) -> bool:
     return input_fmt.lower() in ARCHIVE_FMTS
 
 
+def normalize_text(text):
+    return unicodedata.normalize('NFC', text).replace('\u00ad', '')
+
+
 def extract_text(pathtoebook):
+    return ''.join(extract_text_chunks(pathtoebook))
+
+
+def extract_text_chunks(pathtoebook):
+    ''' Yield the text of the book in chunks, one per spine item, so that
+    the text of the whole book never has to be in memory at once. The input
+    file is only read, never modified. '''
     input_fmt = pathtoebook.rpartition('.')[-1].upper()
-    ans = ''
-    input_plugin = is_fmt_ok(input_fmt)
     with contextlib.ExitStack() as exit_stack:
         pathtoebook, input_fmt = can_extract_text(pathtoebook, input_fmt, exit_stack)
         if not pathtoebook:
-            return ans
-        input_plugin = plugin_for_input_format(input_fmt)
+            return
         if input_fmt == 'PDF':
-            ans = pdftotext(pathtoebook)
-        else:
-            tdir = exit_stack.enter_context(TemporaryDirectory())
-            texts = []
-            book_fmt, opfpath, input_fmt = extract_book(pathtoebook, tdir, log=default_log)
-            input_plugin = plugin_for_input_format(input_fmt)
-            is_comic = bool(getattr(input_plugin, 'is_image_collection', False))
-            if is_comic:
-                return ''
-            container = SimpleContainer(tdir, opfpath, default_log)
-            for name, is_linear in container.spine_names:
-                texts.extend(to_text(container, name))
-            ans = '\n\n\n'.join(texts)
-        return unicodedata.normalize('NFC', ans).replace('\u00ad', '')
-
-
-def main(pathtoebook):
-    text = extract_text(pathtoebook)
-    with open(pathtoebook + '.txt', 'wb') as f:
-        f.write(text.encode('utf-8'))
+            for text in pdftotext_chunks(pathtoebook):
+                yield normalize_text(text)
+            return
+        tdir = exit_stack.enter_context(TemporaryDirectory())
+        book_fmt, opfpath, input_fmt = extract_book(pathtoebook, tdir, log=default_log)
+        input_plugin = plugin_for_input_format(input_fmt)
+        is_comic = bool(getattr(input_plugin, 'is_image_collection', False))
+        if is_comic:
+            return
+        container = SimpleContainer(tdir, opfpath, default_log)
+        first = True
+        for name, is_linear in container.spine_names:
+            for text in to_text(container, name):
+                if not first:
+                    yield '\n\n\n'
+                first = False
+                yield normalize_text(text)
+
+
+def main(pathtoebook, output_path=None):
+    output_path = output_path or (pathtoebook + '.txt')
+    try:
+        with open(output_path, 'wb') as f:
+            for text in extract_text_chunks(pathtoebook):
+                f.write(text.encode('utf-8'))
+    except BaseException:
+        # A partially written file would be indexed as the text of the book
+        with contextlib.suppress(OSError):
+            os.remove(output_path)
+        raise
+
+
+def serve(max_jobs=0, max_memory=0):
+    '''
+    Extract text from many files in a single process. Each request is read
+    as a line of JSON from stdin with the path to the file and the path to
+    write errors to. The text is written to stdout as it is extracted, as
+    chunks each preceded by a line of JSON with its size in bytes, followed
+    by a line of JSON with the status. As stdout is used for the responses,
+    anything else written to it is discarded, while anything written to
+    stderr during an extraction goes to the error file for that request, as
+    it does for a process that extracts a single file. Exits when stdin is
+    closed or, so that it can be replaced by a fresh process, after max_jobs
+    files or once it uses more than max_memory bytes.
+    '''
+    import json
+    import sys
+    import traceback
+
+    from calibre.utils.mem import get_memory
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    # Output from the extraction code must never be mixed into the responses
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    sys.stdout.flush()
+    os.dup2(devnull, sys.stdout.fileno())
+    num_done = 0
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        sys.stdout.flush(), sys.stderr.flush()
+        with open(request['error_path'], 'wb') as error:
+            os.dup2(error.fileno(), sys.stderr.fileno())
+            try:
+                for text in extract_text_chunks(request['path']):
+                    if text:
+                        raw = text.encode('utf-8')
+                        responses.write(json.dumps({'text': len(raw)}).encode('utf-8') + b'\n')
+                        responses.write(raw)
+                responses.flush()
+                ok = True
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            finally:
+                sys.stdout.flush(), sys.stderr.flush()
+                os.dup2(devnull, sys.stderr.fileno())
+        num_done += 1
+        recycle = bool(max_jobs and num_done >= max_jobs)
+        if not recycle and max_memory:
+            with contextlib.suppress(Exception):
+                recycle = get_memory() > max_memory
+        responses.write(json.dumps({'ok': ok, 'recycle': recycle}).encode('utf-8') + b'\n')
+        responses.flush()
+        if recycle:
+            break
@@ -327,6 +327,86 @@ def user_categories_getter(proxy_metadata):
 
 for field in ('formats', 'format_metadata'):
     getters[field] = fmt_getter(field)
+
+
+# The fields in the database whose values are returned by the getters above,
+# None if the value can change without any of the fields of the book changing
+getter_dependencies = {
+    'title_sort': ('sort',), 'book_size': ('size',), 'ondevice_col': ('ondevice',), 'language': ('languages',),
+    'db_approx_formats': ('formats',), 'has_cover': ('cover',), 'series': ('series', 'series_index'),
+    'series_index': ('series', 'series_index'), 'format_metadata': ('formats',), 'application_id': (), 'id': (),
+    'virtual_libraries': None, 'link_maps': None, 'author_sort_map': None,
+}
+for field in TOP_LEVEL_IDENTIFIERS:
+    getter_dependencies[field] = ('identifiers',)
+for field in getters:
+    getter_dependencies.setdefault(field, (field,))
+
+
+def field_dependencies(names, field_metadata):
+    '''
+    Return the names of the fields in the database that the values of the
+    ProxyMetadata attributes in names are read from, or None if any of them can
+    change without any field changing. Composite columns are included as is,
+    their own dependencies are not expanded.
+    '''
+    ans = set()
+    for name in names:
+        if name in getter_dependencies:
+            deps = getter_dependencies[name]
+            if deps is None:
+                return None
+            ans.update(deps)
+        elif name == 'user_categories':
+            return None
+        elif name.startswith('#'):
+            base = name[:-6] if name.endswith('_index') and name[:-6] in field_metadata else name
+            ans.add(base)
+            if field_metadata.get(base, {}).get('datatype') == 'series':
+                ans.add(base + '_index')
+        # Other names are constants stored in the cache of the ProxyMetadata
+    return frozenset(ans)
+
+
+# Names used in templates for fields whose name in the database is different
+db_field_names = {'title_sort': 'sort', 'book_size': 'size', 'has_cover': 'cover', 'db_approx_formats': 'formats', 'ondevice_col': 'ondevice'}
+
+
+def cache_setter(field, field_metadata):
+    '''
+    Return a function that stores a value of field, as returned by
+    Cache.field_for(), in the cache of a ProxyMetadata object, in the form
+    used by the getters above. Returns None if the field cannot be stored.
+    '''
+    def func(cache, val):
+        cache[field] = val
+
+    def func_if_defined(cache, val):
+        if val is not None:
+            cache[field] = val
+
+    if field in ('authors', 'languages', 'tags', 'formats'):
+        def func_list(cache, val):
+            cache[field] = list(val)
+        return func_list
+    if field == 'cover':
+        def func_cover(cache, val):
+            cache['has_cover'] = _('Yes') if val else ''
+        return func_cover
+    if field in ('comments', 'publisher', 'identifiers', 'series', 'rating'):
+        return func
+    if field in ('title', 'sort', 'author_sort', 'uuid', 'size', 'ondevice', 'series_index', 'timestamp', 'pubdate', 'last_modified'):
+        # The getters for these fields use a default other than None
+        return func_if_defined
+    m = field_metadata.get(field, None)
+    if m is None or not m['is_custom'] or m['datatype'] == 'composite':
+        return None
+    if field.endswith('_index') and m['datatype'] == 'float':
+        return func_if_defined
+
+    def func_custom(cache, val):
+        cache[field] = fmt_custom(val)
+    return func_custom
 # }}}
 
 
@@ -339,12 +419,29 @@ def __init__(self, db, book_id, formatter=None):
         sa(self, '_book_id', book_id)
         sa(self, '_cache', {'cover_data':(None,None), 'device_collections':[]})
         sa(self, '_user_metadata', db.field_metadata)
+        sa(self, '_accessed', None)
+
+    def track_access(self, accessed):
+        '''
+        Record the names of the fields that are read from this object in the
+        set accessed, or stop recording if it is None. Returns the set that was
+        previously used, so that it can be restored.
+        '''
+        ans = ga(self, '_accessed')
+        sa(self, '_accessed', accessed)
+        return ans
 
     def __getattribute__(self, field):
         getter = getters.get(field, None)
         if getter is not None:
+            accessed = ga(self, '_accessed')
+            if accessed is not None:
+                accessed.add(field)
             return getter(ga(self, '_db'), ga(self, '_book_id'), ga(self, '_cache'))
         if field in SIMPLE_GET:
+            accessed = ga(self, '_accessed')
+            if accessed is not None:
+                accessed.add(field)
             if field == 'user_categories':
                 return user_categories_getter(self)
             return ga(self, '_cache').get(field, None)
@@ -355,6 +452,9 @@ def __getattribute__(self, field):
         um = ga(self, '_user_metadata')
         d = um.get(field, None)
         if d is not None:
+            accessed = ga(self, '_accessed')
+            if accessed is not None:
+                accessed.add(field)
             dt = d['datatype']
             if dt != 'composite':
                 if field.endswith('_index') and dt == 'float':
@@ -492,3 +592,48 @@ def smart_update(self, *args, **kwargs):
     @property
     def _proxy_metadata(self):
         return self
+
+
+class BatchProxyMetadata:
+
+    '''
+    Use instead of Cache._get_proxy_metadata() when metadata is needed for
+    many books, for example, to render a composite column for all books. Call
+    :meth:`prefetch` with the books and fields that will be needed and the
+    values for them are read with a single call to Cache.metadata_frame().
+    The values are stored one column per field and put into the
+    ProxyMetadata object created each time this object is called with a
+    book id, so that only the values, not a ProxyMetadata object for every
+    book, are kept. Must be used with the read lock held.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        # One (row_map, ((setter, column), ...)) per call to prefetch()
+        self.prefetched = []
+
+    def __call__(self, book_id):
+        ans = ProxyMetadata(self.db, book_id)
+        if self.prefetched:
+            cache = ga(ans, '_cache')
+            for row_map, columns in self.prefetched:
+                i = row_map.get(book_id)
+                if i is not None:
+                    for setter, column in columns:
+                        setter(cache, column[i])
+        return ans
+
+    def prefetch(self, book_ids, fields):
+        db = self.db
+        fm = db.field_metadata
+        setters = {}
+        for field in fields:
+            field = db_field_names.get(field, field)
+            if field in db.fields and field not in setters:
+                setter = cache_setter(field, fm)
+                if setter is not None:
+                    setters[field] = setter
+        if not setters:
+            return
+        frame = db._metadata_frame(book_ids, setters)
+        self.prefetched.append((frame.row_map, tuple((setters[field], frame[field]) for field in setters)))
@@ -35,10 +35,13 @@ class DowngradeLockError(LockingError):
     pass
 
 
-def create_locks():
+def create_locks(on_write=None):
     '''
     Return a pair of locks: (read_lock, write_lock)
 
+    If on_write is specified, it is called every time the write_lock is
+    acquired, see :class:`VersionedSnapshots`.
+
     The read_lock can be acquired by multiple threads simultaneously, it can
     also be acquired multiple times by the same thread.
 
@@ -59,7 +62,7 @@ def create_locks():
     '''
     l = SHLock()
     wrapper = DebugRWLockWrapper if os.environ.get('CALIBRE_DEBUG_DB_LOCKING') == '1' else RWLockWrapper
-    return wrapper(l), wrapper(l, is_shared=False)
+    return wrapper(l), wrapper(l, is_shared=False, on_acquire=on_write)
 
 
 class SHLock:  # {{{
@@ -109,6 +112,12 @@ def owns_lock(self):
         with self._lock:
             return self._exclusive_owner is me or me in self._shared_owners
 
+    @property
+    def is_contended(self):
+        ''' True if the lock is held exclusively or there are threads waiting
+        for it. Only a hint, as it can change as soon as it is returned. '''
+        return bool(self.is_exclusive or self._shared_queue or self._exclusive_queue)
+
     def release(self):
         ''' Release the lock. '''
         # This decrements the appropriate lock counters, and if the lock
@@ -224,12 +233,16 @@ def _return_waiter(self, waiter):
 
 class RWLockWrapper:
 
-    def __init__(self, shlock, is_shared=True):
+    def __init__(self, shlock, is_shared=True, on_acquire=None):
         self._shlock = shlock
         self._is_shared = is_shared
+        self._on_acquire = on_acquire
 
-    def acquire(self):
-        self._shlock.acquire(shared=self._is_shared)
+    def acquire(self, blocking=True):
+        ans = self._shlock.acquire(blocking=blocking, shared=self._is_shared)
+        if ans and self._on_acquire is not None:
+            self._on_acquire()
+        return ans
 
     def release(self, *args):
         self._shlock.release()
@@ -240,6 +253,14 @@ def release(self, *args):
     def owns_lock(self):
         return self._shlock.owns_lock()
 
+    @property
+    def is_contended(self):
+        return self._shlock.is_contended
+
+    def variant(self, is_shared=None, on_acquire=None):
+        ' Return a wrapper for the same underlying lock, with different settings '
+        return self.__class__(self._shlock, is_shared=self._is_shared if is_shared is None else is_shared, on_acquire=on_acquire)
+
 
 class DebugRWLockWrapper(RWLockWrapper):
 
@@ -247,15 +268,16 @@ def __init__(self, *args, **kwargs):
         RWLockWrapper.__init__(self, *args, **kwargs)
         self.print_lock = Lock()
 
-    def acquire(self):
+    def acquire(self, blocking=True):
         with self.print_lock:
             print('#' * 120, file=sys.stderr)
             print('acquire called: thread id:', current_thread(), 'shared:', self._is_shared, file=sys.stderr)
             traceback.print_stack()
-        RWLockWrapper.acquire(self)
+        ans = RWLockWrapper.acquire(self, blocking=blocking)
         with self.print_lock:
-            print('acquire done: thread id:', current_thread(), file=sys.stderr)
+            print('acquire done: thread id:', current_thread(), 'acquired:', ans, file=sys.stderr)
             print('_' * 120, file=sys.stderr)
+        return ans
 
     def release(self, *args):
         with self.print_lock:
@@ -294,3 +316,105 @@ def release(self, *args):
 
     __enter__ = acquire
     __exit__  = release
+
+
+class NullLock:
+
+    ' A lock that does nothing, used for objects that are never modified '
+
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self, *args):
+        pass
+
+    __enter__ = acquire
+    __exit__ = release
+
+    def owns_lock(self):
+        return False
+
+    is_contended = False
+
+
+class ReadOnlyLock(NullLock):
+
+    ' A lock that refuses to be acquired, used as the write lock of read-only objects '
+
+    def acquire(self, blocking=True):
+        raise LockingError('Cannot make changes using a read-only snapshot')
+
+    __enter__ = acquire
+
+
+class VersionedSnapshots:  # {{{
+    '''
+    Snapshot (multi-version) reads for data protected by an :class:`SHLock`.
+    Readers get an immutable snapshot of the data and so never have to wait for
+    writers. Writers call :meth:`invalidate` (typically via the on_write
+    callback of :func:`create_locks`) and a new version is created lazily,
+    copy-on-write, by the next reader that can acquire a shared lock without
+    waiting. Until then, readers keep using the previous version. Only the
+    very first snapshot is created with a blocking acquire.
+
+    create_snapshot(previous, changed) must return the new snapshot. changed
+    is either None, meaning everything must be copied, or the set of keys
+    passed to :meth:`invalidate` since previous was created. Everything else
+    can be shared with previous, since snapshots are never modified.
+    '''
+
+    def __init__(self, read_lock, create_snapshot):
+        self.read_lock = read_lock
+        self.create_snapshot = create_snapshot
+        self.current = None
+        self.version = 0
+        self.changed = None
+        self.is_stale = True
+        self.refresh_lock = Lock()
+
+    def invalidate(self, keys=None):
+        ''' Mark the current snapshot as stale. Must be called with the write lock
+        held. keys is an optional iterable of the keys that were changed, if not
+        specified everything is considered changed. '''
+        if keys is None:
+            self.changed = None
+        elif self.changed is not None:
+            self.changed |= set(keys)
+        self.is_stale = True
+
+    def get(self):
+        ''' Return the latest snapshot available without waiting for writers,
+        or None if the current thread holds the write lock, in which case the
+        caller should read the live data. '''
+        snapshot = self.current
+        if snapshot is not None and not self.is_stale:
+            return snapshot
+        blocking = snapshot is None
+        if not self.refresh_lock.acquire(blocking=blocking):
+            return snapshot  # another thread is creating a new version
+        try:
+            try:
+                if not self.read_lock.acquire(blocking=blocking):
+                    return snapshot  # a writer is active or waiting
+            except DowngradeLockError:
+                return None
+            try:
+                if self.is_stale or self.current is None:
+                    changed, previous = self.changed, self.current
+                    self.changed, self.is_stale = set(), False
+                    try:
+                        self.current = self.create_snapshot(previous, None if previous is None else changed)
+                    except Exception:
+                        self.changed, self.is_stale = None, True
+                        raise
+                    self.version += 1
+                return self.current
+            finally:
+                self.read_lock.release()
+        finally:
+            self.refresh_lock.release()
+
+    def clear(self):
+        self.current = None
+        self.invalidate()
+# }}}
@@ -818,3 +818,40 @@ def upgrade_version_25(self):
         alters.append("ALTER TABLE languages ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         alters.append("ALTER TABLE ratings ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         self.db.execute('\n'.join(alters))
+
+    def upgrade_version_26(self):
+        ''' Support incremental syncing of annotations, including deleted ones '''
+        self.db.execute('''
+ALTER TABLE annotations ADD COLUMN sync_seq INTEGER NOT NULL DEFAULT 0;
+
+DROP TABLE IF EXISTS annotations_sync_seq;
+CREATE TABLE annotations_sync_seq(id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER NOT NULL);
+INSERT INTO annotations_sync_seq (id, seq) VALUES (0, 0);
+
+DROP INDEX IF EXISTS annot_sync_idx;
+CREATE INDEX annot_sync_idx ON annotations (book, format, user_type, user, sync_seq);
+DROP INDEX IF EXISTS annot_user_timestamp_idx;
+CREATE INDEX annot_user_timestamp_idx ON annotations (user_type, user, timestamp);
+
+DROP TABLE IF EXISTS annotations_tombstones;
+CREATE TABLE annotations_tombstones(id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE,
+    user_type TEXT NOT NULL,
+    user TEXT NOT NULL,
+    annot_type TEXT NOT NULL,
+    annot_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    sync_seq INTEGER NOT NULL,
+    UNIQUE(book, format, user_type, user, annot_type, annot_id)
+);
+DROP INDEX IF EXISTS annot_tombstones_sync_idx;
+CREATE INDEX annot_tombstones_sync_idx ON annotations_tombstones (book, format, user_type, user, sync_seq);
+
+DROP TRIGGER IF EXISTS annotations_tombstones_delete_trg;
+CREATE TRIGGER annotations_tombstones_delete_trg
+    AFTER DELETE ON books
+    BEGIN
+        DELETE FROM annotations_tombstones WHERE book=OLD.id;
+    END;
+''')
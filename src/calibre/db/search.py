@@ -6,16 +6,23 @@
 __docformat__ = 'restructuredtext en'
 
 import operator
+import sys
+import time
 import weakref
-from collections import OrderedDict, deque
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
 from datetime import timedelta
 from functools import partial
+from threading import Lock
 
 import regex
 
 from calibre.constants import DEBUG, preferred_encoding
+from calibre.db.bitmap import Bitmap
+from calibre.db.fields import ManyToManyField, ManyToOneField
+from calibre.db.lazy import BatchProxyMetadata
 from calibre.db.utils import force_to_bool
-from calibre.utils.config_base import prefs
+from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import primary_contains, primary_no_punc_contains, sort_key
@@ -149,6 +156,16 @@ def lt(self, dbdate, query, field_count):
     def ge(self, *args):
         return not self.lt(*args)
 
+    def is_relative(self, query):
+        ' Return True if the result of query depends on the current date '
+        query = icu_lower(query)
+        for k in self.operators:
+            if query.startswith(k):
+                query = query[len(k):]
+                break
+        return (query in self.local_today or query in self.local_yesterday or query in self.local_thismonth or
+                self.daysago_pat.search(query) is not None)
+
     def __call__(self, query, field_iter):
         matches = set()
         if len(query) < 2:
@@ -476,8 +493,9 @@ class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, search_index=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.search_index = search_index
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -499,7 +517,7 @@ def universal_set(self):
         return self.all_book_ids
 
     def field_iter(self, name, candidates):
-        get_metadata = self.dbcache._get_proxy_metadata
+        get_metadata = BatchProxyMetadata(self.dbcache)
         try:
             field = self.dbcache.fields[name]
         except KeyError:
@@ -630,7 +648,7 @@ def fi(default_value=None):
                 len(query) > 1 and query[0] == '#' and query[1] in '=<>!'):
                 return self.num_search(icu_lower(query[1:]), partial(
                         self.dbcache.fields[location].iter_counts, candidates,
-                        get_metadata=self.dbcache._get_proxy_metadata),
+                        get_metadata=BatchProxyMetadata(self.dbcache)),
                     location, dt, candidates)
 
             # take care of boolean special case
@@ -774,12 +792,18 @@ def fi(default_value=None):
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
-                    if val is not None:
-                        if isinstance(val, string_or_bytes):
-                            val = (val,)
-                        if _match(q, val, matchkind, use_primary_find_in_search=upf, case_sensitive=case_sensitive):
-                            matches |= book_ids
+                found = None
+                if self.search_index is not None and not case_sensitive:
+                    found = self.search_index.matching_books(self.dbcache, location, q, matchkind, upf, current_candidates)
+                if found is None:
+                    for val, book_ids in self.field_iter(location, current_candidates):
+                        if val is not None:
+                            if isinstance(val, string_or_bytes):
+                                val = (val,)
+                            if _match(q, val, matchkind, use_primary_find_in_search=upf, case_sensitive=case_sensitive):
+                                matches |= book_ids
+                else:
+                    matches |= found
 
             if location == 'series_sort':
                 book_lang_map = self.dbcache.fields['languages'].book_value_map
@@ -816,6 +840,173 @@ def get_user_category_matches(self, location, query, candidates):
 # }}}
 
 
+class FieldValueIndex:  # {{{
+
+    '''
+    An inverted index of the values of a single many-one or many-many text
+    field. Maps the case folded value to the ids of the items that have it.
+    The book ids are looked up in the col_book_map of the field's table at
+    query time, so this only needs updating when item names change.
+    '''
+
+    __slots__ = ('folded', 'item_values', 'sorted_values', 'trigrams')
+
+    def __init__(self, id_map):
+        self.item_values = {}
+        self.folded = defaultdict(set)
+        self.sorted_values = self.trigrams = None
+        for item_id, val in iteritems(id_map):
+            self.set_item(item_id, val)
+
+    def set_item(self, item_id, val):
+        ' Add or update an item, returns True if the index was changed '
+        fval = icu_lower(val) if isinstance(val, str) else None
+        old = self.item_values.get(item_id)
+        if old == fval and item_id in self.item_values:
+            return False
+        if item_id in self.item_values:
+            self.remove_item(item_id)
+        self.item_values[item_id] = fval
+        if fval is not None:
+            is_new = fval not in self.folded
+            self.folded[fval].add(item_id)
+            if is_new:
+                self.sorted_values = None
+                if self.trigrams is not None:
+                    for tg in iter_trigrams(fval):
+                        self.trigrams[tg].add(fval)
+        return True
+
+    def remove_item(self, item_id):
+        fval = self.item_values.pop(item_id, None)
+        if fval is None:
+            return
+        ids = self.folded.get(fval)
+        if ids is not None:
+            ids.discard(item_id)
+            if not ids:
+                del self.folded[fval]
+                self.sorted_values = None
+                if self.trigrams is not None:
+                    for tg in iter_trigrams(fval):
+                        vals = self.trigrams.get(tg)
+                        if vals is not None:
+                            vals.discard(fval)
+
+    def values_with_prefix(self, prefix):
+        if self.sorted_values is None:
+            self.sorted_values = sorted(self.folded)
+        sv = self.sorted_values
+        for i in range(bisect_left(sv, prefix), len(sv)):
+            if not sv[i].startswith(prefix):
+                break
+            yield sv[i]
+
+    def values_containing(self, query):
+        if self.trigrams is None:
+            self.trigrams = defaultdict(set)
+            for fval in self.folded:
+                for tg in iter_trigrams(fval):
+                    self.trigrams[tg].add(fval)
+        candidates = None
+        for tg in iter_trigrams(query):
+            vals = self.trigrams.get(tg)
+            if not vals:
+                return ()
+            candidates = set(vals) if candidates is None else candidates.intersection(vals)
+        return (v for v in candidates if query in v)
+
+    def matching_values(self, query, matchkind, use_primary_find_in_search):
+        ' Return the folded values that match query, which must already be case folded '
+        if not query.startswith('..'):
+            if matchkind == EQUALS_MATCH:
+                if not query.startswith('.'):
+                    return (query,) if query in self.folded else ()
+                if len(query) > 1:
+                    # Hierarchical match, =.a matches a and a.b but not ab
+                    prefix = query[1:]
+                    return (v for v in self.values_with_prefix(prefix) if len(v) == len(prefix) or v[len(prefix)] == '.')
+            elif matchkind == CONTAINS_MATCH and not use_primary_find_in_search and len(query) > 2:
+                return self.values_containing(query)
+        # Everything else is matched against each distinct value, once
+        return (v for v in self.folded if _match(query, (v,), matchkind, use_primary_find_in_search=use_primary_find_in_search))
+
+    def item_ids_for_values(self, values):
+        ans = set()
+        folded = self.folded
+        for v in values:
+            ans |= folded.get(v, ())
+        return ans
+
+
+def iter_trigrams(text):
+    for i in range(len(text) - 2):
+        yield text[i:i+3]
+
+
+def is_value_indexable(field):
+    isv = getattr(type(field), 'iter_searchable_values', None)
+    return field.has_text_data and isv in (ManyToOneField.iter_searchable_values, ManyToManyField.iter_searchable_values)
+
+
+class SearchIndex:
+
+    '''
+    Holds lazily created :class:`FieldValueIndex` objects for fields, so that
+    text searches on them become lookups rather than matching the query
+    against every value of the field and intersecting its books with the
+    candidates.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.field_indices = {}
+
+    def clear(self):
+        with self.lock:
+            self.field_indices.clear()
+
+    def update(self, dbcache, book_ids):
+        ' Update the indices for any items used by book_ids that were created or renamed '
+        with self.lock:
+            for name, fi in tuple(iteritems(self.field_indices)):
+                field = dbcache.fields.get(name)
+                if field is None:
+                    del self.field_indices[name]
+                    continue
+                id_map = field.table.id_map
+                for book_id in book_ids:
+                    for item_id in field.ids_for_book(book_id):
+                        fi.set_item(item_id, id_map.get(item_id))
+
+    def index_for(self, dbcache, name):
+        with self.lock:
+            ans = self.field_indices.get(name)
+            if ans is None:
+                field = dbcache.fields.get(name)
+                if field is None or not is_value_indexable(field):
+                    return
+                ans = self.field_indices[name] = FieldValueIndex(field.table.id_map)
+            return ans
+
+    def matching_books(self, dbcache, name, query, matchkind, use_primary_find_in_search, candidates):
+        '''
+        Return the set of books from candidates whose values for the field
+        name match the case folded query, or None if the field is not indexed.
+        '''
+        fi = self.index_for(dbcache, name)
+        if fi is None:
+            return
+        cbm = dbcache.fields[name].table.col_book_map
+        with self.lock:
+            item_ids = fi.item_ids_for_values(tuple(fi.matching_values(query, matchkind, use_primary_find_in_search)))
+        ans = set()
+        for item_id in item_ids:
+            ans |= cbm.get(item_id, ())
+        return ans & candidates
+# }}}
+
+
 class LRUCache:  # {{{
 
     'A simple Least-Recently-Used cache'
@@ -873,9 +1064,125 @@ def __iter__(self):
 # }}}
 
 
+class CachedResult:  # {{{
+
+    __slots__ = ('expires', 'fields', 'frozen', 'result')
+
+    def __init__(self, result, fields=None, expires=None):
+        self.result, self.fields, self.expires = result, fields, expires
+        self.frozen = None
+
+    @property
+    def nbytes(self):
+        return self.result.nbytes + (0 if self.frozen is None else sys.getsizeof(self.frozen))
+
+    def depends_on(self, changed_fields):
+        return self.fields is None or changed_fields is None or not self.fields.isdisjoint(changed_fields)
+# }}}
+
+
+class ResultCache:  # {{{
+
+    '''
+    A Least-Recently-Used cache of search results. Results are stored as
+    :class:`Bitmap` objects and the cache is bounded both by the number of
+    entries and by the memory used by them. Every entry records the fields its
+    query depends on (None meaning all fields) so that only entries affected
+    by a change need be invalidated, and optionally a time after which the
+    entry expires, for queries that depend on the current date. A frozenset
+    of the result is created and kept with the entry the first time it is
+    needed, so that repeated searches do not have to decode the bitmap.
+    '''
+
+    def __init__(self, limit=None, max_memory=None):
+        if limit is None or max_memory is None:
+            limits = tweaks['search_result_cache_limits']
+            limit = limits.get('entries', 100) if limit is None else limit
+            max_memory = limits.get('memory_mb', 16) * 1024 * 1024 if max_memory is None else max_memory
+        self.limit, self.max_memory = limit, max_memory
+        self.item_map = OrderedDict()
+        self.memory_used = 0
+
+    def _prune(self):
+        while self.item_map and (len(self.item_map) > self.limit or self.memory_used > self.max_memory):
+            self.memory_used -= self.item_map.popitem(last=False)[1].nbytes
+
+    def add(self, key, val, fields=None, expires=None):
+        self.pop(key)
+        val = Bitmap.coerce(val)
+        self.item_map[key] = CachedResult(val, fields, expires)
+        self.memory_used += val.nbytes
+        self._prune()
+        return val
+    __setitem__ = add
+
+    def set_result(self, key, val):
+        ' Replace the result for key, keeping its dependencies and position '
+        entry = self.item_map.get(key)
+        if entry is not None:
+            val = Bitmap.coerce(val)
+            self.memory_used -= entry.nbytes
+            entry.result, entry.frozen = val, None
+            self.memory_used += entry.nbytes
+            self._prune()
+
+    def get(self, key, default=None, frozen=False):
+        ' Return the cached Bitmap for key or, if frozen is True, the cached result as a frozenset '
+        entry = self.item_map.get(key)
+        if entry is None:
+            return default
+        if entry.expires is not None and time.time() >= entry.expires:
+            self.pop(key)
+            return default
+        self.item_map.move_to_end(key)
+        if frozen:
+            if entry.frozen is None:
+                entry.frozen = frozenset(entry.result)
+                self.memory_used += sys.getsizeof(entry.frozen)
+                self._prune()
+            return entry.frozen
+        return entry.result
+
+    def clear(self):
+        self.item_map.clear()
+        self.memory_used = 0
+
+    def pop(self, key, default=None):
+        entry = self.item_map.pop(key, None)
+        if entry is None:
+            return default
+        self.memory_used -= entry.nbytes
+        return entry.result
+
+    def keys_depending_on(self, changed_fields):
+        return tuple(k for k, entry in iteritems(self.item_map) if entry.depends_on(changed_fields))
+
+    def __contains__(self, key):
+        return key in self.item_map
+
+    def __len__(self):
+        return len(self.item_map)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __iter__(self):
+        for key, entry in tuple(iteritems(self.item_map)):
+            yield key, entry.result
+
+
+def next_day_boundary():
+    ' The time at which queries relative to today must be re-evaluated '
+    n = now()
+    return (n + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+# }}}
+
+
 class Search:
 
     MAX_CACHE_UPDATE = 50
+    # Fields whose values are derived from other fields
+    EXTRA_DEPENDENCIES = {'series_sort': ('series', 'languages')}
 
     def __init__(self, db, opt_name, all_search_locations=()):
         self.all_search_locations = all_search_locations
@@ -884,8 +1191,9 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.bool_search = BooleanSearch()
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
-        self.cache = LRUCache()
+        self.cache = ResultCache()
         self.parse_cache = LRUCache(limit=100)
+        self.search_index = SearchIndex()
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -896,40 +1204,57 @@ def change_locations(self, newlocs):
             self.parse_cache.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
-        else:
+    def update_or_clear(self, dbcache, book_ids=None, changed_fields=None):
+        '''
+        Update cached results after the books in book_ids have changed. If
+        changed_fields is not None only cached results that depend on one of
+        those fields are affected.
+        '''
+        if not book_ids:
+            self.search_index.clear()
             self.clear_caches()
+            return
+        self.search_index.update(dbcache, book_ids)
+        queries = self.cache.keys_depending_on(changed_fields)
+        if not queries:
+            return
+        if len(book_ids) * len(queries) <= self.MAX_CACHE_UPDATE:
+            self.update_caches(dbcache, book_ids, queries)
+        else:
+            for query in queries:
+                self.cache.pop(query)
 
     def clear_caches(self):
         self.cache.clear()
 
-    def update_caches(self, dbcache, book_ids):
+    def update_caches(self, dbcache, book_ids, queries=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, queries)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
     def discard_books(self, book_ids):
-        book_ids = set(book_ids)
+        book_ids = Bitmap(book_ids)
         for query, result in self.cache:
-            result.difference_update(book_ids)
+            self.cache.set_result(query, result - book_ids)
 
-    def _update_caches(self, sqp, book_ids):
+    def _update_caches(self, sqp, book_ids, queries=None):
         book_ids = sqp.all_book_ids = set(book_ids)
+        changed = Bitmap(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        queries = None if queries is None else frozenset(queries)
+        for query, result in self.cache:
+            if queries is not None and query not in queries:
+                continue
             try:
                 matches = sqp.parse(query)
             except ParseException:
                 remove.add(query)
             else:
-                # remove books that no longer match
-                result.difference_update(book_ids - matches)
-                # add books that now match but did not before
-                result.update(matches)
+                # remove books that no longer match and add books that now
+                # match but did not before
+                self.cache.set_result(query, (result - changed) | Bitmap(matches))
         for query in remove:
             self.cache.pop(query)
 
@@ -940,48 +1265,83 @@ def create_parser(self, dbcache, virtual_fields=None):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache, self.search_index)
 
-    def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
+    def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None, as_bitmap=False):
         '''
         Return the set of ids of all records that match the specified
-        query and restriction
+        query and restriction. If as_bitmap is True the result is a
+        :class:`Bitmap` rather than a set.
         '''
         # We construct a new parser instance per search as the parse is not
         # thread safe.
         sqp = self.create_parser(dbcache, virtual_fields)
         try:
-            return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
+            return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids, as_bitmap=as_bitmap)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
     def query_is_cacheable(self, sqp, dbcache, query):
-        if query:
-            for name, value in sqp.get_queried_fields(query):
-                if name == 'template':
-                    return False
-                elif name in dbcache.field_metadata.all_field_keys():
-                    fm = dbcache.field_metadata[name]
-                    if fm['datatype'] == 'datetime':
-                        return False
-                    if fm['datatype'] == 'composite':
-                        if fm.get('display', {}).get('composite_sort', '') == 'date':
-                            return False
-        return True
+        return self.query_dependencies(sqp, dbcache, query)[0]
 
-    def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
+    def query_dependencies(self, sqp, dbcache, query):
+        '''
+        Return (is_cacheable, fields, expires) for query. fields is the set of
+        fields the result of the query depends on, or None if it can depend on
+        any field. expires is the time at which a cached result becomes
+        invalid or None.
+        '''
+        fields, expires = set(), None
+        if not query:
+            return True, frozenset(), expires
+        field_metadata = dbcache.field_metadata
+        all_keys = frozenset(field_metadata.all_field_keys())
+        for name, value in sqp.get_queried_fields(query):
+            if name == 'template':
+                return False, None, None
+            if len(name) > 2 and name.startswith('@') and name[1:] in sqp.grouped_search_terms:
+                name = name[1:]
+            keys = field_metadata.search_term_to_field_key(icu_lower(name.strip()))
+            for key in (keys if isinstance(keys, list) else (keys,)):
+                if key == 'date':
+                    key = 'timestamp'
+                if key not in all_keys:
+                    # all, vl, user categories, etc.
+                    fields = None
+                    continue
+                fm = field_metadata[key]
+                if fm['datatype'] == 'composite':
+                    if fm.get('display', {}).get('composite_sort', '') == 'date':
+                        return False, None, None
+                    # Templates can use the values of any field
+                    fields = None
+                    continue
+                if fm['datatype'] == 'datetime' and self.date_search.is_relative(value):
+                    expires = next_day_boundary()
+                if fields is not None:
+                    fields.add(key)
+                    fields.update(self.EXTRA_DEPENDENCIES.get(key, ()))
+        return True, (None if fields is None else frozenset(fields)), expires
+
+    def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None, as_bitmap=False):
         ''' Do the search, caching the results. Results are cached only if the
         search is on the full library and no virtual field is searched on '''
+
+        def ans(result):
+            if as_bitmap:
+                return Bitmap.coerce(result)
+            return result.as_set() if isinstance(result, Bitmap) else result
+
         if isinstance(search_restriction, bytes):
             search_restriction = search_restriction.decode('utf-8')
         if isinstance(query, bytes):
             query = query.decode('utf-8')
 
         query = query.strip()
-        use_cache = self.query_is_cacheable(sqp, dbcache, query)
+        use_cache, query_fields, query_expires = self.query_dependencies(sqp, dbcache, query)
 
         if use_cache and book_ids is None and query and not search_restriction:
-            cached = self.cache.get(query)
+            cached = self.cache.get(query, frozen=not as_bitmap)
             if cached is not None:
                 return cached
 
@@ -989,33 +1349,42 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         if search_restriction and search_restriction.strip():
             sr = search_restriction.strip()
             sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
-            if self.query_is_cacheable(sqp, dbcache, sr):
+            sr_cacheable, sr_fields, sr_expires = self.query_dependencies(sqp, dbcache, sr)
+            if sr_cacheable:
                 cached = self.cache.get(sr)
                 if cached is None:
                     restricted_ids = sqp.parse(sr)
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                        self.cache.add(sr, restricted_ids)
+                        stored = self.cache.add(sr, restricted_ids, sr_fields, sr_expires)
+                        if as_bitmap and not query:
+                            restricted_ids = stored
                 else:
+                    if not query and book_ids is None and not as_bitmap:
+                        return self.cache.get(sr, frozen=True)
+                    # Stays a bitmap until the parser needs a set, the
+                    # restriction is often the only thing searched for
                     restricted_ids = cached
                     if book_ids is not None:
-                        restricted_ids = book_ids.intersection(restricted_ids)
+                        restricted_ids = {book_id for book_id in book_ids if book_id in cached}
             else:
                 restricted_ids = sqp.parse(sr)
         elif book_ids is not None:
             restricted_ids = book_ids
 
         if not query:
-            return restricted_ids
+            return ans(restricted_ids)
 
         if use_cache and restricted_ids is all_book_ids:
-            cached = self.cache.get(query)
+            cached = self.cache.get(query, frozen=not as_bitmap)
             if cached is not None:
                 return cached
 
-        sqp.all_book_ids = restricted_ids
+        sqp.all_book_ids = restricted_ids.as_set() if isinstance(restricted_ids, Bitmap) else restricted_ids
         result = sqp.parse(query)
 
-        if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+        if use_cache and not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
+            stored = self.cache.add(query, result, query_fields, query_expires)
+            if as_bitmap:
+                result = stored
 
-        return result
+        return ans(result)
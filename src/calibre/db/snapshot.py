@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import copy
+from collections import defaultdict
+from threading import Lock
+
+from calibre.db.columnar import DenseBookMap
+
+# Attributes through which fields refer to other fields, see Cache.init()
+FIELD_REFERENCES = ('series_field', 'index_field', 'author_sort_field', 'title_sort_field')
+MUTABLE_VALUE_TYPES = (set, dict, list, defaultdict)
+
+
+def copy_map(m):
+    if isinstance(m, DenseBookMap):
+        # Values in dense maps are always immutable
+        return m.clone()
+    ans = m.copy()
+    for k, v in m.items():
+        if isinstance(v, MUTABLE_VALUE_TYPES):
+            ans[k] = v.copy()
+    return ans
+
+
+def snapshot_table(table):
+    ' Return a copy of table that shares nothing mutable with it, apart from its metadata '
+    if table.deferred_reader is not None:
+        # Read now, so that the snapshot has the data as of its creation
+        table.deferred_reader(table)
+    ans = copy.copy(table)
+    for k, v in vars(table).items():
+        if k != 'metadata' and isinstance(v, (dict, DenseBookMap)):
+            setattr(ans, k, copy_map(v))
+    return ans
+
+
+def snapshot_field(field, db_weakref):
+    ans = copy.copy(field)
+    ans.db_weakref = db_weakref
+    table = getattr(field, 'table', None)
+    if table is not None:
+        ans.table = snapshot_table(table)
+    if hasattr(field, '_render_cache'):
+        ans._render_cache = {}
+        ans._lock = Lock()
+        ans._template_state = None
+    return ans
+
+
+def fields_to_copy(fields, changed):
+    ' Expand the set of changed field names to include fields that refer to them '
+    ans = set(changed)
+    while True:
+        before = len(ans)
+        for name, field in fields.items():
+            for attr in FIELD_REFERENCES:
+                other = getattr(field, attr, None)
+                if other is not None and (name in ans or other.name in ans):
+                    ans.add(name), ans.add(other.name)
+        if len(ans) == before:
+            return ans
+
+
+def snapshot_fields(fields, previous_fields, changed, db_weakref):
+    '''
+    Return copies of fields for use in a read snapshot. Fields that have not
+    changed since previous_fields was created are shared with it. Composite
+    fields are always copied, since their values can depend on any field.
+    Virtual fields, such as ondevice, are shared as they do their own locking.
+    '''
+    if previous_fields is None or changed is None:
+        to_copy = None
+    else:
+        to_copy = fields_to_copy(fields, changed)
+    ans = {}
+    for name, field in fields.items():
+        table = getattr(field, 'table', None)
+        if table is None:  # virtual fields
+            ans[name] = field
+        elif to_copy is None or name in to_copy or field.metadata['datatype'] == 'composite' or name not in previous_fields:
+            ans[name] = snapshot_field(field, db_weakref)
+        else:
+            ans[name] = previous_fields[name]
+    for field in ans.values():
+        for attr in FIELD_REFERENCES:
+            other = getattr(field, attr, None)
+            if other is not None and ans.get(other.name) is not other:
+                setattr(field, attr, ans[other.name])
+    return ans
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, Kovid Goyal <kovid at kovidgoyal.net>'
+
+from threading import Lock
+
+
+class FieldRanks:
+    '''
+    Maps book_id -> rank for a single sort field. Books with equal sort keys
+    have equal ranks and ranks are ordered the same way as the sort keys. The
+    sort keys themselves are kept so that when a few books change, only their
+    keys need to be re-calculated.
+    '''
+
+    __slots__ = ('keys', 'rank_for_key', 'ranks')
+
+    def __init__(self):
+        self.keys = {}
+        self.ranks = {}
+        self.rank_for_key = {}
+
+    @property
+    def num_of_ranks(self):
+        return len(self.rank_for_key)
+
+    def invalidate(self, book_ids):
+        keys, ranks = self.keys, self.ranks
+        for book_id in book_ids:
+            keys.pop(book_id, None)
+            ranks.pop(book_id, None)
+
+    def ensure(self, book_ids, create_key_func):
+        ranks = self.ranks
+        missing = [book_id for book_id in book_ids if book_id not in ranks]
+        if not missing:
+            return
+        key_func = create_key_func()
+        keys, rank_for_key = self.keys, self.rank_for_key
+        needs_rebuild = False
+        for book_id in missing:
+            k = keys[book_id] = key_func(book_id)
+            r = rank_for_key.get(k)
+            if r is None:
+                needs_rebuild = True
+            else:
+                ranks[book_id] = r
+        if needs_rebuild:
+            # Only the distinct keys are sorted, which is much faster than
+            # sorting all books
+            rank_for_key = self.rank_for_key = {k:i for i, k in enumerate(sorted(set(keys.values())))}
+            self.ranks = {book_id:rank_for_key[k] for book_id, k in keys.items()}
+
+
+class SortIndex:
+    '''
+    Persistent per-field sort ranks used by :meth:`calibre.db.cache.Cache.multisort`.
+    Sorting on one or more fields then becomes a gather of small integers
+    followed by a sort on those integers, instead of comparing ICU sort keys
+    for every pair of books. The ranks for a book are invalidated whenever its
+    metadata changes and are re-calculated lazily on the next sort.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.field_ranks = {}
+
+    def invalidate(self, book_ids=None):
+        with self.lock:
+            if book_ids is None:
+                self.field_ranks.clear()
+            else:
+                for fr in self.field_ranks.values():
+                    fr.invalidate(book_ids)
+
+    def ranks_for(self, field, book_ids, create_key_func, persistent=True):
+        ' Return the book_id -> rank map and the number of distinct ranks for field '
+        if not persistent:
+            fr = FieldRanks()
+            fr.ensure(book_ids, create_key_func)
+            return fr.ranks, fr.num_of_ranks
+        with self.lock:
+            fr = self.field_ranks.get(field)
+            if fr is None:
+                fr = self.field_ranks[field] = FieldRanks()
+            try:
+                fr.ensure(book_ids, create_key_func)
+            except Exception:
+                # Do not leave partially calculated ranks around
+                del self.field_ranks[field]
+                raise
+            return fr.ranks, fr.num_of_ranks
+
+    def multisort(self, ids_to_sort, fields, create_key_func, is_indexable):
+        '''
+        Sort ids_to_sort on fields, a list of (field_name, ascending) pairs.
+        create_key_func(field) must return the sort key function for field.
+        Fields for which is_indexable(field) is False have their ranks
+        calculated afresh for every sort. Raises an exception if the sort keys
+        for some field cannot be compared, in which case the caller should
+        fall back to sorting by comparing keys directly.
+        '''
+        if not isinstance(ids_to_sort, (list, tuple)):
+            ids_to_sort = tuple(ids_to_sort)
+        combined = None
+        for field, ascending in fields:
+            ranks, num_of_ranks = self.ranks_for(
+                field, ids_to_sort, lambda: create_key_func(field), is_indexable(field))
+            if len(fields) == 1:
+                return sorted(ids_to_sort, key=ranks.__getitem__, reverse=not ascending)
+            vals = map(ranks.__getitem__, ids_to_sort)
+            if not ascending:
+                vals = map((num_of_ranks - 1).__sub__, vals)
+            if combined is None:
+                combined = list(vals)
+            else:
+                # Combine the ranks into a single integer, with the most
+                # significant field in the highest "digit"
+                combined = [c * num_of_ranks + r for c, r in zip(combined, vals)]
+        if combined is None:
+            return list(ids_to_sort)
+        return sorted(ids_to_sort, key=dict(zip(ids_to_sort, combined)).__getitem__)
@@ -10,6 +10,7 @@
 from collections.abc import Iterable
 from datetime import datetime, timedelta
 
+from calibre.db.columnar import DenseBookMap, intern_values
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
@@ -55,6 +56,14 @@ def c_parse(val):
 class Table:
 
     supports_notes = False
+    # The array typecode used to store values unboxed in book_col_map, see DenseBookMap
+    book_col_typecode = None
+    # If not None, a callable that reads the data for this table, used to
+    # defer reading rarely used tables until their data is first accessed
+    deferred_reader = None
+    # Incremented every time fix_case_duplicates() merges items, which
+    # changes the items of books other than the ones being written
+    case_duplicates_fixed = 0
 
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
@@ -75,6 +84,17 @@ def __init__(self, name, metadata, link_table=None):
                 'books_{}_link'.format(self.metadata['table']))
         if self.supports_notes and dt == 'rating':  # custom ratings table
             self.supports_notes = False
+        if self.unserialize is None and self.table_type == ONE_ONE:
+            self.book_col_typecode = {'int': 'q', 'float': 'd'}.get(dt)
+
+    def __getattr__(self, name):
+        # Only called for attributes that do not exist, which for a table
+        # whose reading has been deferred includes all its data
+        reader = self.deferred_reader
+        if reader is None or name.startswith('__'):
+            raise AttributeError(f'{self.__class__.__name__!r} object has no attribute {name!r}')
+        reader(self)
+        return object.__getattribute__(self, name)
 
     def remove_books(self, book_ids, db):
         return set()
@@ -114,18 +134,20 @@ def read(self, db):
         idcol = 'id' if self.metadata['table'] == 'books' else 'book'
         query = db.execute('SELECT {}, {} FROM {}'.format(idcol,
             self.metadata['column'], self.metadata['table']))
+        tc = self.book_col_typecode
         if self.unserialize is None:
             try:
-                self.book_col_map = dict(query)
+                self.book_col_map = DenseBookMap(tuple(intern_values(query)), tc)
             except UnicodeDecodeError:
                 # The db is damaged, try to work around it by ignoring
                 # failures to decode utf-8
                 query = db.execute('SELECT {}, cast({} as blob) FROM {}'.format(idcol,
                     self.metadata['column'], self.metadata['table']))
-                self.book_col_map = {k:bytes(val).decode('utf-8', 'replace') for k, val in query}
+                self.book_col_map = DenseBookMap(tuple(intern_values(
+                    (k, bytes(val).decode('utf-8', 'replace')) for k, val in query)), tc)
         else:
             us = self.unserialize
-            self.book_col_map = {book_id:us(val) for book_id, val in query}
+            self.book_col_map = DenseBookMap(tuple(intern_values((book_id, us(val)) for book_id, val in query)), tc)
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -146,11 +168,13 @@ def set_path(self, book_id, path, db):
 
 class SizeTable(OneToOneTable):
 
+    book_col_typecode = 'q'
+
     def read(self, db):
         query = db.execute(
             'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
             'WHERE data.book=books.id) FROM books')
-        self.book_col_map = dict(query)
+        self.book_col_map = DenseBookMap(tuple(query), self.book_col_typecode)
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
@@ -210,7 +234,7 @@ def read(self, db):
         self.id_map = {}
         self.link_map = {}
         self.col_book_map = defaultdict(set)
-        self.book_col_map = {}
+        self.book_col_map = DenseBookMap(typecode='q')
         self.read_id_maps(db)
         self.read_maps(db)
 
@@ -224,12 +248,12 @@ def read_id_maps(self, db):
 
     def read_maps(self, db):
         cbm = self.col_book_map
-        bcm = self.book_col_map
-        for book, item_id in db.execute(
+        pairs = tuple(db.execute(
                 'SELECT book, {} FROM {}'.format(
-                    self.metadata['link_column'], self.link_table)):
+                    self.metadata['link_column'], self.link_table)))
+        for book, item_id in pairs:
             cbm[item_id].add(book)
-            bcm[book] = item_id
+        self.book_col_map = DenseBookMap(pairs, 'q')
 
     def fix_link_table(self, db):
         linked_item_ids = set(itervalues(self.book_col_map))
@@ -263,6 +287,7 @@ def fix_case_duplicates(self, db):
                     self.link_table, self.metadata['link_column']),
                     tuple((main_id, x) for x in v))
                 db.delete_category_items(self.name, self.metadata['table'], item_map)
+                self.case_duplicates_fixed += 1
 
     def item_ids_for_names(self, db, item_names: Iterable[str], case_sensitive: bool = False) -> dict[str, int]:
         item_names = tuple(item_names)
@@ -425,7 +450,7 @@ def read_maps(self, db):
             cbm[item_id].add(book)
             bcm[book].append(item_id)
 
-        self.book_col_map = {k:tuple(v) for k, v in iteritems(bcm)}
+        self.book_col_map = DenseBookMap(tuple((k, tuple(v)) for k, v in iteritems(bcm)))
 
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in itervalues(self.book_col_map) for item_id in item_ids}
@@ -573,6 +598,7 @@ def fix_case_duplicates(self, db):
                                 'INSERT INTO {} (book,{}) VALUES (?,?)'.format(self.link_table, self.metadata['link_column']),
                                 tuple((book_id, x) for x in vals))
                 db.delete_category_items(self.name, self.metadata['table'], item_map)
+                self.case_duplicates_fixed += 1
 
 
 class AuthorsTable(ManyToManyTable):
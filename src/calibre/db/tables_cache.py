@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+A persistent, versioned, binary copy of the in-memory tables, stored next to
+metadata.db so that opening a large library does not need to read and process
+every table with SQL. The file is only used if metadata.db has not changed
+since it was written, as determined by the modification time, size and change
+counter of metadata.db and its schema version.
+
+The data is stored using msgpack rather than pickle, so a tables cache file
+copied into a library from elsewhere cannot be used to execute code.
+'''
+
+import os
+import struct
+import sys
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta
+from mmap import ACCESS_READ, mmap
+
+from calibre.db.columnar import DenseBookMap
+from calibre.utils.iso8601 import utc_tz
+
+# Increase this whenever the data stored in the Table classes changes
+TABLES_CACHE_VERSION = 1
+MAGIC = b'calibre-tables\0\0'
+HEADER = struct.Struct('<16sII')
+EPOCH = datetime(1970, 1, 1, tzinfo=utc_tz)
+UTC_DATETIME, DATETIME, SET, FROZENSET, DENSE_BOOK_MAP, DEFAULT_DICT = range(1, 7)
+DEFAULT_FACTORIES = {set: 'set', dict: 'dict', list: 'list'}
+FACTORY_FOR_NAME = {v: k for k, v in DEFAULT_FACTORIES.items()}
+
+
+def db_state_key(dbpath):
+    '''
+    Return a key that changes whenever the contents or schema of the database
+    at dbpath change or None if the state cannot be determined. The caller must
+    hold a read transaction, so that the database cannot be changed while the
+    key is calculated.
+    '''
+    try:
+        wal = os.stat(dbpath + '-wal')
+    except OSError:
+        pass
+    else:
+        if wal.st_size:
+            return None  # changes pending in the write ahead log are not reflected in the main file
+    try:
+        with open(dbpath, 'rb') as f:
+            st = os.fstat(f.fileno())
+            header = f.read(100)
+    except OSError:
+        return None
+    if len(header) < 100 or not header.startswith(b'SQLite format 3\0'):
+        return None
+    # The file change counter, the schema cookie and the user version
+    counter, = struct.unpack_from('>I', header, 24)
+    schema_cookie, = struct.unpack_from('>I', header, 40)
+    user_version, = struct.unpack_from('>I', header, 60)
+    return [TABLES_CACHE_VERSION, sys.byteorder, st.st_mtime_ns, st.st_size, counter, schema_cookie, user_version]
+
+
+def data_attributes(table):
+    ' The names of the attributes of table that contain data read from the database '
+    return tuple(k for k, v in vars(table).items() if k != 'metadata' and isinstance(v, (dict, DenseBookMap)))
+
+
+def is_cacheable(table):
+    # Composite tables have no data in the database
+    return table.metadata.get('datatype') != 'composite'
+
+
+# Serialization {{{
+
+def encoder(obj):
+    import msgpack
+    if type(obj) is tuple:
+        return list(obj)
+    if isinstance(obj, DenseBookMap):
+        data = obj.data.tobytes() if obj.typecode else tuple(obj.data)
+        return msgpack.ExtType(DENSE_BOOK_MAP, dumps((obj.typecode or '', bytes(obj.state), data, tuple(obj.sparse.items()), obj.count)))
+    if isinstance(obj, defaultdict):
+        return msgpack.ExtType(DEFAULT_DICT, dumps((DEFAULT_FACTORIES[obj.default_factory], tuple(obj.items()))))
+    if isinstance(obj, datetime):
+        if obj.tzinfo is utc_tz:
+            return msgpack.ExtType(UTC_DATETIME, struct.pack('<q', (obj - EPOCH) // timedelta(microseconds=1)))
+        return msgpack.ExtType(DATETIME, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, frozenset):
+        return msgpack.ExtType(FROZENSET, dumps(tuple(obj)))
+    if isinstance(obj, set):
+        return msgpack.ExtType(SET, dumps(tuple(obj)))
+    raise TypeError(f'Cannot serialize objects of type {type(obj)}')
+
+
+def dumps(obj):
+    import msgpack
+    # strict_types is needed as otherwise defaultdicts are serialized as dicts
+    return msgpack.packb(obj, default=encoder, use_bin_type=True, strict_types=True)
+
+
+class Decoder:
+
+    def __init__(self):
+        # Share a single instance for identical strings, as intern_values()
+        # does when reading from the database
+        self.pool = {}
+
+    def ext_hook(self, code, data):
+        if code == UTC_DATETIME:
+            return EPOCH + timedelta(microseconds=struct.unpack('<q', data)[0])
+        if code == DATETIME:
+            return datetime.fromisoformat(bytes(data).decode('utf-8'))
+        if code == SET:
+            return set(self.loads(data))
+        if code == FROZENSET:
+            return frozenset(self.loads(data))
+        if code == DENSE_BOOK_MAP:
+            typecode, state, data, sparse, count = self.loads(data)
+            ans = DenseBookMap.__new__(DenseBookMap)
+            ans.typecode = typecode or None
+            if typecode:
+                ans.data = array(typecode)
+                ans.data.frombytes(data)
+            else:
+                pool = self.pool
+                ans.data = [pool.setdefault(x, x) if type(x) is str else x for x in data]
+            ans.state = bytearray(state)
+            ans.sparse = dict(sparse)
+            ans.count = count
+            return ans
+        if code == DEFAULT_DICT:
+            factory, items = self.loads(data)
+            factory = FACTORY_FOR_NAME[factory]
+            ans = defaultdict(factory)
+            for k, v in items:
+                ans[k] = factory(v)
+            return ans
+        raise ValueError(f'Unknown extension type: {code}')
+
+    def loads(self, data):
+        import msgpack
+        return msgpack.unpackb(data, ext_hook=self.ext_hook, raw=False, use_list=False, strict_map_key=False)
+# }}}
+
+
+def save_tables(path, key, tables):
+    '''
+    Write the data in tables, a mapping of field name to Table, to path,
+    atomically. key must be the value of :func:`db_state_key` for the
+    database the tables were read from.
+    '''
+    import msgpack
+    blobs, index, offset = [], {}, 0
+    for name, table in tables.items():
+        if is_cacheable(table):
+            blob = dumps({k: getattr(table, k) for k in data_attributes(table)})
+            index[name] = (table.__class__.__name__, offset, len(blob))
+            blobs.append(blob)
+            offset += len(blob)
+    header = msgpack.packb({'key': key, 'tables': index}, use_bin_type=True)
+    tpath = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tpath, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, TABLES_CACHE_VERSION, len(header)))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tpath, path)
+    except BaseException:
+        try:
+            os.remove(tpath)
+        except OSError:
+            pass
+        raise
+
+
+def read_header(m):
+    import msgpack
+    magic, version, header_size = HEADER.unpack_from(m, 0)
+    if magic != MAGIC or version != TABLES_CACHE_VERSION:
+        return None, 0
+    header = msgpack.unpackb(m[HEADER.size:HEADER.size + header_size], raw=False, use_list=True, strict_map_key=False)
+    return header, HEADER.size + header_size
+
+
+def load_tables(path, key, tables):
+    '''
+    Load the data for tables from path, returning False if the data is missing
+    or stale, in which case tables are not changed. tables can be a subset of
+    the tables that were saved.
+    '''
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return False
+    with f:
+        try:
+            m = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except (OSError, ValueError):  # empty file
+            return False
+        with m:
+            try:
+                header, base = read_header(m)
+                if header is None or header['key'] != key:
+                    return False
+                index = header['tables']
+                wanted = {name for name, table in tables.items() if is_cacheable(table)}
+                if not wanted.issubset(index):
+                    return False
+                decoder, updates = Decoder(), {}
+                with memoryview(m) as mv:
+                    for name in wanted:
+                        class_name, offset, size = index[name]
+                        if class_name != tables[name].__class__.__name__:
+                            return False
+                        updates[name] = decoder.loads(mv[base + offset:base + offset + size])
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                return False
+    for name, attrs in updates.items():
+        table = tables[name]
+        for k, v in attrs.items():
+            setattr(table, k, v)
+    return True
@@ -217,6 +217,79 @@ def test_add_books(self):  # {{{
         self.assertEqual(cache.format(book_id, 'FMT2'), FMT2)
     # }}}
 
+    def test_bulk_import(self):  # {{{
+        'Test adding books with the bulk import pipeline'
+        import json
+        import re
+
+        from calibre.db.adding import BulkImporter
+        from calibre.ptempfile import TemporaryDirectory
+        cache = self.init_cache()
+        num_before = len(cache.all_book_ids())
+        with TemporaryDirectory('bulk-import-test') as tdir:
+            root = os.path.join(tdir, 'root')
+            groups = []
+            for i in range(5):
+                d = os.path.join(root, f'd{i}')
+                os.makedirs(d)
+                path = os.path.join(d, f'Bulk Book {i} - Bulk Author.txt')
+                with open(path, 'wb') as f:
+                    f.write(f'text {i}'.encode())
+                groups.append([path])
+            journal = os.path.join(tdir, 'journal')
+            # Simulate an interrupted import that had already dealt with the
+            # first book
+            with open(journal, 'w') as f:
+                f.write(json.dumps(groups[0]) + '\n')
+            added_ids = set()
+            importer = BulkImporter(cache, journal_path=journal, added_ids=added_ids, max_workers=2)
+            importer.batch_size = 2
+            self.assertFalse(importer(iter(groups)))
+            self.assertFalse(importer.failures)
+            self.assertFalse(os.path.exists(journal))
+            self.assertEqual(len(added_ids), 4)
+            seen = set()
+            for book_id in added_ids:
+                self.assertEqual(cache.formats(book_id), ('TXT',))
+                i = int(re.search(r'Bulk Book (\d)', cache.field_for('title', book_id)).group(1))
+                self.assertEqual(cache.format(book_id, 'TXT'), f'text {i}'.encode())
+                seen.add(i)
+            self.assertEqual(seen, {1, 2, 3, 4})
+            for i in range(5):
+                self.assertTrue(os.path.exists(groups[i][0]))
+            importer = BulkImporter(cache, max_workers=1)
+            dups = importer(iter(groups))
+            self.assertEqual(len(dups), 4)
+            self.assertEqual(len(cache.all_book_ids()), num_before + 5)
+
+            # A worker crash only fails the group that caused it
+            crash = '\n'.join((
+                'import os', 'from calibre.ebooks.metadata.worker import read_metadata',
+                'def run(paths, *args):', '    if "Crash" in paths[0]:', '        os._exit(1)', '    return read_metadata(paths, *args)', ''))
+
+            class CrashingImporter(BulkImporter):
+
+                def submit(self, group_id, formats):
+                    self.in_flight[group_id] = formats
+                    self.pool(group_id, crash, 'run', formats, group_id, self.tdir)
+
+            groups = []
+            for i in range(12):
+                d = os.path.join(root, f'c{i}')
+                os.makedirs(d)
+                path = os.path.join(d, f'{"Crash" if i == 3 else "Other"} Book {i} - Bulk Author.txt')
+                with open(path, 'wb') as f:
+                    f.write(f'text {i}'.encode())
+                groups.append([path])
+            added_ids = set()
+            importer = CrashingImporter(cache, added_ids=added_ids, max_workers=1)
+            importer.batch_size = 2
+            self.assertFalse(importer(iter(groups)))
+            self.assertEqual([formats for formats, details in importer.failures], [groups[3]])
+            self.assertEqual(len(added_ids), 11)
+            self.assertEqual(len(cache.all_book_ids()), num_before + 16)
+    # }}}
+
     def test_remove_books(self):  # {{{
         'Test removal of books'
         cl = self.cloned_library
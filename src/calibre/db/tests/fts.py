@@ -265,6 +265,43 @@ def test_fts_indexing(self):
                 zf.writestr('text.pdf', pdf_data)
             self.assertEqual(extract_text(zip).strip(), 'Hello World')
 
+            # The incomplete text from a failed pdftotext is not used
+            import subprocess
+            from unittest.mock import patch
+
+            def failing_popen(cmd, **kw):
+                return subprocess.Popen([sys.executable, '-c', 'print("partial"); raise SystemExit(1)'], **kw)
+
+            with patch('calibre.ebooks.pdf.pdftohtml.popen', failing_popen):
+                self.assertRaises(ValueError, extract_text, pdf)
+
+            # Test that a single worker process is used for many jobs
+            from queue import Queue
+
+            from calibre.db.fts.pool import Job, Worker, quit
+            jobs_queue, results_queue = Queue(), Queue()
+            w = Worker(jobs_queue, results_queue)
+            w.start()
+            pids = set()
+            for i, data in enumerate((pdf_data, pdf_data, 'not a pdf')):
+                path = os.path.join(tdir, f'job{i}.pdf')
+                with open(path, 'w') as f:
+                    f.write(data)
+                jobs_queue.put(Job(i, 'PDF', path, len(data), '', 0))
+                r = results_queue.get(timeout=60)
+                self.ae(r.book_id, i)
+                if i < 2:
+                    self.assertTrue(r.ok, r.text)
+                    self.ae(r.text.strip(), 'Hello World')
+                else:
+                    self.assertFalse(r.ok)
+                self.assertFalse(os.path.exists(path))
+                pids.add(w.extractor.process.pid)
+            self.ae(len(pids), 1)
+            jobs_queue.put(quit)
+            w.join(10)
+            self.assertIsNone(w.extractor)
+
 
 def find_tests():
     import unittest
@@ -88,6 +88,8 @@ def check(**kw):
             q(tr[0], **kw)
 
         check(id=1, book=1, format='TXT', searchable_text='a test text')
+        # check the format file, which may have been read in place, is left alone
+        self.ae(cache.format(1, 'TXT'), b'a test text')
         # check re-adding does not rescan
         cache.add_format(1, 'TXT', BytesIO(b'a test text'))
         self.wait_for_fts_to_finish(fts)
@@ -123,7 +125,7 @@ def check(**kw):
 
         # check shutdown when workers have hung
         for w in fts.pool.workers:
-            w.code_to_exec = 'import time; time.sleep(100)'
+            w.code_to_exec = w.persistent_code_to_exec = 'import time; time.sleep(100)'
         cache.add_format(1, 'TXTZ', self.make_txtz(b'hung worker'))
         workers = list(fts.pool.workers)
         cache.close()
@@ -142,6 +144,15 @@ def test_fts_search(self):
         self.assertFalse(fts.all_currently_dirty())
         self.ae({x['id'] for x in cache.fts_search('help')}, {1, 2})
         self.ae({x['id'] for x in cache.fts_search('help', restrict_to_book_ids=(1, 3, 4, 5, 11))}, {1})
+        with patch.object(fts, 'max_restriction_in_query', 2):
+            self.ae({x['id'] for x in cache.fts_search('help', restrict_to_book_ids=(1, 3, 4, 5, 11))}, {1})
+            self.ae([x['id'] for x in cache.fts_search('help', restrict_to_book_ids=(1, 2, 3), offset=1)], [x['id'] for x in cache.fts_search('help')][1:])
+            self.ae([x['text'] for x in cache.fts_search('also', highlight_start='[', highlight_end=']', snippet_size=3, restrict_to_book_ids=(1, 2, 3))], [
+                '…will [also] help…'])
+        all_results = [x['id'] for x in cache.fts_search('help')]
+        self.ae([x['id'] for x in cache.fts_search('help', limit=1)], all_results[:1])
+        self.ae([x['id'] for x in cache.fts_search('help', limit=1, offset=1)], all_results[1:2])
+        self.ae([x['id'] for x in cache.fts_search('help', offset=2)], [])
         self.ae({x['format'] for x in cache.fts_search('help')}, {'TXT', 'MD'})
         self.ae({x['id'] for x in cache.fts_search('also')}, {2})
         self.ae({x['text'] for x in cache.fts_search('also', highlight_start='[', highlight_end=']')}, {
@@ -192,6 +203,56 @@ def test_fts_triggers(self):
         cache.reindex_fts_book(2)
         self.ae(fts.all_currently_dirty(), [(2, 'ADDED')])
 
+    def test_fts_batched_commit(self):
+        cache = self.init_cache()
+        cache.queue_next_fts_job = lambda *a: None
+        fts = cache.enable_fts(start_pool=False)
+        self.ae(fts.all_currently_dirty(), [(1, 'FMT1'), (1, 'FMT2'), (2, 'FMT1')])
+        fts.commit_results((
+            (1, 'FMT1', 10, 'h1', 'some batched text', ''),
+            (1, 'FMT2', 10, 'h2', '', 'failed'),
+            (2, 'FMT1', 10, 'h3', 'more batched text', ''),
+        ))
+        self.assertFalse(fts.all_currently_dirty())
+        self.ae({(r['book'], r['format'], r['err_msg']) for r in self.text_records(fts)}, {(1, 'FMT1', ''), (1, 'FMT2', 'failed'), (2, 'FMT1', '')})
+        for i in range(3, 12):
+            fts.commit_results(((1, 'FMT1', 10 + i, f'h{i}', f'batch number {i}', ''),))
+        while fts.merge_segments(pages=1):
+            pass
+        self.ae({x['book_id'] for x in cache.fts_search('batched')}, {2})
+        self.ae({x['book_id'] for x in cache.fts_search('number')}, {1})
+
+    def test_fts_shared_text(self):
+        cache = self.init_cache()
+        cache.queue_next_fts_job = lambda *a: None
+        fts = cache.enable_fts(start_pool=False)
+        fts.commit_results((
+            (1, 'FMT1', 10, 'h1', 'the same  text', ''),
+            (1, 'FMT2', 10, 'h2', 'the same text\n', ''),
+            (2, 'FMT1', 10, 'h3', 'the same text', ''),
+        ))
+
+        def stored():
+            return {(r['book'], r['format']): r['searchable_text'] for r in self.text_records(fts)}
+
+        def found(query='same', **kw):
+            return {(x['book_id'], x['format']) for x in cache.fts_search(query, **kw)}
+
+        self.ae(len([t for t in stored().values() if t]), 1)
+        self.ae(found(), {(1, 'FMT1'), (1, 'FMT2'), (2, 'FMT1')})
+        self.ae(found(restrict_to_book_ids={2}), {(2, 'FMT1')})
+        self.ae(fts.indexed_formats(1), {'FMT1', 'FMT2'})
+        # removing the format that has the text moves it to one that refers to it
+        cache.remove_formats({1: ['FMT1']})
+        self.ae(len([t for t in stored().values() if t]), 1)
+        self.ae(found(), {(1, 'FMT2'), (2, 'FMT1')})
+        # as does replacing its text
+        owner = next(k for k, t in stored().items() if t)
+        other = ({(1, 'FMT2'), (2, 'FMT1')} - {owner}).pop()
+        fts.commit_result(*owner, 10, 'h4', 'different text')
+        self.ae(found(), {other})
+        self.ae(found('different'), {owner})
+
     def test_fts_to_text(self):
         from calibre.ebooks.oeb.polish.parsing import parse
         html = '''
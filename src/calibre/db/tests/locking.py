@@ -6,9 +6,9 @@
 
 import random
 import time
-from threading import Thread
+from threading import Event, Thread
 
-from calibre.db.locking import LockingError, RWLockWrapper, SHLock
+from calibre.db.locking import LockingError, RWLockWrapper, SHLock, VersionedSnapshots, create_locks
 from calibre.db.tests.base import BaseTest
 
 
@@ -192,6 +192,114 @@ def lots_of_acquires():
         self.assertFalse(lock.is_shared)
         self.assertFalse(lock.is_exclusive)
 
+    def test_versioned_snapshots(self):
+        data = {'a': 1, 'b': 1}
+        calls = []
+
+        def create_snapshot(previous, changed):
+            calls.append(changed)
+            if previous is None or changed is None:
+                return dict(data)
+            return {k: (data[k] if k in changed else previous[k]) for k in data}
+
+        snapshots = VersionedSnapshots(None, create_snapshot)
+        read_lock, write_lock = create_locks(on_write=snapshots.invalidate)
+        snapshots.read_lock = read_lock
+        s1 = snapshots.get()
+        self.assertEqual(s1, data)
+        self.assertIs(s1, snapshots.get())
+        self.assertEqual(calls, [None])
+        with write_lock:
+            data['a'] = 2
+            self.assertIsNone(snapshots.get(), 'writer did not get the live data')
+        s2 = snapshots.get()
+        self.assertEqual(s2, {'a': 2, 'b': 1})
+        self.assertEqual(calls[-1], None)
+        self.assertEqual(snapshots.version, 2)
+
+        # Writes using a lock that does not invalidate specify the changed keys
+        tracked = write_lock.variant()
+        with tracked:
+            data['b'] = 2
+            snapshots.invalidate(('b',))
+        self.assertEqual(snapshots.get(), data)
+        self.assertEqual(calls[-1], {'b'})
+
+        # Readers must not wait for writers, but must get the previous
+        # version until the writer is done
+        current = snapshots.get()
+        writing, finish, results = Event(), Event(), []
+
+        def writer():
+            with write_lock:
+                data['a'] = 3
+                writing.set()
+                finish.wait(10)
+
+        def reader():
+            results.append(snapshots.get())
+
+        w = Thread(target=writer, daemon=True)
+        w.start()
+        writing.wait(10)
+        r = Thread(target=reader, daemon=True)
+        r.start()
+        r.join(2)
+        self.assertFalse(r.is_alive(), 'Reader blocked behind writer')
+        self.assertIs(results[0], current)
+        finish.set()
+        w.join(2)
+        self.assertEqual(snapshots.get(), {'a': 3, 'b': 2})
+
+
+def benchmark_contention(num_of_readers=10, duration=5, write_interval=0.005, write_duration=0.002, read_duration=0.0002):
+    '''
+    Measure how long readers wait for the lock when a writer is constantly
+    queueing writes, as happens in the Content server, with and without
+    snapshot reads. Run with:
+
+    calibre-debug -c "from calibre.db.tests.locking import *; benchmark_contention()"
+    '''
+    def run(use_snapshots):
+        snapshots = VersionedSnapshots(None, lambda previous, changed: object())
+        read_lock, write_lock = create_locks(on_write=snapshots.invalidate)
+        snapshots.read_lock = read_lock
+        stop_at = time.monotonic() + duration
+        waits = []
+
+        def reader():
+            ans = []
+            while time.monotonic() < stop_at:
+                st = time.perf_counter()
+                if use_snapshots:
+                    snapshots.get()
+                    ans.append(time.perf_counter() - st)
+                    wait_for(read_duration)
+                else:
+                    with read_lock:
+                        ans.append(time.perf_counter() - st)
+                        wait_for(read_duration)
+            waits.extend(ans)
+
+        def writer():
+            while time.monotonic() < stop_at:
+                with write_lock:
+                    wait_for(write_duration)
+                time.sleep(write_interval)
+
+        threads = [Thread(target=reader) for i in range(num_of_readers)] + [Thread(target=writer)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        waits.sort()
+        return len(waits), waits[len(waits) // 2], waits[int(len(waits) * 0.99)], waits[-1]
+
+    for use_snapshots in (False, True):
+        count, median, p99, worst = run(use_snapshots)
+        print('Snapshot reads:' if use_snapshots else 'Shared lock reads:', f'{count} reads in {duration} seconds',
+              f'wait median: {median * 1e6:.1f}us p99: {p99 * 1e6:.1f}us max: {worst * 1e6:.1f}us')
+
 
 def find_tests():
     import unittest
@@ -40,5 +40,41 @@ def main():
     print('Stats saved to', stats)
 
 
+def benchmark_sorting(path='~/test library', repeat=5):
+    ' Compare sorting via View.multisort with and without the sort index '
+    from time import monotonic
+    initdb(path)
+    cache, view = db.new_api, db.data
+    sorts = ([('title', True)], [('authors', True), ('series', True)], [('timestamp', False), ('rating', False), ('title', True)])
+
+    def timed(use_sort_index):
+        orig = cache.multisort
+
+        def multisort(*a, **kw):
+            kw['use_sort_index'] = use_sort_index
+            return orig(*a, **kw)
+        cache.multisort = multisort
+        try:
+            ans = []
+            for fields in sorts:
+                st = monotonic()
+                for i in range(repeat):
+                    view.multisort(fields)
+                ans.append((monotonic() - st) / repeat)
+            return ans
+        finally:
+            cache.multisort = orig
+
+    print('Sorting', len(cache.all_book_ids()), 'books')
+    cache.sort_index.invalidate()
+    without = timed(False)
+    st = monotonic()
+    timed(True)
+    print(f'First run, including building the sort index, took: {monotonic() - st:.3f} seconds')
+    with_index = timed(True)
+    for fields, a, b in zip(sorts, without, with_index):
+        print(f'{fields}: without index: {a:.4f}s with index: {b:.4f}s speedup: {a / max(b, 1e-9):.1f}x')
+
+
 if __name__ == '__main__':
     main()
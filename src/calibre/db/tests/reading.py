@@ -218,6 +218,19 @@ def test_sorting(self):  # {{{
         ae(list(range(1, 11)), cache.multisort([('#one', True), ('#two', True)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([4, 5, 1, 2, 3, 7, 8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
+
+        # Test that the sort index gives the same results as comparing sort
+        # keys and is updated when books change
+        def check_sort_index(*fields):
+            ids = sorted(cache.all_book_ids())
+            ae(cache.multisort(fields, ids_to_sort=ids, use_sort_index=False), cache.multisort(fields, ids_to_sort=ids))
+        for fields in ((('title', True),), (('#one', False), ('title', True)), (('series', True), ('authors', False), ('id', True))):
+            check_sort_index(*fields)
+        cache.set_field('#one', {1:7, 6:-1})
+        cache.set_field('title', {2:'zzz', 3:'title0'})
+        check_sort_index(('#one', False), ('title', True))
+        ae(cache.multisort([('title', False)])[0], 2)
+        ae(cache.multisort([('#one', True)])[0], 6)
     # }}}
 
     def test_get_metadata(self):  # {{{
@@ -383,6 +396,19 @@ def test_searching(self):  # {{{
         # Note that the old db searched uuid for un-prefixed searches, the new
         # db does not, for performance
 
+        # Test the inverted index used for text searches on many-one and many-many fields
+        cache.set_field('tags', {1: ('A.B', 'News'), 2: ('a.bc',), 3: ('Tag Two',)})
+        self.assertEqual(cache.search('tags:"=.a"'), {1, 2})
+        self.assertEqual(cache.search('tags:"=.a.b"'), {1})
+        self.assertEqual(cache.search('tags:"=news"'), {1})
+        self.assertEqual(cache.search('tags:b.c'), {2})
+        self.assertEqual(cache.search('tags:"=news"', book_ids={2, 3}), set())
+        cache.rename_items('tags', {cache.get_item_id('tags', 'News'): 'Old News'})
+        self.assertEqual(cache.search('tags:"=news"'), set())
+        self.assertEqual(cache.search('tags:"=old news"'), {1})
+        cache.set_field('tags', {3: ('a.b.c',)})
+        self.assertEqual(cache.search('tags:"=.a.b"'), {1, 3})
+
     # }}}
 
     def test_get_categories(self):  # {{{
@@ -546,18 +572,29 @@ def test_restrictions(self):  # {{{
         se({1,2}, cache.books_in_virtual_library('12'))
         se({1}, cache.books_in_virtual_library('12', 'id:1'))
         se({2}, cache.books_in_virtual_library('1', 'id:1 or id:2'))
+        from calibre.db.bitmap import Bitmap
+        for i in range(2):  # second time round results come from the cache
+            b = cache.books_in_virtual_library('12', 'not id:1', as_bitmap=True)
+            self.assertIsInstance(b, Bitmap)
+            se({2}, b)
+            b = cache.search('', 'id:1 or id:3', as_bitmap=True)
+            self.assertIsInstance(b, Bitmap)
+            se({1, 3}, b)
+            se({3}, cache.search('', 'id:1 or id:3', book_ids={2, 3}))
+            se({3}, cache.search('not id:1', 'id:1 or id:3'))
+            se({2}, cache.search('vl:12 and not id:1'))
     # }}}
 
     def test_search_caching(self):  # {{{
         ' Test caching of searches '
-        from calibre.db.search import LRUCache
+        from calibre.db.search import ResultCache
 
-        class TestCache(LRUCache):
+        class TestCache(ResultCache):
             hit_counter = 0
             miss_counter = 0
 
-            def get(self, key, default=None):
-                ans = LRUCache.get(self, key, default=default)
+            def get(self, key, default=None, frozen=False):
+                ans = ResultCache.get(self, key, default=default, frozen=frozen)
                 if ans is not None:
                     self.hit_counter += 1
                 else:
@@ -586,6 +623,11 @@ def test(hit, result, *args, **kw):
         test(False, {3}, 'Unknown')
         test(True, {3}, 'Unknown')
         test(True, {3}, 'Unknown')
+        # Cached results can be changed by callers without affecting the cache
+        r = cache.search('Unknown')
+        self.assertIs(type(r), set)
+        r.discard(3)
+        test(True, {3}, 'Unknown')
         cache._search_api.MAX_CACHE_UPDATE = 0
         cache.set_field('title', {3:'xxx'})
         test(False, {3}, 'Unknown')  # cache cleared
@@ -602,6 +644,30 @@ def test(hit, result, *args, **kw):
         cache.set_field('publisher', {3:'ppppp', 2:'other'})
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+
+        # Test that only cached searches that depend on a changed field are invalidated
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        test(False, {3}, 'publisher:ppppp')
+        cache.set_field('tags', {1:('x',)})
+        test(True, {3}, 'publisher:ppppp')
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        cache.set_field('publisher', {1:'ppppp'})
+        test(False, {1, 3}, 'publisher:ppppp')
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        # Test that searches relative to today are cached till the end of the day
+        cache.search('date:>10daysago')
+        self.assertIsNotNone(c.item_map['date:>10daysago'].expires)
+        self.assertIsNone(c.item_map['publisher:ppppp'].expires)
+        # Test that cached results are decoded into sets only once
+        r = ResultCache()
+        r.add('q', {1, 2})
+        f = r.get('q', frozen=True)
+        ae(frozenset({1, 2}), f)
+        self.assertIs(f, r.get('q', frozen=True))
+        r.set_result('q', {3})
+        ae(frozenset({3}), r.get('q', frozen=True))
+        r.pop('q')
+        ae(0, r.memory_used)
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -711,6 +777,49 @@ def f(x):
 
     # }}}
 
+    def test_metadata_frame(self):  # {{{
+        ' Test reading metadata for many books at once '
+        from calibre.db.lazy import BatchProxyMetadata
+        from calibre.ebooks.metadata.book.base import STANDARD_METADATA_FIELDS
+        cache = self.init_cache()
+        cache.create_custom_column('comp', 'comp', 'composite', True, display={'composite_template':'{title},{#tags},{tags}'})
+        cache.close()
+        cache = self.init_cache()
+        book_ids = sorted(cache.all_book_ids()) + [1000]
+        fields = [f for f in cache.fields if f != 'ondevice'] + ['nosuchfield']
+        frame = cache.metadata_frame(book_ids, fields)
+        self.assertEqual(len(frame), len(book_ids))
+        self.assertEqual(frame.fields, tuple(fields))
+        self.assertNotIn(1000, frame)
+        cache.clear_caches()
+        for field in fields:
+            self.assertEqual(frame.column_map(field), {book_id: cache.field_for(field, book_id) for book_id in book_ids}, f'The field {field} is not the same')
+        self.assertEqual(frame.row(1)['title'], cache.field_for('title', 1))
+        self.assertEqual(frame.value('#tags', 2), cache.field_for('#tags', 2))
+
+        # Prefetched ProxyMetadata must be the same as ProxyMetadata that reads on demand
+        book_ids = book_ids[:-1]
+        get_metadata = BatchProxyMetadata(cache)
+        with cache.safe_read_lock:
+            get_metadata.prefetch(book_ids, list(STANDARD_METADATA_FIELDS) + fields)
+        for book_id in book_ids:
+            pmi, ppmi = cache.get_proxy_metadata(book_id), get_metadata(book_id)
+            for field in STANDARD_METADATA_FIELDS | set(cache.field_metadata.custom_field_keys()):
+                self.assertEqual(getattr(pmi, field), getattr(ppmi, field), f'The field {field} is not the same for book {book_id}')
+
+        # Composite columns used for sorting, searching and categories
+        cache.clear_caches()
+        sk = cache.fields['#comp'].sort_keys_for_books(cache.get_proxy_metadata, None)
+        expected = sorted(book_ids, key=sk)
+        cache.clear_caches()
+        self.assertEqual(cache.multisort([('#comp', True)]), expected)
+        cache.clear_caches()
+        self.assertEqual(cache.search('#comp:"=Title One"'), {1})
+        cache.clear_caches()
+        cats = {t.name: t.count for t in cache.get_categories()['#comp']}
+        self.assertEqual(cats['Title One'], 1)
+    # }}}
+
     def test_marked_field(self):  # {{{
         ' Test the marked field '
         db = self.init_legacy()
@@ -770,6 +879,72 @@ def test_composites(self):  # {{{
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
     # }}}
 
+    def test_composite_dependencies(self):  # {{{
+        ' Test compiled templates and that composite columns are only re-rendered when a field they read changes '
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        cache = self.init_cache()
+        cache.create_custom_column('ccpub', 'CC1', 'composite', False, display={'composite_template': 'program: uppercase($publisher)'})
+        cache.create_custom_column('ccnest', 'CC2', 'composite', False, display={'composite_template': "program: $#ccpub & ':' & $#tags"})
+        cache.create_custom_column('ccday', 'CC3', 'composite', False, display={'composite_template': 'program: if today() then $title fi'})
+        cache = self.init_cache()
+        cache.set_field('publisher', {1:'P', 2:'P', 3:'Q'})
+        book_ids = tuple(cache.all_book_ids())
+        names = ('#ccpub', '#ccnest', '#ccday')
+
+        def rendered(name):
+            return set(cache.fields[name]._render_cache)
+
+        def check():
+            frame = cache.metadata_frame(book_ids, names + ('publisher', '#tags', 'title'))
+            for book_id in book_ids:
+                row = frame.row(book_id)
+                self.assertEqual(row['#ccpub'], row['publisher'].upper())
+                self.assertEqual(row['#ccnest'], row['#ccpub'] + ':' + ', '.join(row['#tags'] or ()))
+                self.assertEqual(row['#ccday'], row['title'])
+                self.assertEqual(row['#ccnest'], cache.get_metadata(book_id).get('#ccnest'))
+
+        check()
+        cache.set_field('title', {1:'changed'})
+        self.assertEqual(rendered('#ccpub'), set(book_ids))
+        self.assertEqual(rendered('#ccnest'), set(book_ids))
+        self.assertNotIn(1, rendered('#ccday'))
+        check()
+        cache.set_field('#tags', {2:'x, y'})
+        self.assertEqual(rendered('#ccpub'), set(book_ids))
+        self.assertNotIn(2, rendered('#ccnest'))
+        check()
+        # Books with the same publisher share the rendered value
+        hits = cache.fields['#ccpub']._template_state.hits
+        cache.set_field('publisher', {1:'Q'})
+        self.assertNotIn(1, rendered('#ccpub'))
+        self.assertNotIn(1, rendered('#ccnest'))
+        self.assertEqual(cache.field_for('#ccpub', 1), 'Q')
+        self.assertEqual(cache.fields['#ccpub']._template_state.hits, hits + 1)
+        check()
+
+        # Compiled templates give the same results as interpreted ones
+        mi = cache.get_proxy_metadata(1)
+        for template in (
+            'program: a = 3; b = 4; a + b * 2',
+            "program: if $tags inlist 'news' then 'yes' elif $#ccpub == 'q' then 'pub' else 'no' fi",
+            "program: strcat($title, ' - ', $series, field('series_index'))",
+            "program: first_non_empty($#comments, $publisher, 'x')",
+            "program: switch_if($rating >=# 3, 'good', $rating <# 2, 'bad', 'meh')",
+            "program: !($title == 'abc') && ('' || 1)",
+            "program: x = ''; for t in $tags: if t == 'b' then break fi; x = x & t rof; x",
+            'program: undefined_variable',
+            'program: 1 / 0',
+            "program: 'a' + 2",
+            'program: return 5; 6',
+        ):
+            interpreted = SafeFormat().safe_format(template, mi, 'TEMPLATE ERROR', mi)
+            template_cache = {}
+            for i in range(2):
+                self.assertEqual(interpreted, SafeFormat().safe_format(
+                    template, mi, 'TEMPLATE ERROR', mi, column_name='test', template_cache=template_cache), template)
+            self.assertIn('test::compiled', template_cache)
+    # }}}
+
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
         from calibre.db.utils import find_identical_books
@@ -790,6 +965,23 @@ def test_find_identical_books(self):  # {{{
         ):
             self.assertEqual(books, cache.find_identical_books(mi))
             self.assertEqual(books, find_identical_books(mi, data))
+
+        # Test that the duplicate index is kept up to date
+        cache.set_field('title', {2: 'Changed Title'})
+        self.assertFalse(cache.find_identical_books(Metadata('title one', ['author one'])))
+        self.assertEqual({2}, cache.find_identical_books(Metadata('changed: title', ['Author One'])))
+        self.assertTrue(cache.has_book(Metadata('CHANGED TITLE')))
+        self.assertFalse(cache.has_book(Metadata('title one')))
+        book_id = cache.create_book_entry(Metadata('Changed Title', ['author one', 'author two']))
+        self.assertEqual({2, book_id}, cache.find_identical_books(Metadata('changed: title', ['Author One'])))
+        self.assertEqual({book_id}, cache.find_identical_books(Metadata('changed: title', ['Author One']), book_ids={book_id, 3}))
+        self.assertIsNone(cache.create_book_entry(Metadata('changed title'), add_duplicates=False))
+        cache.set_field('identifiers', {book_id: {'isbn': '9780316225205'}})
+        self.assertEqual({book_id}, cache.books_with_identifier('ISBN', '9780316225205'))
+        cache.remove_books((2, book_id))
+        self.assertFalse(cache.find_identical_books(Metadata('changed: title', ['Author One'])))
+        self.assertFalse(cache.books_with_identifier('isbn', '9780316225205'))
+        self.assertFalse(cache.has_book(Metadata('changed title')))
     # }}}
 
     def test_last_read_positions(self):  # {{{
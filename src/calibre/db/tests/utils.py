@@ -81,3 +81,41 @@ def test_thumbnail_cache(self):  # {{{
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), (os.path.join(c.location, 'version'),))
     # }}}
+
+    def test_dense_book_map(self):  # {{{
+        ' Test the array backed book_id -> value map used by tables '
+        from calibre.db.columnar import DenseBookMap
+        m = DenseBookMap(((1, 1.5), (3, None), (2, 2.0)), typecode='d')
+        self.assertEqual(m.typecode, 'd')
+        self.assertEqual(list(m), [1, 2, 3])
+        self.assertIsNone(m[3])
+        self.assertNotIn(4, m)
+        self.assertRaises(KeyError, m.__getitem__, 4)
+        m[10**9] = 7.0
+        self.assertEqual(m[10**9], 7.0)
+        m[4] = 'x'
+        self.assertIsNone(m.typecode, 'storing a str did not switch to object storage')
+        self.assertEqual(m.copy(), {1: 1.5, 2: 2.0, 3: None, 4: 'x', 10**9: 7.0})
+        self.assertEqual(m.pop(2), 2.0)
+        self.assertIsNone(m.pop(2, None))
+        del m[10**9]
+        self.assertEqual(len(m), 3)
+        self.assertEqual(dict(m.items()), {1: 1.5, 3: None, 4: 'x'})
+        m.clear()
+        self.assertFalse(m)
+
+        # Keys that were too large for the arrays are moved into them, when the arrays grow past them
+        big = 5000
+        m = DenseBookMap(typecode='q')
+        m[big] = -1
+        for i in range(big):
+            m[i] = i
+        self.assertIn(big, m)
+        self.assertEqual(m.get(big), -1)
+        self.assertEqual(m[big], -1)
+        self.assertFalse(m.sparse)
+        m[big] = -2
+        self.assertEqual(len(m), big + 1)
+        self.assertEqual(list(m), list(range(big + 1)))
+        self.assertEqual(dict(m.items())[big], -2)
+    # }}}
@@ -362,10 +362,30 @@ def test_backup(self):  # {{{
                 mb.join(2)
                 count -= 1
             af(cache.dirty_queue_length())
+            stats = mb.stats()
+            ae(stats['queue_depth'], 0)
+            self.assertGreaterEqual(stats['written'], 3)
+            ae(stats['failed'], 0)
         finally:
             mb.stop()
         mb.join(2)
         af(mb.is_alive())
+        # Backups are written without holding the lock, except for books
+        # whose folder is missing
+        orig_write_backup, calls = cache.backend.write_backup, []
+
+        def write_backup(path, raw, create_dirs=True):
+            calls.append((path, create_dirs, cache.write_lock.owns_lock()))
+            if not create_dirs and path == cache.field_for('path', 2).replace('/', os.sep):
+                raise FileNotFoundError(path)
+            return orig_write_backup(path, raw, create_dirs=create_dirs)
+        cache.backend.write_backup = write_backup
+        try:
+            raw_map = {book_id: cache.read_backup(book_id) for book_id in (1, 2)}
+            ae(cache.write_backups(raw_map, max_workers=1), set())
+        finally:
+            del cache.backend.write_backup
+        ae([c[1:] for c in calls], [(False, False), (False, False), (True, True)])
         from calibre.ebooks.metadata.opf2 import OPF
         book_ids = (1,2,3)
 
@@ -727,6 +747,265 @@ def test_invalidate():
         test_invalidate()
     # }}}
 
+    def test_read_snapshot(self):  # {{{
+        ' Test reading from immutable snapshots of the cache '
+        from threading import Event, Thread
+
+        from calibre.db.locking import LockingError
+        cache = self.init_cache()
+        snap = cache.read_snapshot()
+        self.assertTrue(snap.is_read_snapshot)
+        self.assertIs(snap, cache.read_snapshot())
+        self.assertIs(snap, snap.read_snapshot())
+        old_title = cache.field_for('title', 1)
+        for field in ('title', 'authors', 'tags', 'series', 'formats', 'identifiers'):
+            for book_id in cache.all_book_ids():
+                self.assertEqual(cache.field_for(field, book_id), snap.field_for(field, book_id))
+        self.assertRaises(LockingError, snap.set_field, 'title', {1:'x'})
+        self.assertRaises(LockingError, snap.update_last_modified, (1,))
+        self.assertEqual(old_title, cache.field_for('title', 1))
+
+        # Changes that do not affect the in-memory tables do not need a new version
+        cache.set_last_read_position(1, 'EPUB', cfi='epubcfi(/1)')
+        self.assertIs(snap, cache.read_snapshot())
+
+        # Only changed tables are copied
+        cache.set_field('title', {1:'changed'})
+        self.assertEqual(old_title, snap.field_for('title', 1))
+        s2 = cache.read_snapshot()
+        self.assertIsNot(s2, snap)
+        self.assertEqual('changed', s2.field_for('title', 1))
+        self.assertIs(s2.fields['tags'], snap.fields['tags'])
+        self.assertIsNot(s2.fields['title'], snap.fields['title'])
+        self.assertIs(s2.fields['title'].title_sort_field, s2.fields['sort'])
+        self.assertEqual({1}, s2.search('title:changed'))
+        self.assertEqual(set(), snap.search('title:changed'))
+        self.assertEqual(cache.multisort([('title', True)]), s2.multisort([('title', True)]))
+
+        # Changes made with the write lock held invalidate everything
+        with cache.write_lock:
+            cache._set_field('tags', {1:('snap1', 'snap2')})
+            self.assertIs(cache, cache.read_snapshot())
+        s3 = cache.read_snapshot()
+        self.assertIsNot(s3.fields['tags'], s2.fields['tags'])
+        self.assertEqual(('snap1', 'snap2'), s3.field_for('tags', 1))
+        self.assertNotEqual(('snap1', 'snap2'), s2.field_for('tags', 1))
+
+        # Readers do not wait for writers
+        writing, finish, results = Event(), Event(), []
+
+        def writer():
+            with cache.write_lock:
+                cache._set_field('title', {2:'changed again'})
+                writing.set()
+                finish.wait(10)
+
+        def reader():
+            s = cache.read_snapshot()
+            results.append((s, s.field_for('title', 2)))
+
+        w = Thread(target=writer, daemon=True)
+        w.start()
+        writing.wait(10)
+        r = Thread(target=reader, daemon=True)
+        r.start()
+        r.join(2)
+        self.assertFalse(r.is_alive(), 'Reading from a snapshot blocked behind a writer')
+        self.assertIs(s3, results[0][0])
+        self.assertNotEqual('changed again', results[0][1])
+        # But reads that are not from the in-memory tables do
+        r = Thread(target=lambda: results.append(s3.format_abspath(1, 'FMT1')), daemon=True)
+        r.start()
+        r.join(0.2)
+        self.assertTrue(r.is_alive(), 'Reading a format from a snapshot did not wait for the writer')
+        finish.set()
+        w.join(2)
+        r.join(2)
+        self.assertFalse(r.is_alive())
+        self.assertEqual(cache.format_abspath(1, 'FMT1'), results[1])
+        self.assertEqual('changed again', cache.read_snapshot().field_for('title', 2))
+        cache.remove_books((1,))
+        self.assertEqual(cache.all_book_ids(), cache.read_snapshot().all_book_ids())
+    # }}}
+
+    def test_tables_cache(self):  # {{{
+        ' Test the on disk cache of the in-memory tables '
+        cache = self.init_cache()
+        cache.create_custom_column('mult', 'CC1', 'text', True)
+        cache.create_custom_column('ser', 'CC2', 'series', False)
+        cache.close()
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_read_from_cache)
+        self.assertTrue(os.path.exists(cache.backend.tables_cache_path))
+        cache.set_field('#mult', {1:('a', 'b'), 2:('b',)})
+        cache.set_field('#ser', {1:'s [3]'})
+        cache.set_field('pubdate', {2:UNDEFINED_DATE})
+
+        def all_data(cache):
+            return {field: {book_id: cache.field_for(field, book_id) for book_id in cache.all_book_ids()} for field in cache.fields if field != 'ondevice'}
+
+        before = all_data(cache)
+        cache.close()
+        # Changes made by this process make the cache stale, it is rebuilt on the next open
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_read_from_cache)
+        self.assertEqual(before, all_data(cache))
+        cache.close()
+        cache = self.init_cache()
+        self.assertTrue(cache.backend.tables_read_from_cache)
+        self.assertEqual(before, all_data(cache))
+        self.assertEqual(cache.fields['formats'].table.fname_map, cache.backend.tables['formats'].fname_map)
+        self.assertEqual(('a', 'b'), cache.field_for('#mult', 1))
+        self.assertEqual(3, cache.field_for('#ser_index', 1))
+        cache.set_field('title', {1:'cached'})
+        self.assertEqual('cached', cache.field_for('title', 1))
+
+        # Changes made by other connections make the cache stale
+        other = self.init_cache()
+        other.backend.tables_cache_path = None
+        other.set_field('title', {1:'changed'})
+        other.close()
+        cache.close()
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_read_from_cache)
+        self.assertEqual('changed', cache.field_for('title', 1))
+        cache.close()
+        cache = self.init_cache()
+        self.assertTrue(cache.backend.tables_read_from_cache)
+        self.assertEqual('changed', cache.field_for('title', 1))
+
+        # Changes made with SQL on the same connection are never lost
+        cache.backend.execute('UPDATE books SET title="raw" WHERE id=1')
+        cache.close()
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_read_from_cache)
+        self.assertEqual('raw', cache.field_for('title', 1))
+
+        # A corrupted cache is ignored
+        cache.close()
+        with open(cache.backend.tables_cache_path, 'r+b') as f:
+            f.truncate(50)
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_read_from_cache)
+        self.assertEqual(before['authors'], all_data(cache)['authors'])
+    # }}}
+
+    def test_deferred_tables(self):  # {{{
+        ' Test reading the tables for custom columns on first use '
+        from threading import Thread
+        from unittest.mock import patch
+
+        from calibre.db.tables import ManyToManyTable
+        cache = self.init_cache()
+        cache.set_field('#tags', {1:('x', 'y')})
+
+        def all_data(cache):
+            return {field: {book_id: cache.field_for(field, book_id) for book_id in cache.all_book_ids()} for field in cache.fields if field != 'ondevice'}
+
+        expected = all_data(cache)
+        cache.close()
+        self.init_cache().close()  # rebuild the tables cache
+        for use_tables_cache in (True, False):
+            cache = self.init_cache()
+            if not use_tables_cache:
+                cache.backend.tables_cache_path = None
+            tables = cache.backend.tables
+            deferred = {name for name, table in tables.items() if table.deferred_reader is not None}
+            self.assertIn('#tags', deferred)
+            self.assertIn('#series_index', deferred)
+            self.assertFalse({name for name in deferred if not name.startswith('#')})
+            # Only the tables that are used are read
+            self.assertEqual(expected['#rating'][1], cache.field_for('#rating', 1))
+            self.assertIsNone(tables['#rating'].deferred_reader)
+            self.assertIsNotNone(tables['#tags'].deferred_reader)
+            self.assertIn('#tags', cache.fields)
+            # Concurrent readers see the table read exactly once
+            reads, results, orig = [], [], ManyToManyTable.read
+
+            def read(self, db):
+                reads.append(self.name)
+                return orig(self, db)
+
+            threads = [Thread(target=lambda: results.append(cache.field_for('#tags', 1))) for i in range(8)]
+            with patch.object(ManyToManyTable, 'read', read):
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            self.assertEqual(results, [('x', 'y')] * len(threads))
+            self.assertEqual(reads, [] if use_tables_cache else ['#tags'])
+            self.assertEqual(expected, all_data(cache))
+            self.assertFalse({name for name, table in tables.items() if table.deferred_reader is not None})
+            cache.close()
+
+        # Deferred tables have the same state of the database as the other tables
+        cache = self.init_cache()
+        self.assertTrue(cache.backend.tables_read_from_cache)
+        other = self.init_cache()
+        other.backend.tables_cache_path = None
+        other.set_field('#tags', {1:('changed',)})
+        other.close()
+        self.assertEqual(('x', 'y'), cache.field_for('#tags', 1))
+        cache.reload_from_db()
+        self.assertEqual(('changed',), cache.field_for('#tags', 1))
+        cache.close()
+    # }}}
+
+    def test_category_cache(self):  # {{{
+        ' Test that the cached Tag Browser categories are updated when books change '
+        cache = self.init_cache()
+        scopes = (None, frozenset({1, 2}))
+
+        def summary(categories):
+            return {
+                c: sorted((repr(t.name), repr(t.id), t.count, sorted(t.id_set), t.avg_rating, repr(t.sort)) for t in tags)
+                for c, tags in categories.items()}
+
+        def check():
+            for book_ids in scopes:
+                cached = summary(cache.get_categories(book_ids=book_ids))
+                cache.category_cache.invalidate()
+                self.assertEqual(cached, summary(cache.get_categories(book_ids=book_ids)), f'Categories for {book_ids} differ')
+            for book_ids in scopes:
+                cache.get_categories(book_ids=book_ids)
+
+        check()
+        cache.set_field('tags', {1:('new tag', 'Tag One'), 2:()})
+        self.assertIn('tags', cache.category_cache.scopes[None])
+        check()
+        cache.set_field('rating', {1:8, 3:2})
+        check()
+        cache.set_field('#rating', {2:6, 1:None})
+        check()
+        cache.set_field('series', {3:'new series', 1:None})
+        cache.set_field('authors', {2:['New Author', 'Author One']})
+        cache.set_field('identifiers', {1:{'isbn':'1234', 'xyz':'1'}})
+        check()
+        mi = Metadata('added', ['Author One'])
+        mi.tags, mi.rating = ['Tag One', 'added tag'], 4
+        book_id = cache.add_books([(mi, {})])[0][0]
+        self.assertIn(book_id, {b for t in cache.get_categories()['tags'] for b in t.id_set})
+        check()
+        cache.remove_books((2,))
+        check()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'new tag'): 'Tag One'})
+        self.assertNotIn('tags', cache.category_cache.scopes[None])
+        check()
+        conn = cache.backend.conn
+        conn.execute('INSERT INTO tags (name) VALUES ("mūs")')
+        lid = conn.last_insert_rowid()
+        conn.execute('INSERT INTO tags (name) VALUES ("MŪS")')
+        uid = conn.last_insert_rowid()
+        conn.execute(f'INSERT INTO books_tags_link (book,tag) VALUES (1, {lid})')
+        conn.execute(f'INSERT INTO books_tags_link (book,tag) VALUES (3, {uid})')
+        cache.reload_from_db()
+        check()
+        # Merging the tags that differ only in case changes book 3 as well
+        cache.set_field('tags', {book_id: ('mūs',)})
+        self.assertNotIn(uid, {t.id for t in cache.get_categories()['tags']})
+        check()
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         import warnings
@@ -917,6 +1196,45 @@ def map_as_list(amap):
         cache.restore_annotations(1, list(opf.read_annotations()))
         amap = cache.annotations_map_for_book(1, 'moo')
         self.assertEqual([x[0] for x in annot_list], map_as_list(amap))
+
+        # Test incremental sync
+        def h(uuid, ts, text='x'):
+            return {'type': 'highlight', 'uuid': uuid, 'timestamp': ts, 'highlighted_text': text}
+
+        cache.set_annotations_for_book(2, 'EPUB', [(h('a', '2020-01-01T00:00:00+00:00'), 1), (h('b', '2020-01-01T00:00:00+00:00'), 1)])
+        seq, changes = cache.sync_annotations(2, 'epub')
+        self.assertEqual({'a', 'b'}, {x['uuid'] for x in changes})
+        self.assertEqual((seq, []), cache.sync_annotations(2, 'epub', since=seq))
+        # a is newer on the client, b is older and c is new
+        seq2, changes = cache.sync_annotations(2, 'epub', [
+            h('a', '2021-01-01T00:00:00+00:00', 'new'), h('b', '2019-01-01T00:00:00+00:00', 'old'), h('c', '2021-01-01T00:00:00+00:00')], since=seq)
+        self.assertGreater(seq2, seq)
+        self.assertEqual([h('b', '2020-01-01T00:00:00+00:00')], changes)
+        amap = cache.annotations_map_for_book(2, 'EPUB')
+        self.assertEqual({'a': 'new', 'b': 'x', 'c': 'x'}, {x['uuid']: x['highlighted_text'] for x in amap['highlight']})
+        # Another client only gets the changes made after its last sync
+        self.assertEqual({'a', 'c'}, {x['uuid'] for x in cache.sync_annotations(2, 'epub', since=seq)[1]})
+        # Unchanged annotations are not sent again after a full save
+        cache.set_annotations_for_book(2, 'EPUB', [(x, 1) for x in amap['highlight']] + [(h('d', '2022-01-01T00:00:00+00:00'), 1)])
+        self.assertEqual(['d'], [x['uuid'] for x in cache.sync_annotations(2, 'epub', since=seq2)[1]])
+        # Deleted annotations are sent as removal skeletons
+        seq3 = cache.sync_annotations(2, 'epub', since=seq2)[0]
+        amap = cache.annotations_map_for_book(2, 'EPUB')
+        cache.set_annotations_for_book(2, 'EPUB', [(x, 1) for x in amap['highlight'] if x['uuid'] != 'c'])
+        seq4, changes = cache.sync_annotations(2, 'epub', since=seq3)
+        self.assertGreater(seq4, seq3)
+        self.assertEqual([('c', True)], [(x['uuid'], x['removed']) for x in changes])
+        self.assertEqual((seq4, []), cache.sync_annotations(2, 'epub', since=seq4))
+
+        def uuids():
+            return {x['uuid'] for x in cache.annotations_map_for_book(2, 'EPUB')['highlight']}
+        # Changes older than the deletion are rejected, newer ones restore the annotation
+        changes = cache.sync_annotations(2, 'epub', [h('c', '2021-06-01T00:00:00+00:00')], since=seq4)[1]
+        self.assertEqual([('c', True)], [(x['uuid'], x['removed']) for x in changes])
+        self.assertNotIn('c', uuids())
+        self.assertEqual([], cache.sync_annotations(2, 'epub', [h('c', '2999-01-01T00:00:00+00:00')], since=seq4)[1])
+        self.assertIn('c', uuids())
+        self.assertEqual(['c'], [x['uuid'] for x in cache.sync_annotations(2, 'epub', since=seq4)[1] if not x.get('removed')])
     # }}}
 
     def test_changed_events(self):  # {{{
@@ -163,10 +163,9 @@ def doit(self):
         from calibre.gui2.ui import get_gui
         library_broker = get_gui().library_broker
         newdb = library_broker.get_library(self.loc)
+        # Duplicates are found using the duplicate index of the destination library
         self.find_identical_books_data = None
         try:
-            if self.check_for_duplicates:
-                self.find_identical_books_data = newdb.new_api.data_for_find_identical_books()
             self._doit(newdb)
         finally:
             library_broker.prune_loaded_dbs()
@@ -15,6 +15,7 @@
 from calibre.srv.content import get as get_content
 from calibre.srv.content import icon as get_icon
 from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.pool import GENERATION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import custom_fields_to_display, decode_name, encode_name, get_db, http_date
 from calibre.utils.config import prefs, tweaks
@@ -217,7 +218,7 @@ def books(ctx, rd, library_id):
         device_compatible = rd.query.get('device_compatible', 'false').lower() == 'true'
         device_for_template = rd.query.get('device_for_template', None)
         ans = {}
-        allowed_book_ids = ctx.allowed_book_ids(rd, db)
+        allowed_book_ids = ctx.allowed_book_ids(rd, db, as_bitmap=True)
         for book_id in ids:
             if book_id not in allowed_book_ids:
                 ans[book_id] = None
@@ -236,7 +237,7 @@ def books(ctx, rd, library_id):
 
 # Categories (Tag Browser) {{{
 
-@endpoint('/ajax/categories/{library_id=None}', postprocess=json)
+@endpoint('/ajax/categories/{library_id=None}', postprocess=json, lane=GENERATION)
 def categories(ctx, rd, library_id):
     '''
     Return the list of top-level categories as a list of dictionaries. Each
@@ -297,7 +298,7 @@ def getter(x):
         return ans
 
 
-@endpoint('/ajax/category/{encoded_name}/{library_id=None}', postprocess=json)
+@endpoint('/ajax/category/{encoded_name}/{library_id=None}', postprocess=json, lane=GENERATION)
 def category(ctx, rd, encoded_name, library_id):
     '''
     Return a dictionary describing the category specified by name. The
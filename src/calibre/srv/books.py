@@ -17,6 +17,7 @@
 from calibre.srv.errors import BookNotFound, HTTPNotFound
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
+from calibre.srv.pool import FILE_IO
 from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
@@ -181,7 +182,7 @@ def book_manifest(ctx, rd, book_id, fmt):
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
 
-@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
+@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int}, lane=FILE_IO)
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
     if not ctx.has_id(rd, db, book_id):
@@ -210,7 +211,7 @@ def get_last_read_position(ctx, rd, library_id, which):
     if not user:
         raise HTTPNotFound('login required for sync')
     ans = {}
-    allowed_book_ids = ctx.allowed_book_ids(rd, db)
+    allowed_book_ids = ctx.allowed_book_ids(rd, db, as_bitmap=True)
     for item in which.split('_'):
         book_id, fmt = item.partition('-')[::2]
         try:
@@ -256,7 +257,7 @@ def get_annotations(ctx, rd, library_id, which):
     db = get_db(ctx, rd, library_id)
     user = rd.username or '*'
     ans = {}
-    allowed_book_ids = ctx.allowed_book_ids(rd, db)
+    allowed_book_ids = ctx.allowed_book_ids(rd, db, as_bitmap=True)
     for item in which.split('_'):
         book_id, fmt = item.partition('-')[::2]
         try:
@@ -291,6 +292,38 @@ def update_annotations(ctx, rd, library_id, book_id, fmt):
     return b''
 
 
+@endpoint('/book-sync-annotations/{library_id}', methods=('POST',), postprocess=json)
+def sync_annotations(ctx, rd, library_id):
+    '''
+    Incrementally sync annotations for many books at once. The request body must be a JSON object
+    of the form: {"book_id:fmt": {"since": seq, "changes": [annotations changed since the last sync]}, ...}
+    The response has the same keys with values of the form: {"seq": seq, "changes": [annotations changed on the server]}.
+    Use zero for since on the first sync. See Cache.sync_annotations() for details.
+    '''
+    db = get_db(ctx, rd, library_id)
+    user = rd.username or '*'
+    try:
+        data = jsonlib.load(rd.request_body_file)
+        items = tuple(data.items())
+    except Exception:
+        raise HTTPNotFound('Invalid data')
+    allowed_book_ids = ctx.allowed_book_ids(rd, db, as_bitmap=True)
+    ans = {}
+    for key, val in items:
+        book_id, fmt = key.partition(':')[::2]
+        try:
+            book_id = int(book_id)
+            since = int(val.get('since') or 0)
+            changes = list(val.get('changes') or ())
+        except Exception:
+            continue
+        if not fmt or book_id not in allowed_book_ids:
+            continue
+        seq, changes = db.sync_annotations(book_id, fmt, changes, since=since, user_type='web', user=user)
+        ans[key] = {'seq': seq, 'changes': changes}
+    return ans
+
+
 mathjax_lock = Lock()
 mathjax_manifest = None
 
@@ -14,6 +14,7 @@
 from calibre.srv.changes import books_added, books_deleted, metadata
 from calibre.srv.errors import HTTPBadRequest, HTTPForbidden, HTTPNotFound
 from calibre.srv.metadata import book_as_json
+from calibre.srv.pool import FILE_IO, GENERATION
 from calibre.srv.routes import endpoint, json, msgpack_or_json
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.imghdr import what
@@ -26,7 +27,7 @@
 receive_data_methods = {'GET', 'POST'}
 
 
-@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache', lane=GENERATION)
 def cdb_run(ctx, rd, which, version):
     try:
         m = module_for_cmd(which)
@@ -67,7 +68,7 @@ def cdb_run(ctx, rd, which, version):
 
 
 @endpoint('/cdb/add-book/{job_id}/{add_duplicates}/{filename}/{library_id=None}',
-          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache')
+          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache', lane=FILE_IO)
 def cdb_add_book(ctx, rd, job_id, add_duplicates, filename, library_id):
     '''
     Add a file as a new book. The file contents must be in the body of the request.
@@ -220,7 +221,7 @@ def to_lang_code(x):
 
 
 @endpoint('/cdb/copy-to-library/{target_library_id}/{library_id=None}', needs_db_write=True,
-        postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+        postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache', lane=FILE_IO)
 def cdb_copy_to_library(ctx, rd, target_library_id, library_id):
     db_src = get_db(ctx, rd, library_id)
     db_dest = get_db(ctx, rd, target_library_id)
@@ -20,6 +20,7 @@
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound, HTTPRedirect, HTTPTempRedirect
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json, categories_as_json, categories_settings, get_gpref, icon_map, web_search_link
+from calibre.srv.pool import GENERATION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
@@ -80,7 +81,7 @@ def console_print(ctx, rd):
 
 
 def get_basic_query_data(ctx, rd):
-    db, library_id, library_map, default_library = get_library_data(ctx, rd)
+    db, library_id, library_map, default_library = get_library_data(ctx, rd, for_reading=True)
     skeys = db.field_metadata.sortable_field_keys()
     sorts, orders = [], []
     for x in rd.query.get('sort', '').split(','):
@@ -382,7 +383,7 @@ def get_books(ctx, rd):
     except Exception:
         raise HTTPNotFound('Invalid number of books: {!r}'.format(rd.query.get('num')))
     searchq = rd.query.get('search', '')
-    db = get_library_data(ctx, rd)[0]
+    db = get_library_data(ctx, rd, for_reading=True)[0]
     ans = {}
     mdata = ans['metadata'] = {}
     with db.safe_read_lock:
@@ -444,7 +445,7 @@ def web_search(ctx, rd, book_id, field, item_val):
     raise HTTPNotFound(f'No web search URL for {field} {item_val}')
 
 
-@endpoint('/interface-data/tag-browser')
+@endpoint('/interface-data/tag-browser', lane=GENERATION, max_concurrency=2)
 def tag_browser(ctx, rd):
     '''
     Get the Tag Browser serialized as JSON
@@ -8,11 +8,14 @@
 import errno
 import os
 import re
-from contextlib import suppress
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
 from functools import partial
 from io import BytesIO
+from itertools import count
 from json import load as load_json_file
 from threading import Lock
+from weakref import WeakSet
 
 from calibre import fit_image, guess_type, sanitize_file_name
 from calibre.constants import config_dir, iswindows
@@ -25,11 +28,13 @@
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.metadata import encode_stat_result
+from calibre.srv.pool import FILE_IO, METADATA
 from calibre.srv.routes import endpoint, json
+from calibre.srv.thumbnails import write_thumbnail
 from calibre.srv.utils import get_db, get_use_roman, http_date
 from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
-from calibre.utils.filenames import ascii_filename, atomic_rename, make_long_path_useable
+from calibre.utils.filenames import ascii_filename, atomic_rename, make_long_path_useable, reflink_file
 from calibre.utils.img import image_from_data, scale_image
 from calibre.utils.localization import _
 from calibre.utils.resources import get_image_path as I
@@ -42,15 +47,123 @@
 plugboard_content_server_value = 'content_server'
 plugboard_content_server_formats = ['epub', 'mobi', 'azw3']
 update_metadata_in_fmts = frozenset(plugboard_content_server_formats)
-lock = Lock()
 
 # Get book formats/cover as a cached filesystem file {{{
 
-rename_counter = 0
+rename_counter = count()
+
+
+class FileCache:
+
+    '''
+    Tracks the files copied out of the library into rd.tdir/fcache. Each file
+    has its own lock, so concurrent requests for the same file wait for a
+    single copy to be made, while requests for different files proceed in
+    parallel. Once the total size of the cached files exceeds the limit, the
+    least recently used files are removed, unless they are still open, for
+    example, while being sent to a client, as their space is not freed until
+    they are closed.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.file_locks = {}
+        self.entries = OrderedDict()
+        self.handles = {}
+        self.total_size = 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.handles.clear()
+            self.total_size = 0
+
+    @contextmanager
+    def locked(self, fname):
+        with self.lock:
+            fl = self.file_locks.get(fname)
+            if fl is None:
+                fl = self.file_locks[fname] = [Lock(), 0]
+            fl[1] += 1
+        try:
+            with fl[0]:
+                yield
+        finally:
+            with self.lock:
+                fl[1] -= 1
+                if not fl[1]:
+                    del self.file_locks[fname]
+
+    def record(self, fname, size, handle):
+        ' Record that fname, of the specified size, has been opened as the file object handle '
+        with self.lock:
+            self.total_size += size - self.entries.pop(fname, 0)
+            self.entries[fname] = size
+            handles = self.handles.get(fname)
+            if handles is None:
+                handles = self.handles[fname] = WeakSet()
+            handles.add(handle)
+
+    def is_open(self, fname):
+        # Must be called with self.lock held
+        handles = self.handles.get(fname)
+        if handles is not None:
+            if any(not h.closed for h in handles):
+                return True
+            del self.handles[fname]
+        return False
+
+    def discard(self, fname):
+        with self.lock:
+            self.total_size -= self.entries.pop(fname, 0)
+            self.handles.pop(fname, None)
+
+    def expire(self, max_size):
+        ' Remove least recently used files until the cache is no larger than max_size '
+        if max_size <= 0:
+            return
+        with self.lock:
+            # Never expire the most recently used file
+            candidates = tuple(self.entries)[:-1]
+            total_size, expired = self.total_size, []
+            for fname in candidates:
+                if total_size <= max_size:
+                    break
+                if fname not in self.file_locks and not self.is_open(fname):
+                    expired.append(fname)
+                    total_size -= self.entries[fname]
+        for fname in expired:
+            with self.locked(fname):
+                with self.lock:
+                    if self.is_open(fname):
+                        continue  # opened while we were waiting for the lock
+                    size = self.entries.pop(fname, None)
+                    if size is None:
+                        continue  # already removed
+                    self.total_size -= size
+                with suppress(OSError):
+                    remove_cached_file(fname)
+
+
+file_cache = FileCache()
 
 
 def reset_caches():
-    pass
+    file_cache.clear()
+
+
+def remove_cached_file(fname):
+    # The file may be open, so we cannot change its contents, as that would
+    # lead to corrupted downloads in any clients that are currently
+    # downloading the file.
+    if iswindows:
+        # On windows in order to re-use fname, we have to rename it before
+        # deleting it
+        dname = os.path.join(os.path.dirname(fname), f'_{next(rename_counter):x}')
+        atomic_rename(fname, dname)
+        os.remove(dname)
+    else:
+        os.remove(fname)
 
 
 def open_for_write(fname):
@@ -64,13 +177,39 @@ def open_for_write(fname):
     return share_open(fname, 'w+b')
 
 
-def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func, extra_etag_data=''):
+def fill_file_copy(fname, copy_func, get_source_path=None):
+    ans = open_for_write(fname)
+    try:
+        cloned = False
+        path = None if get_source_path is None else get_source_path()
+        if path:
+            # Use a copy-on-write clone of the library file, if the filesystem
+            # supports it
+            with suppress(OSError), open(path, 'rb') as src:
+                reflink_file(src, ans)
+                cloned = True
+        if not cloned:
+            copy_func(ans)
+        ans.seek(0, os.SEEK_END)
+        size = ans.tell()
+        ans.seek(0)
+    except Exception:
+        ans.close()
+        with suppress(OSError):
+            remove_cached_file(fname)
+        raise
+    return ans, size
+
+
+def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func, extra_etag_data='', get_source_path=None):
     ''' We cannot copy files directly from the library folder to the output
     socket, as this can potentially lock the library for an extended period. So
     instead we copy out the data from the library folder into a temp folder. We
     make sure to only do this copy once, using the previous copy, if there have
-    been no changes to the data for the file since the last copy. '''
-    global rename_counter
+    been no changes to the data for the file since the last copy. If
+    get_source_path is specified, it must return the path to the file in the
+    library, which is then cloned rather than copied, where the filesystem
+    supports it. '''
 
     # Avoid too many items in a single directory for performance
     base = os.path.join(rd.tdir, 'fcache', ((f'{book_id:x}')[-3:]))
@@ -88,39 +227,28 @@ def safe_mtime():
             return os.path.getmtime(fname)
 
     mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
-    with lock:
+    with file_cache.locked(fname):
         previous_mtime = safe_mtime()
         if previous_mtime is None or previous_mtime < mt:
             if previous_mtime is not None:
-                # File exists and may be open, so we cannot change its
-                # contents, as that would lead to corrupted downloads in any
-                # clients that are currently downloading the file.
-                if iswindows:
-                    # On windows in order to re-use bname, we have to rename it
-                    # before deleting it
-                    rename_counter += 1
-                    dname = os.path.join(base, f'_{rename_counter:x}')
-                    atomic_rename(fname, dname)
-                    os.remove(dname)
-                else:
-                    os.remove(fname)
-            ans = open_for_write(fname)
-            copy_func(ans)
-            ans.seek(0)
+                file_cache.discard(fname)
+                remove_cached_file(fname)
+            ans, size = fill_file_copy(fname, copy_func, get_source_path)
         else:
             try:
                 ans = share_open(fname, 'rb')
+                size = os.fstat(ans.fileno()).st_size
                 used_cache = 'yes'
             except OSError as err:
                 if err.errno != errno.ENOENT:
                     raise
-                ans = open_for_write(fname)
-                copy_func(ans)
-                ans.seek(0)
-        if ctx.testing:
-            rd.outheaders['Used-Cache'] = used_cache
-            rd.outheaders['Tempfile'] = as_hex_unicode(fname)
-        return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mt, extra_etag_data)
+                ans, size = fill_file_copy(fname, copy_func, get_source_path)
+        file_cache.record(fname, size, ans)
+    file_cache.expire(ctx.opts.max_file_cache_size * 1024 * 1024)
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+        rd.outheaders['Tempfile'] = as_hex_unicode(fname)
+    return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mt, extra_etag_data)
 
 
 def write_generated_cover(db, book_id, width, height, destf):
@@ -149,20 +277,46 @@ def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     mtime = db.cover_last_modified(book_id)
     if mtime is None:
         return generated_cover(ctx, rd, library_id, db, book_id, width, height)
-    prefix = 'cover'
-    if width is None and height is None:
-        def copy_func(dest):
-            db.copy_cover_to(book_id, dest)
-    else:
-        prefix += f'-{width}x{height}'
+    if width is not None or height is not None:
+        return thumbnail(ctx, rd, library_id, db, book_id, mtime, width, height)
 
-        def copy_func(dest):
+    def copy_func(dest):
+        db.copy_cover_to(book_id, dest)
+    get_source_path = partial(db.format_abspath, book_id, '__COVER_INTERNAL__')
+    return create_file_copy(ctx, rd, 'cover', library_id, book_id, 'jpg', mtime, copy_func, get_source_path=get_source_path)
+
+
+def thumbnail(ctx, rd, library_id, db, book_id, mtime, width, height):
+    ''' Thumbnails are served from the persistent thumbnail store, generating
+    them if needed. Thumbnails for new covers are generated in the background
+    in the sizes that have been requested recently. '''
+    store = ctx.thumbnail_store
+    if store.location is None:
+        store.location = os.path.join(rd.tdir, 'thumbnails')
+    mt = timestampfromdt(mtime)
+    path = store.path_for(db, book_id, mt, width, height)
+    store.size_requested(width, height)
+    used_cache = 'yes'
+    with file_cache.locked(path):
+        try:
+            ans = share_open(path, 'rb')
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            used_cache = 'no'
             buf = BytesIO()
             db.copy_cover_to(book_id, buf)
             quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
             data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
-            dest.write(data)
-    return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
+            write_thumbnail(path, data)
+            store.add(path, len(data))
+            ans = share_open(path, 'rb')
+        else:
+            store.touch(path)
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+        rd.outheaders['Tempfile'] = as_hex_unicode(path)
+    return rd.filesystem_file_with_custom_etag(ans, f'cover-{width}x{height}', library_id, book_id, mt)
 
 
 def fname_for_content_disposition(fname, as_encoded_unicode=False):
@@ -225,7 +379,9 @@ def copy_func(dest):
     rd.outheaders['Content-Disposition'] = (
         f'''{cd}; filename="{book_filename(rd, book_id, mi, fmt)}"; filename*=utf-8''{book_filename(rd, book_id, mi, fmt, as_encoded_unicode=True)}''')
 
-    return create_file_copy(ctx, rd, 'fmt', library_id, book_id, fmt, mtime, copy_func, extra_etag_data=extra_etag_data)
+    get_source_path = None if update_metadata else partial(db.format_abspath, book_id, fmt)
+    return create_file_copy(
+        ctx, rd, 'fmt', library_id, book_id, fmt, mtime, copy_func, extra_etag_data=extra_etag_data, get_source_path=get_source_path)
 # }}}
 
 
@@ -245,6 +401,16 @@ def static(ctx, rd, what):
         raise HTTPNotFound()
 
 
+def static_files():
+    ' The static files used by the server UI, these are compressed in the background when the server starts '
+    base = P('content-server', allow_user_override=False)
+    for dirpath, dirnames, filenames in os.walk(base):
+        for name in filenames:
+            if name.endswith(('.html', '.js', '.css', '.svg')):
+                path = os.path.relpath(os.path.join(dirpath, name), base).replace(os.sep, '/')
+                yield P('content-server/' + path)
+
+
 @endpoint('/favicon.png', auth_required=False, cache_control=24)
 def favicon(ctx, rd):
     return share_open(I('lt.png'), 'rb')
@@ -282,8 +448,8 @@ def icon(ctx, rd, which):
             return share_open(path, 'rb')
         except OSError:
             raise HTTPNotFound()
-    with lock:
-        cached = os.path.join(rd.tdir, 'icons', f'{sz}-{which}.png')
+    cached = os.path.join(rd.tdir, 'icons', f'{sz}-{which}.png')
+    with file_cache.locked(cached):
         try:
             return share_open(cached, 'rb')
         except OSError:
@@ -343,7 +509,12 @@ def save_reader_profile(ctx, rd):
     return True
 
 
-@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True)
+def get_lane(what, *args):
+    # Covers and metadata are cheap, do not let them wait behind book files
+    return METADATA if what in ('thumb', 'cover', 'opf', 'json') else FILE_IO
+
+
+@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True, lane=get_lane)
 def get(ctx, rd, what, book_id, library_id):
     book_id, rest = book_id.partition('_')[::2]
     try:
@@ -353,6 +524,9 @@ def get(ctx, rd, what, book_id, library_id):
     db = get_db(ctx, rd, library_id)
     if db is None:
         raise HTTPNotFound(f'Library {library_id!r} not found')
+    if what == 'thumb':
+        # Must be done before acquiring the read lock
+        ctx.thumbnail_store.watch(db)
     with db.safe_read_lock:
         if not ctx.has_id(rd, db, book_id):
             raise BookNotFound(book_id, db)
@@ -453,7 +627,7 @@ def get_note_from_val(ctx, rd, field, item, library_id):
     return {'item_id': item_id, 'html': html}
 
 
-@endpoint('/get-note-resource/{scheme}/{digest}/{library_id=None}')
+@endpoint('/get-note-resource/{scheme}/{digest}/{library_id=None}', lane=FILE_IO)
 def get_note_resource(ctx, rd, scheme, digest, library_id):
     '''
     Get the data for a resource in a field note, such as an image.
@@ -529,7 +703,7 @@ def data_file(rd, fname, path, stat_result):
     return rd.filesystem_file_with_custom_etag(share_open(path, 'rb'), stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime)
 
 
-@endpoint('/data-files/get/{book_id}/{relpath}/{library_id=None}', types={'book_id': int})
+@endpoint('/data-files/get/{book_id}/{relpath}/{library_id=None}', types={'book_id': int}, lane=FILE_IO)
 def get_data_file(ctx, rd, book_id, relpath, library_id):
     db = get_db(ctx, rd, library_id)
     if db is None:
@@ -547,7 +721,7 @@ def strerr(e: Exception):
     return str(e)
 
 
-@endpoint('/data-files/upload/{book_id}/{library_id=None}', needs_db_write=True, methods={'POST'}, types={'book_id': int}, postprocess=json)
+@endpoint('/data-files/upload/{book_id}/{library_id=None}', needs_db_write=True, methods={'POST'}, types={'book_id': int}, postprocess=json, lane=FILE_IO)
 def upload_data_files(ctx, rd, book_id, library_id):
     db = get_db(ctx, rd, library_id)
     if db is None:
@@ -86,7 +86,8 @@ def start(self):
         if self.current_thread is None:
             try:
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    create_http_handler(
+                        self.handler.dispatch, classify_request=self.handler.classify_request, static_files=self.handler.static_files),
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -5,16 +5,21 @@
 
 from calibre.ebooks.metadata import authors_to_string
 from calibre.srv.errors import HTTPBadRequest, HTTPPreconditionRequired, HTTPUnprocessableEntity
+from calibre.srv.pool import GENERATION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data
 
 
-@endpoint('/fts/search', postprocess=json)
+@endpoint('/fts/search', postprocess=json, lane=GENERATION, max_concurrency=2)
 def fts_search(ctx, rd):
     '''
     Perform the specified full text query.
 
     Optional: ?query=<search query>&library_id=<default library>&use_stemming=<y or n>&query_id=arbitrary&restriction=arbitrary
+    &offset=0&limit=<number of results>
+
+    When limit is specified only that many results, starting at offset, are
+    returned and has_more is set if there are more results after them.
     '''
 
     db = get_library_data(ctx, rd)[0]
@@ -31,6 +36,14 @@ def fts_search(ctx, rd):
     qid = rd.query.get('query_id')
     if qid:
         ans['query_id'] = qid
+    try:
+        offset = int(rd.query.get('offset', 0))
+        limit = rd.query.get('limit')
+        limit = None if limit is None else int(limit)
+    except Exception:
+        raise HTTPBadRequest('Invalid offset or limit')
+    if offset < 0 or (limit is not None and limit < 1):
+        raise HTTPBadRequest('Invalid offset or limit')
     book_ids = None
     if rd.query.get('restriction'):
         book_ids = db.search('', restriction=rd.query.get('restriction'))
@@ -46,11 +59,18 @@ def add_metadata(result):
 
     from calibre.db import FTSQueryError
     try:
-        ans['results'] = tuple(db.fts_search(
-            query, use_stemming=use_stemming, return_text=False, process_each_result=add_metadata, restrict_to_book_ids=book_ids,
-        ))
+        # Get one extra result to know if there are more
+        results = db.fts_search(
+            query, use_stemming=use_stemming, return_text=False, restrict_to_book_ids=book_ids,
+            limit=None if limit is None else limit + 1, offset=offset,
+        )
     except FTSQueryError as e:
         raise HTTPUnprocessableEntity(str(e))
+    if limit is not None:
+        ans['offset'] = offset
+        ans['has_more'] = len(results) > limit
+        results = results[:limit]
+    ans['results'] = tuple(map(add_metadata, results))
     return ans
 
 
@@ -94,7 +114,7 @@ def fts_indexing(ctx, rd):
     return ''
 
 
-@endpoint('/fts/snippets/{book_ids}', postprocess=json)
+@endpoint('/fts/snippets/{book_ids}', postprocess=json, lane=GENERATION)
 def fts_snippets(ctx, rd, book_ids):
     '''
     Perform the specified full text query and return the results with snippets restricted to the specified book ids.
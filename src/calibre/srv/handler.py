@@ -3,15 +3,19 @@
 
 
 import json
+import os
 from functools import partial
 from importlib import import_module
 from threading import Lock
 
+from calibre.constants import cache_dir
 from calibre.srv.auth import AuthController
 from calibre.srv.errors import HTTPForbidden
 from calibre.srv.library_broker import LibraryBroker, path_for_db
 from calibre.srv.routes import Router
+from calibre.srv.thumbnails import ThumbnailStore
 from calibre.srv.users import UserManager
+from calibre.utils.config_base import tweaks
 from calibre.utils.date import utcnow
 from calibre.utils.search_query_parser import ParseException
 from polyglot.builtins import itervalues
@@ -34,6 +38,9 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.ignored_fields = frozenset(filter(None, (x.strip() for x in (opts.ignored_fields or '').split(','))))
         self.displayed_fields = frozenset(filter(None, (x.strip() for x in (opts.displayed_fields or '').split(','))))
         self._notify_changes = notify_changes
+        self.thumbnail_store = ThumbnailStore(
+            None if testing else os.path.join(cache_dir(), 'srvt'), max_size=opts.max_thumbnail_cache_size,
+            compression_quality=min(99, max(50, tweaks['content_server_thumbnail_compression_quality'])))
 
     def notify_changes(self, library_path, change_event):
         if self._notify_changes is not None:
@@ -87,7 +94,7 @@ def has_id(self, request_data, db, book_id):
         restriction = self.restriction_for(request_data, db)
         if restriction:
             try:
-                return book_id in db.search('', restriction=restriction)
+                return book_id in db.search('', restriction=restriction, as_bitmap=True)
             except ParseException:
                 return False
         return db.has_id(book_id)
@@ -99,13 +106,22 @@ def newest_book_ids(self, request_data, db, count=5):
             allowed_book_ids = db.search('', restriction=restriction)
         return db.newly_added_book_ids(count=count, book_ids=allowed_book_ids)
 
-    def get_allowed_book_ids_from_restriction(self, request_data, db):
+    def get_allowed_book_ids_from_restriction(self, request_data, db, as_bitmap=False):
         restriction = self.restriction_for(request_data, db)
-        return frozenset(db.search('', restriction=restriction)) if restriction else None
-
-    def allowed_book_ids(self, request_data, db):
+        if not restriction:
+            return None
+        ans = db.search('', restriction=restriction, as_bitmap=as_bitmap)
+        return ans if as_bitmap or isinstance(ans, frozenset) else frozenset(ans)
+
+    def allowed_book_ids(self, request_data, db, as_bitmap=False):
+        '''
+        The ids of the books the user is allowed to access. If as_bitmap is
+        True, the result may be a read-only Bitmap, which is much faster for
+        users with restrictions, use it when the result is only needed for
+        membership tests.
+        '''
         try:
-            ans = self.get_allowed_book_ids_from_restriction(request_data, db)
+            ans = self.get_allowed_book_ids_from_restriction(request_data, db, as_bitmap=as_bitmap)
         except ParseException:
             return frozenset()
         if ans is None:
@@ -209,6 +225,8 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
         self.dispatch = self.router.dispatch
+        self.classify_request = self.router.classify
+        self.static_files = import_module('calibre.srv.content').static_files
 
     def set_log(self, log):
         self.router.ctx.log = log
@@ -216,7 +234,7 @@ def set_log(self, log):
             self.auth_controller.log = log
 
     def set_jobs_manager(self, jobs_manager):
-        self.router.ctx.jobs_manager = jobs_manager
+        self.router.ctx.jobs_manager = self.router.ctx.thumbnail_store.jobs_manager = jobs_manager
 
     def close(self):
         self.router.ctx.library_broker.close()
@@ -202,7 +202,9 @@ def read_headers(readline):
 class HTTPRequest(Connection):
 
     request_handler = None
+    classify_request = None
     static_cache = None
+    compressed_cache = None
     translator_cache = None
 
     def __init__(self, *args, **kwargs):
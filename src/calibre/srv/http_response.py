@@ -10,11 +10,12 @@
 import struct
 import time
 import uuid
-from collections import namedtuple
-from functools import wraps
+from collections import OrderedDict, namedtuple
+from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from itertools import chain, repeat
 from operator import itemgetter
+from threading import Lock, Thread
 
 from calibre import force_unicode, guess_type
 from calibre.constants import __version__
@@ -35,6 +36,18 @@
 import zlib
 from itertools import zip_longest
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
 
 def file_metadata(fileobj):
     try:
@@ -154,7 +167,7 @@ def get_ranges(headervalue, content_length):  # {{{
 # }}}
 
 
-# gzip transfer encoding {{{
+# Content encoding {{{
 
 def gzip_prefix():
     # See http://www.gzip.org/zlib/rfc-gzip.html
@@ -188,9 +201,159 @@ def compress_readable_output(src_file, compress_level=6):
             data = gzip_prefix() + data
         yield data
     yield zobj.flush() + struct.pack(b'<L', crc & 0xffffffff) + struct.pack(b'<L', size)
+
+
+def gzip_compress(data):
+    return b''.join(compress_readable_output(ReadOnlyFileBuffer(data), compress_level=9))
+
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=9)
+
+
+def zstd_compress(data):
+    if hasattr(zstd, 'ZstdCompressor'):
+        return zstd.ZstdCompressor(level=12).compress(data)
+    return zstd.compress(data, level=12)
+
+
+# Encodings used for cached response bodies, in order of preference
+COMPRESSORS = {k: v for k, v in (
+    ('br', brotli_compress if brotli is not None else None),
+    ('zstd', zstd_compress if zstd is not None else None),
+    ('gzip', gzip_compress),
+) if v is not None}
+
+
+def accepted_encodings(val):
+    return frozenset(x.lower() for x in sort_q_values(val))
+
+
+def filesystem_etag(name, mtime):
+    if not isinstance(name, string_or_bytes):
+        name = str(name)
+    return '"{}"'.format(hashlib.sha1((str(mtime) + force_unicode(name)).encode('utf-8')).hexdigest())
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class CompressedCache:
+
+    '''
+    Cache of compressed response bodies, keyed by (resource, ETag), so that
+    responses that have been seen before are never compressed again. The
+    resource is the path of the file for responses that are files and the
+    request URI otherwise, as some endpoints use a single ETag for many
+    different bodies. The first response for a key is compressed on the fly,
+    while the body is compressed into every available encoding in a background
+    thread, so as not to stall the server loop. The least recently used bodies
+    are dropped once the cache grows larger than max_size.
+    '''
+
+    max_size = 64 * 1024 * 1024
+    max_item_size = 8 * 1024 * 1024
+    max_pending = 256
+
+    def __init__(self):
+        self.lock = Lock()
+        self.items = OrderedDict()
+        self.size = 0
+        self.pending = OrderedDict()
+        self.worker = None
+
+    def get(self, resource, etag, accepted):
+        ' Return (encoding, data) for the most preferred cached encoding in accepted or None '
+        with self.lock:
+            for encoding in COMPRESSORS:
+                if encoding in accepted:
+                    key = resource, etag, encoding
+                    data = self.items.get(key)
+                    if data is not None:
+                        self.items.move_to_end(key)
+                        return encoding, data
+
+    def __contains__(self, key):
+        with self.lock:
+            return key + ('gzip',) in self.items
+
+    def schedule(self, key, func):
+        with self.lock:
+            if key in self.pending or len(self.pending) >= self.max_pending:
+                return
+            self.pending[key] = func
+            if self.worker is None:
+                self.worker = Thread(target=self.run, name='CompressedCache', daemon=True)
+                self.worker.start()
+
+    def compress_output(self, resource, output):
+        ' Schedule compression of the body of output, if it can be cached '
+        key = resource, output.etag
+        if not output.etag or output.content_length > self.max_item_size or key in self:
+            return
+        if isinstance(output.src_file, ReadOnlyFileBuffer):
+            self.schedule(key, partial(self.compress, resource, output.etag, output.src_file.getvalue()))
+        elif output.use_sendfile and isinstance(getattr(output, 'name', None), str):
+            self.schedule(key, partial(self.compress, resource, output.etag, partial(read_file, output.name)))
+
+    def precompress(self, get_paths):
+        ' Compress the files returned by get_paths() in the background '
+        self.schedule(None, partial(self.compress_files, get_paths))
+
+    def compress_files(self, get_paths):
+        for path in get_paths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size <= self.max_item_size:
+                self.compress(path, filesystem_etag(path, st.st_mtime), partial(read_file, path))
+
+    def compress(self, resource, etag, data):
+        if (resource, etag) in self:
+            return
+        if callable(data):
+            data = data()
+        data = bytes(data)
+        if len(data) > self.max_item_size:
+            return
+        compressed = {encoding: compressor(data) for encoding, compressor in COMPRESSORS.items()}
+        with self.lock:
+            for encoding, cdata in compressed.items():
+                key = resource, etag, encoding
+                self.size += len(cdata) - len(self.items.pop(key, b''))
+                self.items[key] = cdata
+            while self.size > self.max_size and self.items:
+                self.size -= len(self.items.popitem(last=False)[1])
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.worker = None
+                    return
+                func = next(iter(self.pending.values()))
+            try:
+                func()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.pending.popitem(last=False)
 # }}}
 
 
+def cache_resource(output, request):
+    ' The resource used to identify the body of output in the compressed cache '
+    name = getattr(output, 'name', None)
+    if getattr(output, 'use_sendfile', False) and isinstance(name, str):
+        return name
+    return request.request_original_uri or '/'.join(request.path)
+
+
 def get_range_parts(ranges, content_type, content_length):  # {{{
 
     def part(r):
@@ -314,13 +477,10 @@ def __init__(self, output, etag=None, content_length=None):
 def filesystem_file_output(output, outheaders, stat_result):
     etag = getattr(output, 'etag', None)
     if etag is None:
-        oname = output.name or ''
-        if not isinstance(oname, string_or_bytes):
-            oname = str(oname)
-        etag = hashlib.sha1((str(stat_result.st_mtime) + force_unicode(oname)).encode('utf-8')).hexdigest()
+        etag = filesystem_etag(output.name or '', stat_result.st_mtime)
     else:
         output = output.output
-    etag = f'"{etag}"'
+        etag = f'"{etag}"'
     self = ReadableOutput(output, etag=etag, content_length=stat_result.st_size)
     self.name = output.name
     self.use_sendfile = True
@@ -448,7 +608,11 @@ def prepare_response(self, inheaders, request_body_file):
             self.remote_addr, self.remote_port, self.is_trusted_ip,
             self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri
         )
-        self.queue_job(self.run_request_handler, data)
+        if self.classify_request is None:
+            self.queue_job(self.run_request_handler, data)
+        else:
+            lane, limit_key, limit = self.classify_request(data)
+            self.queue_job(self.run_request_handler, data, lane=lane, limit_key=limit_key, limit=limit)
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
@@ -676,8 +840,13 @@ def finalize_output(self, output, request, is_http1):
         ct = outheaders.get('Content-Type', '').partition(';')[0]
         compressible = (not ct or ct.startswith(('text/', 'image/svg')) or ct.partition(';')[0] in COMPRESSIBLE_TYPES)
         compressible = (compressible and request.status_code == http_client.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and not is_http1)
+        compressed = None
+        if compressible:
+            accepted = accepted_encodings(request.inheaders.get('Accept-Encoding', ''))
+            if output.etag and self.compressed_cache is not None:
+                compressed = self.compressed_cache.get(cache_resource(output, request), output.etag, accepted)
+            compressible = compressed is not None or 'gzip' in accepted
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http_client.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -705,14 +874,23 @@ def finalize_output(self, output, request, is_http1):
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
         if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+            outheaders.set('Vary', 'Accept-Encoding', replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', f'{output.content_length}')
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
-        if output.content_length is not None and not compressible and not ranges:
+            if compressed is None:
+                outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+                if self.compressed_cache is not None:
+                    self.compressed_cache.compress_output(cache_resource(output, request), output)
+                output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            else:
+                encoding, data = compressed
+                outheaders.set('Content-Encoding', encoding, replace_all=True)
+                output = ReadableOutput(ReadOnlyFileBuffer(data), etag=output.etag, content_length=len(data))
+                output.accept_ranges, output.ranges = False, None
+        if output.content_length is not None and not ranges:
             outheaders.set('Content-Length', f'{output.content_length}', replace_all=True)
 
-        if compressible or output.content_length is None:
+        if output.content_length is None:
             outheaders.set('Transfer-Encoding', 'chunked', replace_all=True)
 
         if ranges:
@@ -731,10 +909,13 @@ def finalize_output(self, output, request, is_http1):
         return output
 
 
-def create_http_handler(handler=None, websocket_handler=None):
+def create_http_handler(handler=None, websocket_handler=None, classify_request=None, static_files=None):
     from calibre.srv.web_socket import WebSocketConnection
     static_cache = {}
     translator_cache = {}
+    compressed_cache = CompressedCache()
+    if static_files is not None:
+        compressed_cache.precompress(static_files)
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -744,8 +925,10 @@ def dummy_http_handler(data):
     def wrapper(*args, **kwargs):
         ans = WebSocketConnection(*args, **kwargs)
         ans.request_handler = handler
+        ans.classify_request = classify_request
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
+        ans.compressed_cache = compressed_cache
         ans.translator_cache = translator_cache
         return ans
     return wrapper
@@ -11,7 +11,7 @@
 from calibre.constants import __appname__
 from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata import authors_to_string
-from calibre.srv.content import book_filename, get
+from calibre.srv.content import book_filename, get, get_lane
 from calibre.srv.errors import HTTPBadRequest, HTTPRedirect
 from calibre.srv.routes import endpoint
 from calibre.srv.utils import get_library_data, http_date
@@ -276,7 +276,7 @@ def stanza(ctx, rd, rest):
     raise HTTPRedirect(ctx.url_for('/opds'))
 
 
-@endpoint('/legacy/get/{what}/{book_id}/{library_id}/{+filename=""}', android_workaround=True)
+@endpoint('/legacy/get/{what}/{book_id}/{library_id}/{+filename=""}', android_workaround=True, lane=get_lane)
 def legacy_get(ctx, rd, what, book_id, library_id, filename):
     # See https://www.mobileread.com/forums/showthread.php?p=3531644 for why
     # this is needed for Kobo browsers
@@ -7,12 +7,15 @@
 import ipaddress
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
 from contextlib import suppress
 from functools import lru_cache, partial
+from heapq import heappop, heappush
 from io import BytesIO
+from threading import Lock
 
 from calibre import as_unicode
 from calibre.constants import iswindows
@@ -20,7 +23,7 @@
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.jobs import JobsManager
 from calibre.srv.opts import Options
-from calibre.srv.pool import PluginPool, ThreadPool
+from calibre.srv.pool import METADATA, PluginPool, ThreadPool
 from calibre.srv.utils import (
     DESIRED_SEND_BUFFER_SIZE,
     HandleInterrupt,
@@ -43,6 +46,10 @@
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = b'\0', b'\x01'
 IPPROTO_IPV6 = getattr(socket, 'IPPROTO_IPV6', 41)
+INTEREST = {
+    READ: selectors.EVENT_READ, WRITE: selectors.EVENT_WRITE,
+    RDWR: selectors.EVENT_READ | selectors.EVENT_WRITE, WAIT: 0,
+}
 
 
 class ReadBuffer:  # {{{
@@ -352,11 +359,11 @@ def close(self):
         except OSError:
             pass
 
-    def queue_job(self, func, *args):
+    def queue_job(self, func, *args, lane=METADATA, limit_key=None, limit=None):
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, lane=lane, limit_key=limit_key, limit=limit)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -390,6 +397,64 @@ def parsed_trusted_ips(raw):
     return tuple(parse_trusted_ips(raw)) if raw else ()
 
 
+class TimerWheel:  # {{{
+
+    '''
+    Tracks connection inactivity deadlines in coarse buckets, so that finding
+    timed out connections does not require looking at every connection on
+    every tick. Connections update their last_activity without telling the
+    wheel, so when a bucket expires its connections are checked and the ones
+    that have seen activity in the meantime are simply re-scheduled.
+    '''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.resolution = max(0.001, min(1.0, timeout / 8))
+        self.buckets = {}
+        self.heap = []
+        self.slot_for = {}
+
+    def __len__(self):
+        return len(self.slot_for)
+
+    def schedule(self, s, last_activity):
+        slot = int((last_activity + self.timeout) / self.resolution) + 1
+        old = self.slot_for.get(s)
+        if old == slot:
+            return
+        if old is not None:
+            self.buckets[old].discard(s)
+        self.slot_for[s] = slot
+        b = self.buckets.get(slot)
+        if b is None:
+            self.buckets[slot] = b = set()
+            heappush(self.heap, slot)
+        b.add(s)
+
+    def discard(self, s):
+        slot = self.slot_for.pop(s, None)
+        if slot is not None:
+            self.buckets[slot].discard(s)
+
+    def expired(self, now):
+        ' Remove and return all sockets whose deadline bucket has expired '
+        ans = []
+        limit = now / self.resolution
+        while self.heap and self.heap[0] <= limit:
+            for s in self.buckets.pop(heappop(self.heap)):
+                del self.slot_for[s]
+                ans.append(s)
+        return ans
+
+    def time_to_next_expiry(self, now, default):
+        while self.heap and not self.buckets[self.heap[0]]:
+            del self.buckets[heappop(self.heap)]
+        if self.heap:
+            return max(0, min(default, self.heap[0] * self.resolution - now))
+        return default
+# }}}
+
+
 class ServerLoop:
 
     LISTENING_MSG = 'calibre server listening on'
@@ -420,6 +485,12 @@ def __init__(
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.selector = None
+        self.registered_events = {}
+        self.pending_reads = set()
+        self.dirty_connections = set()
+        self.dirty_lock = Lock()
+        self.timer_wheel = TimerWheel(self.opts.timeout)
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -437,7 +508,7 @@ def __init__(
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count, max_count=self.opts.max_worker_count)
         self.plugin_pool = PluginPool(self, plugins)
 
     def on_ssl_servername(self, socket, server_name, ssl_context):
@@ -527,8 +598,16 @@ def serve(self):
         from calibre.utils.network import format_addr_for_url
 
         self.connection_map = {}
+        self.registered_events = {}
+        self.pending_reads = set()
+        with self.dirty_lock:
+            self.dirty_connections = set()
+        self.timer_wheel = TimerWheel(self.opts.timeout)
         if not self.socket_was_preactivated:
             self.socket.listen(min(socket.SOMAXCONN, 128))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+        self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
         self.bound_address = ba = self.socket.getsockname()
         ba_str = ''
         if isinstance(ba, tuple):
@@ -584,61 +663,33 @@ def bind(self, family, atype, proto=0):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in iteritems(self.connection_map):
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
-                if conn.read_buffer.has_data:
-                    readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
-            self.close(s, conn)
-
-        for x, conn in close_needed:
-            self.close(s, conn)
-
-        if readable:
-            writable = []
-        else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
-                self.ready = False
-                self.log.error('Listening socket was unexpectedly terminated')
-                return
-            except OSError as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
-                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
-                    return
-                for s, conn in tuple(iteritems(self.connection_map)):
-                    try:
-                        select.select([s], [], [], 0)
-                    except OSError as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
+        self.expire_connections(now)
+        if self.socket is None or self.socket.fileno() == -1:
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            return
+        # Connections with already buffered data must be handled without
+        # waiting, otherwise wait until the next inactivity deadline at most
+        timeout = 0 if self.pending_reads else self.timer_wheel.time_to_next_expiry(now, self.opts.timeout)
+        try:
+            events = self.selector.select(timeout)
+        except OSError as e:
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                 return
+            for s, conn in tuple(iteritems(self.connection_map)):
+                try:
+                    select.select([s], [], [], 0)
+                except OSError as e:
+                    if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
+                        self.close(s, conn)  # Bad socket, discard
+            return
+        readable, writable = dict.fromkeys(self.pending_reads), []
+        self.pending_reads = set()
+        for key, mask in events:
+            if mask & selectors.EVENT_READ:
+                readable[key.fd] = None
+            if mask & selectors.EVENT_WRITE:
+                writable.append(key.fd)
 
         if not self.ready:
             return
@@ -680,6 +731,67 @@ def tick(self):
                     else:
                         self.log.error(f'Error in SSL handshake, terminating connection: {as_unicode(e)}')
                         self.close(s, conn)
+            if self.connection_map.get(s) is conn:
+                self.update_registration(s, conn)
+
+    def update_registration(self, s, conn):
+        ' Tell the selector about changes in what the connection is waiting for '
+        events = INTEREST[conn.wait_for]
+        current = self.registered_events.get(s, 0)
+        if events != current:
+            if not events:
+                self.selector.unregister(s)
+                del self.registered_events[s]
+            elif current:
+                self.selector.modify(s, events, conn)
+                self.registered_events[s] = events
+            else:
+                self.selector.register(s, events, conn)
+                self.registered_events[s] = events
+        if events & selectors.EVENT_READ:
+            if not conn.read_buffer.has_data and self.ssl_context is not None and conn.socket.pending():
+                # Decrypted data buffered inside the SSL object is invisible
+                # to the selector
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    self.close(s, conn)
+                    return
+            if conn.read_buffer.has_data:
+                self.pending_reads.add(s)
+                return
+        self.pending_reads.discard(s)
+
+    def sync_registrations(self):
+        # Connections can change what they are waiting for from other threads,
+        # for example when a websocket message is queued, followed by a call
+        # to wakeup(), which marks them dirty, so re-register only those
+        with self.dirty_lock:
+            dirty, self.dirty_connections = self.dirty_connections, set()
+        for s in dirty:
+            conn = self.connection_map.get(s)
+            if conn is not None:
+                self.update_registration(s, conn)
+
+    def expire_connections(self, now):
+        timeout = self.opts.timeout
+        if self.timer_wheel.timeout != timeout:
+            self.timer_wheel = TimerWheel(timeout)
+            for s, conn in iteritems(self.connection_map):
+                self.timer_wheel.schedule(s, conn.last_activity)
+        for s in self.timer_wheel.expired(now):
+            conn = self.connection_map.get(s)
+            if conn is None:
+                continue
+            if now - conn.last_activity > timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                    self.update_registration(s, conn)
+                else:
+                    self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
+                    self.close(s, conn)
+                    continue
+            if self.connection_map.get(s) is conn:
+                self.timer_wheel.schedule(s, conn.last_activity)
 
     def write_to_control(self, what):
         if iswindows:
@@ -688,7 +800,11 @@ def write_to_control(self, what):
             self.control_in.write(what)
             self.control_in.flush()
 
-    def wakeup(self):
+    def wakeup(self, s=None):
+        ' Wake up the loop, s is the socket of a connection whose wait_for was changed from another thread '
+        if s is not None:
+            with self.dirty_lock:
+                self.dirty_connections.add(s)
         self.write_to_control(WAKEUP)
 
     def job_completed(self):
@@ -706,6 +822,11 @@ def dispatch_job_results(self):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.timer_wheel.discard(s)
+        self.pending_reads.discard(s)
+        if self.registered_events.pop(s, None):
+            with suppress(KeyError, ValueError):
+                self.selector.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -718,7 +839,9 @@ def get_actions(self, readable, writable):
                     s = sock.fileno()
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
-                            sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                            sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, partial(self.wakeup, s))
+                        self.timer_wheel.schedule(s, conn.last_activity)
+                        self.update_registration(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -734,14 +857,16 @@ def get_actions(self, readable, writable):
                     for s, conn, event in self.dispatch_job_results():
                         yield s, conn, event
                 elif c == WAKEUP:
-                    pass
+                    self.sync_registrations()
                 elif not c:
                     if not self.ready:
                         return
                     self.log.error('Control connection failed to read after signalling ready')
                     raise Exception('Control connection failed to read, something bad happened')
             else:
-                yield s, self.connection_map[s], READ
+                conn = self.connection_map.get(s)
+                if conn is not None:
+                    yield s, conn, READ
         for s in writable:
             try:
                 conn = self.connection_map[s]
@@ -775,6 +900,9 @@ def shutdown(self):
             if pool.workers:
                 self.log.warn(f'Failed to shutdown {len(pool.workers)} workers in {pool.__class__.__name__} cleanly')
         self.jobs_manager.wait_for_shutdown(wait_till)
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
 
 
 class EchoLine(Connection):  # {{{
@@ -813,6 +941,64 @@ def echo(self, event):
 # }}}
 
 
+def benchmark(num_connections=2000, num_requests=1000):
+    '''
+    Measure how the server loop copes with many idle keep-alive connections.
+    Opens num_connections idle connections to an echo server, then times
+    num_requests round trips on one more connection and reports the CPU
+    time used by the process while doing so. Run with:
+    calibre-debug -c "from calibre.srv.loop import benchmark; benchmark()"
+    '''
+    import time
+    from threading import Thread
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = 2 * num_connections + 64
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            with suppress(Exception):
+                resource.setrlimit(resource.RLIMIT_NOFILE, (needed if hard == resource.RLIM_INFINITY else min(needed, hard), hard))
+    s = ServerLoop(EchoLine, opts=Options(listen_on='127.0.0.1', port=0, timeout=600), log=ThreadSafeLog(level=ThreadSafeLog.WARN))
+    s.LISTENING_MSG = None
+    t = Thread(target=s.serve_forever, name='BenchmarkServer', daemon=True)
+    t.start()
+    while not s.ready and t.is_alive():
+        time.sleep(0.01)
+    if not s.ready:
+        raise SystemExit('Server failed to start')
+    address = s.bound_address[:2]
+    idle = []
+    try:
+        for i in range(num_connections):
+            idle.append(socket.create_connection(address))
+        while s.num_active_connections < num_connections and t.is_alive():
+            time.sleep(0.01)
+        active = socket.create_connection(address)
+        idle.append(active)
+        latencies = []
+        cpu_start, start = time.process_time(), monotonic()
+        for i in range(num_requests):
+            st = monotonic()
+            active.sendall(b'ping\n')
+            received = b''
+            while not received.endswith(b'\n'):
+                received += active.recv(64)
+            latencies.append(monotonic() - st)
+        elapsed, cpu = monotonic() - start, time.process_time() - cpu_start
+    finally:
+        for c in idle:
+            c.close()
+        s.stop()
+        t.join(5)
+    latencies.sort()
+    print(f'Idle connections: {num_connections} Round trips: {num_requests} in {elapsed:.2f} seconds using {cpu:.2f} seconds of CPU')
+    median, p99, worst = 1000 * latencies[len(latencies) // 2], 1000 * latencies[int(len(latencies) * 0.99)], 1000 * latencies[-1]
+    print(f'Latency (ms): median: {median:.3f} p99: {p99:.3f} max: {worst:.3f}')
+
+
 def main():
     print('Starting Echo server')
     s = ServerLoop(EchoLine)
@@ -21,6 +21,7 @@
 from calibre.library.comments import comments_to_html
 from calibre.srv.errors import HTTPInternalServerError, HTTPNotFound
 from calibre.srv.http_request import parse_uri
+from calibre.srv.pool import GENERATION
 from calibre.srv.routes import endpoint
 from calibre.srv.utils import Offsets, get_library_data, http_date
 from calibre.utils.config import prefs
@@ -356,7 +357,7 @@ def __init__(self, items, which, id_, updated, request_context, offsets, page_ur
 class RequestContext:
 
     def __init__(self, ctx, rd):
-        self.db, self.library_id, self.library_map, self.default_library = get_library_data(ctx, rd)
+        self.db, self.library_id, self.library_map, self.default_library = get_library_data(ctx, rd, for_reading=True)
         self.ctx, self.rd = ctx, rd
 
     def url_for(self, path, **kwargs):
@@ -524,7 +525,7 @@ def opds_navcatalog(ctx, rd, which):
     raise HTTPNotFound('Not found')
 
 
-@endpoint('/opds/category/{category}/{which}', postprocess=atom)
+@endpoint('/opds/category/{category}/{which}', postprocess=atom, lane=GENERATION)
 def opds_category(ctx, rd, category, which):
     try:
         offset = int(rd.query.get('offset', 0))
@@ -575,7 +576,7 @@ def opds_category(ctx, rd, category, which):
     return get_acquisition_feed(rc, ids, offset, page_url, up_url, 'calibre-category:'+category+':'+str(which), sort_by=sort_by)
 
 
-@endpoint('/opds/categorygroup/{category}/{which}', postprocess=atom)
+@endpoint('/opds/categorygroup/{category}/{which}', postprocess=atom, lane=GENERATION)
 def opds_categorygroup(ctx, rd, category, which):
     try:
         offset = int(rd.query.get('offset', 0))
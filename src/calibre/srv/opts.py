@@ -70,6 +70,12 @@ def __new__(cls, *args):
     'worker_count', 10,
     None,
 
+    _('Maximum number of worker threads used to process requests'),
+    'max_worker_count', 0,
+    _('When all worker threads are busy, more are started, up to this number, and'
+      ' stopped again once they have been idle for a while. Set to zero to allow'
+      ' up to three times the number of worker threads.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -132,6 +138,18 @@ def __new__(cls, *args):
     _('The maximum size of log files, generated by the server. When the log becomes larger'
     ' than this size, it is automatically rotated. Set to zero to disable log rotation.'),
 
+    _('Max. size of the file cache (in MB)'),
+    'max_file_cache_size', 1024,
+    _('Book files and covers are copied out of the library into a temporary cache'
+    ' before being sent to clients. When the cache grows larger than this size, the'
+    ' least recently used files are removed from it. Set to zero for no limit.'),
+
+    _('Max. size of the thumbnail cache (in MB)'),
+    'max_thumbnail_cache_size', 256,
+    _('Cover thumbnails are stored in a cache that persists across server restarts.'
+    ' When the cache grows larger than this size, the least recently used thumbnails'
+    ' are removed from it. Set to zero for no limit.'),
+
     _('Log HTTP 404 (Not Found) requests'),
     'log_not_found', True,
     _('Normally, the server logs all HTTP requests for resources that are not found.'
@@ -196,6 +214,15 @@ def __new__(cls, *args):
       ' option, any fields not in this list will not be displayed. For example: {}').format(
       'my_rating,my_tags'),
 
+    _('Read library data from snapshots'),
+    'snapshot_reads', False,
+    _('Normally, requests that only read book lists and metadata have to wait while'
+      ' changes are being made to a library. If you turn on this option, such requests'
+      ' are served from a snapshot of the library metadata instead, so they never wait.'
+      ' The snapshot is refreshed in the background after changes and so may briefly'
+      ' not reflect the very latest changes. Uses more memory, since a second copy of'
+      ' the metadata is kept.'),
+
     _('Choose the default book list mode'),
     'book_list_mode', Choices('cover_grid', 'details_list', 'custom_list'),
     _('Set the default book list mode that will be used for new users. Individual users'
@@ -5,75 +5,180 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
-from threading import Thread
+from collections import Counter, deque, namedtuple
+from threading import Condition, Lock, Thread
 
 from calibre.utils.monotonic import monotonic
 from polyglot.queue import Full, Queue
 
+# The lanes requests are queued in, in priority order. Cheap requests such as
+# metadata, covers and thumbnails are always picked first.
+METADATA, FILE_IO, GENERATION = 'metadata', 'io', 'generation'
+LANES = (METADATA, FILE_IO, GENERATION)
+# The fraction of the maximum number of workers that requests from a lane can
+# occupy, so that slow requests can never starve cheap ones
+LANE_SHARE = {METADATA: 1.0, FILE_IO: 0.75, GENERATION: 0.5}
+
+Job = namedtuple('Job', 'job_id func lane limit_key limit queued_at')
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
-        self.notify_server = notify_server
-        self.log = log
+    def __init__(self, pool, num):
+        self.pool = pool
         self.working = False
         Thread.__init__(self, name=f'ServerWorker{num}')
 
     def run(self):
+        pool = self.pool
         while True:
-            x = self.request_queue.get()
-            if x is None:
+            job = pool.next_job(self)
+            if job is None:
                 break
-            job_id, func = x
             self.working = True
             try:
-                result = func()
+                result = job.func()
             except Exception:
-                self.handle_error(job_id)  # must be a separate function to avoid reference cycles with sys.exc_info()
+                self.handle_error(job.job_id)  # must be a separate function to avoid reference cycles with sys.exc_info()
             else:
-                self.result_queue.put((job_id, True, result))
+                pool.result_queue.put((job.job_id, True, result))
             finally:
                 self.working = False
+                pool.job_finished(job)
             try:
-                self.notify_server()
+                pool.notify_server()
             except Exception:
-                self.log.exception('ServerWorker failed to notify server on job completion')
+                pool.log.exception('ServerWorker failed to notify server on job completion')
 
     def handle_error(self, job_id):
-        self.result_queue.put((job_id, False, sys.exc_info()))
+        self.pool.result_queue.put((job_id, False, sys.exc_info()))
 
 
 class ThreadPool:
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
+    '''
+    A pool of worker threads that grows from count up to max_count workers when
+    all workers are busy and shrinks back once the extra workers have been idle
+    for idle_timeout seconds. Jobs are queued in one of the :data:`LANES` and
+    can be limited in how many of them run concurrently, see :meth:`put_nowait`.
+    '''
+
+    wait_sample_size = 512
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, max_count=0, idle_timeout=60):
+        self.log, self.notify_server = log, notify_server
+        self.min_workers = max(1, count)
+        self.max_workers = max(self.min_workers, max_count or 3 * self.min_workers)
+        self.queue_size, self.idle_timeout = queue_size, idle_timeout
+        self.lock = Lock()
+        self.has_work = Condition(self.lock)
+        self.lanes = {lane: deque() for lane in LANES}
+        self.lane_limits = {lane: max(1, int(self.max_workers * LANE_SHARE[lane])) for lane in LANES}
+        self.running_in_lane = dict.fromkeys(LANES, 0)
+        self.running_for_key = Counter()
+        self.num_queued = self.num_idle = 0
+        self.started = self.shutting_down = False
+        self.wait_times = {lane: deque(maxlen=self.wait_sample_size) for lane in LANES}
+        self.max_wait_times = dict.fromkeys(LANES, 0.)
+        self.num_processed = dict.fromkeys(LANES, 0)
+        self.result_queue = Queue(queue_size)
+        self.num_created = 0
+        self.workers = [self.create_worker() for i in range(self.min_workers)]
+
+    def create_worker(self):
+        self.num_created += 1
+        return Worker(self, self.num_created - 1)
 
     def start(self):
-        for w in self.workers:
-            w.start()
-
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+        with self.lock:
+            self.started = True
+            for w in self.workers:
+                w.start()
+
+    def put_nowait(self, job_id, func, lane=METADATA, limit_key=None, limit=None):
+        '''
+        Queue func to be run in a worker thread. At most limit jobs with the
+        same limit_key run simultaneously, other jobs are picked in their
+        place. Raises Full if too many jobs are already queued.
+        '''
+        if lane not in self.lanes:
+            lane = METADATA
+        if not limit:
+            limit_key = None
+        with self.lock:
+            if self.num_queued >= self.queue_size:
+                raise Full()
+            self.lanes[lane].append(Job(job_id, func, lane, limit_key, limit, monotonic()))
+            self.num_queued += 1
+            if self.started and not self.shutting_down and self.num_queued > self.num_idle and len(self.workers) < self.max_workers:
+                w = self.create_worker()
+                self.workers.append(w)
+                w.start()
+            self.has_work.notify()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
+    def pick_job(self):
+        # Must be called with self.lock held
+        for lane in LANES:
+            q = self.lanes[lane]
+            if not q or self.running_in_lane[lane] >= self.lane_limits[lane]:
+                continue
+            for i, job in enumerate(q):
+                if job.limit_key is None or self.running_for_key[job.limit_key] < job.limit:
+                    del q[i]
+                    self.num_queued -= 1
+                    self.running_in_lane[lane] += 1
+                    if job.limit_key is not None:
+                        self.running_for_key[job.limit_key] += 1
+                    wait = monotonic() - job.queued_at
+                    self.wait_times[lane].append(wait)
+                    self.max_wait_times[lane] = max(self.max_wait_times[lane], wait)
+                    self.num_processed[lane] += 1
+                    return job
+
+    def next_job(self, worker):
+        timed_out = False
+        with self.lock:
+            while not self.shutting_down:
+                job = self.pick_job()
+                if job is not None:
+                    return job
+                if timed_out and len(self.workers) > self.min_workers:
+                    self.workers.remove(worker)
+                    return
+                self.num_idle += 1
+                try:
+                    timed_out = not self.has_work.wait(self.idle_timeout)
+                finally:
+                    self.num_idle -= 1
+
+    def job_finished(self, job):
+        with self.lock:
+            self.running_in_lane[job.lane] -= 1
+            if job.limit_key is not None:
+                self.running_for_key[job.limit_key] -= 1
+                if not self.running_for_key[job.limit_key]:
+                    del self.running_for_key[job.limit_key]
+            if self.num_queued:
+                # Jobs held back by a lane or concurrency limit may now be runnable
+                self.has_work.notify()
+
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
-        for w in self.workers:
+        with self.lock:
+            self.shutting_down = True
+            self.has_work.notify_all()
+            workers = tuple(self.workers)
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        with self.lock:
+            self.workers = [w for w in self.workers if w.is_alive()]
 
     @property
     def busy(self):
@@ -83,6 +188,28 @@ def busy(self):
     def idle(self):
         return sum(int(not w.working) for w in self.workers)
 
+    def stats(self):
+        '''
+        Return the number of workers and, for every lane, the number of queued,
+        running and processed jobs along with the times jobs spent waiting in
+        the queue (in seconds). The mean and 95th percentile are over the most
+        recently picked jobs.
+        '''
+        with self.lock:
+            lanes = {}
+            for lane in LANES:
+                waits = sorted(self.wait_times[lane])
+                lanes[lane] = {
+                    'queued': len(self.lanes[lane]), 'running': self.running_in_lane[lane], 'limit': self.lane_limits[lane],
+                    'processed': self.num_processed[lane], 'max_wait': self.max_wait_times[lane],
+                    'mean_wait': sum(waits) / len(waits) if waits else 0.,
+                    'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0.,
+                }
+            return {
+                'workers': len(self.workers), 'min_workers': self.min_workers, 'max_workers': self.max_workers,
+                'busy': self.busy, 'lanes': lanes,
+            }
+
 
 class PluginPool:
 
@@ -14,6 +14,7 @@
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPNotFound, HTTPSimpleResponse, RouteError
+from calibre.srv.pool import METADATA
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import MSGPACK_MIME, json_dumps, msgpack_dumps
 from polyglot import http_client
@@ -74,7 +75,16 @@ def endpoint(route,
              postprocess=None,
 
              # Needs write access to the calibre database
-             needs_db_write=False
+             needs_db_write=False,
+
+             # The worker pool lane requests for this endpoint are queued in,
+             # one of the lanes from calibre.srv.pool. Can also be a function
+             # that is passed the route variables and returns the lane.
+             lane=METADATA,
+
+             # Max. number of requests for this endpoint processed
+             # simultaneously, None for no limit
+             max_concurrency=None
 
 ):
     from calibre.srv.handler import Context
@@ -92,6 +102,8 @@ def annotate(f):
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.lane = lane
+        f.max_concurrency = max_concurrency
         argspec = inspect.getfullargspec(f)
         if len(argspec.args) < 2:
             raise TypeError(f'The endpoint {f.route!r} must take at least two arguments')
@@ -284,6 +296,20 @@ def find_route(self, path):
                     return route.endpoint, args
         raise HTTPNotFound()
 
+    def classify(self, data):
+        ' Return the worker pool lane, concurrency key and concurrency limit for the request '
+        try:
+            endpoint_, args = self.find_route(data.path)
+        except Exception:
+            return METADATA, None, None
+        lane = endpoint_.lane
+        if callable(lane):
+            try:
+                lane = lane(*args)
+            except Exception:
+                lane = METADATA
+        return lane, endpoint_.route_key, endpoint_.max_concurrency
+
     def read_cookies(self, data):
         data.cookies = c = {}
 
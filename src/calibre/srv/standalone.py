@@ -74,7 +74,8 @@ def __init__(self, libraries, opts):
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(
+                self.handler.dispatch, classify_request=self.handler.classify_request, static_files=self.handler.static_files),
             opts=opts,
             log=log,
             access_log=access_log,
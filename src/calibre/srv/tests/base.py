@@ -173,7 +173,7 @@ def __init__(self, library_path, libraries=(), plugins=(), **kwargs):
         self.libraries = libraries or (library_path,)
         self.handler = Handler(self.libraries, opts, testing=True)
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, classify_request=self.handler.classify_request),
             opts=opts,
             plugins=plugins,
             log=ServerLog(level=ServerLog.DEBUG),
@@ -180,6 +180,26 @@ def change_cover(count, book_id=2):
             self.ae(identify(data), ('jpeg', 100, 100))
             self.ae(r.getheader('Used-Cache'), 'no')
 
+            # Test background generation of thumbnails for changed covers
+            store = server.handler.router.ctx.thumbnail_store
+            db.set_cover({3:I('lt.png', data=True)})
+            path = store.path_for(db, 3, db.cover_last_modified(3), 100, 100)
+            for i in range(500):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.01)
+            r, data = get('thumb', 3, q='sz=100')
+            self.ae(r.status, http_client.OK)
+            self.ae(identify(data), ('jpeg', 100, 100))
+            self.ae(r.getheader('Used-Cache'), 'yes')
+            self.ae(from_hex_unicode(r.getheader('Tempfile')), path)
+            db.set_cover({3:None})
+            for i in range(500):
+                if not os.path.exists(path):
+                    break
+                time.sleep(0.01)
+            self.assertFalse(os.path.exists(path))
+
             # Test file sharing in cache
             r, data = get('cover', 2)
             self.ae(r.status, http_client.OK)
@@ -230,6 +250,160 @@ def change_cover(count, book_id=2):
 
     # }}}
 
+    def test_file_cache(self):  # {{{
+        'Test the cache of files copied out of the library'
+        from threading import Event, Thread
+        from types import SimpleNamespace
+
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.content import create_file_copy, file_cache, reset_caches
+
+        with TemporaryDirectory() as tdir:
+            ctx = SimpleNamespace(testing=True, opts=SimpleNamespace(max_file_cache_size=1))
+            calls, results = [], {}
+            started, release = Event(), Event()
+
+            def rd():
+                return SimpleNamespace(tdir=tdir, outheaders={}, filesystem_file_with_custom_etag=lambda f, *a: f)
+
+            def get(book_id, size=1024, mtime=1, block=False, key=None):
+                def copy_func(dest):
+                    calls.append(book_id)
+                    if block:
+                        started.set()
+                        release.wait(10)
+                    dest.write(b'x' * size)
+                r = rd()
+                with create_file_copy(ctx, r, 'fmt', 'lib', book_id, 'txt', mtime, copy_func) as f:
+                    results[book_id if key is None else key] = f.read(), r.outheaders['Used-Cache']
+                return from_hex_unicode(r.outheaders['Tempfile'])
+
+            reset_caches()
+            try:
+                # Concurrent requests for the same file share a single copy
+                # and do not block requests for other files
+                threads = [Thread(target=get, args=(1,), kwargs={'block': True, 'key': f'thread-{i}'}) for i in range(3)]
+                threads[0].start()
+                self.assertTrue(started.wait(10))
+                for t in threads[1:]:
+                    t.start()
+                get(2)
+                self.ae(results[2], (b'x' * 1024, 'no'))
+                release.set()
+                for t in threads:
+                    t.join(10)
+                self.ae(calls, [1, 2])
+                self.ae(sorted(results[f'thread-{i}'][1] for i in range(3)), ['no', 'yes', 'yes'])
+                self.assertTrue(all(results[f'thread-{i}'][0] == b'x' * 1024 for i in range(3)))
+
+                # The least recently used files are removed when the cache grows too large
+                reset_caches()
+                size = 400 * 1024
+                paths = {book_id: get(book_id, size=size, mtime=2) for book_id in (3, 4, 5)}
+                self.assertFalse(os.path.exists(paths[3]))
+                self.assertTrue(os.path.exists(paths[4]) and os.path.exists(paths[5]))
+                get(4, size=size, mtime=2)
+                self.ae(results[4][1], 'yes')
+                paths[6] = get(6, size=size, mtime=2)
+                self.assertFalse(os.path.exists(paths[5]))
+                self.assertTrue(os.path.exists(paths[4]) and os.path.exists(paths[6]))
+                self.ae(file_cache.total_size, 2 * size)
+
+                # Files that are still open are not removed
+                reset_caches()
+                r = rd()
+                f = create_file_copy(ctx, r, 'fmt', 'lib', 7, 'txt', 2, lambda dest: dest.write(b'x' * size))
+                paths[7] = from_hex_unicode(r.outheaders['Tempfile'])
+                paths.update((book_id, get(book_id, size=size, mtime=2)) for book_id in (8, 9))
+                self.assertTrue(os.path.exists(paths[7]))
+                self.assertFalse(os.path.exists(paths[8]))
+                self.ae(f.read(), b'x' * size)
+                f.close()
+                get(10, size=size, mtime=2)
+                self.assertFalse(os.path.exists(paths[7]))
+                self.assertTrue(os.path.exists(paths[9]))
+            finally:
+                reset_caches()
+    # }}}
+
+    def test_thumbnail_batches(self):  # {{{
+        'Test that covers are staged for only one thumbnail generation job at a time'
+        from datetime import datetime, timezone
+        from types import SimpleNamespace
+
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.thumbnails import ThumbnailStore
+
+        class DB:
+            library_id = 'lib'
+
+            def add_cover_cache(self, listener):
+                self.listener = listener
+
+            def cover_last_modified(self, book_id):
+                return datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+            def copy_cover_to(self, book_id, dest):
+                dest.write(b'cover')
+
+        class JobsManager:
+
+            def __init__(self):
+                self.jobs = []
+
+            def start_job(self, name, module, func, args=(), job_done_callback=None, job_data=None):
+                self.jobs.append((job_done_callback, job_data))
+                return len(self.jobs)
+
+            def job_status(self, job_id):
+                return 'running', None, None, None
+
+        with TemporaryDirectory() as tdir:
+            store = ThumbnailStore(tdir)
+            store.batch_size = 2
+            store.jobs_manager = jm = JobsManager()
+            db = DB()
+            store.watch(db)
+            store.size_requested(60, 80)
+            db.listener.invalidate(range(1, 6))
+            staging = os.path.join(tdir, 'staging')
+            for num_jobs in (1, 2, 3):
+                for i in range(500):
+                    if len(jm.jobs) == num_jobs:
+                        break
+                    time.sleep(0.01)
+                time.sleep(0.05)
+                self.ae(len(jm.jobs), num_jobs)
+                self.ae(len(os.listdir(staging)), 1 if num_jobs == 3 else 2)
+                callback, data = jm.jobs[-1]
+                callback(SimpleNamespace(data=data, result=None))
+            for i in range(500):
+                if store.worker is None:
+                    break
+                time.sleep(0.01)
+            self.assertIsNone(store.worker)
+            self.ae(os.listdir(staging), [])
+    # }}}
+
+    def test_generate_thumbnails(self):  # {{{
+        'Test that a corrupt cover does not prevent thumbnails being generated for the other covers'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.thumbnails import generate_thumbnails
+
+        with TemporaryDirectory() as tdir:
+            tasks = []
+            for name, data in (('bad', b'not an image'), ('good', I('lt.png', data=True))):
+                cover_path = os.path.join(tdir, name + '.png')
+                with open(cover_path, 'wb') as f:
+                    f.write(data)
+                tasks.append((cover_path, [(os.path.join(tdir, f'{name}-{w}x{h}.jpg'), w, h) for w, h in ((60, 80), (30, 40))]))
+            ans = generate_thumbnails(tasks)
+            self.ae([path for path, size in ans], [path for path, w, h in tasks[1][1]])
+            for path, size in ans:
+                self.ae(os.path.getsize(path), size)
+            self.assertFalse(any(os.path.exists(path) for path, w, h in tasks[0][1]))
+    # }}}
+
     def test_char_count(self):  # {{{
         from calibre.ebooks.oeb.parse_utils import html5_parse
         from calibre.srv.render_book import get_length
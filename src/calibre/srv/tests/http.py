@@ -338,6 +338,45 @@ def handler(conn):
             self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
             self.ae(r.status, http_client.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
 
+            # Test caching of compressed responses
+            server.change_handler(lambda conn: conn.generate_static_output('cc', lambda: raw))
+            conn = server.connect()
+            conn.request('GET', '/cc', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            self.ae(r.getheader('Transfer-Encoding'), 'chunked')
+            self.ae(r.getheader('Vary'), 'Accept-Encoding')
+            self.ae(r.status, http_client.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
+            for i in range(500):
+                conn.request('GET', '/cc', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                data = r.read()
+                if r.getheader('Content-Length'):
+                    break
+                time.sleep(0.01)
+            self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(int(r.getheader('Content-Length')), len(data))
+            self.assertIsNone(r.getheader('Transfer-Encoding'))
+            self.ae(zlib.decompress(data, 16+zlib.MAX_WBITS), raw)
+            conn.request('GET', '/cc')
+            r = conn.getresponse()
+            self.ae(r.read(), raw), self.assertIsNone(r.getheader('Content-Encoding'))
+
+            # Different resources that share an ETag must not share cached bodies
+            server.change_handler(lambda conn: conn.etagged_dynamic_response('shared', lambda: ''.join(conn.path) * 1000))
+            conn = server.connect()
+            for i in range(500):
+                conn.request('GET', '/s1', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                data = r.read()
+                if r.getheader('Content-Length'):
+                    break
+                time.sleep(0.01)
+            self.ae(zlib.decompress(data, 16+zlib.MAX_WBITS), b's1' * 1000)
+            conn.request('GET', '/s2', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            self.ae(r.getheader('ETag'), '"shared"')
+            self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), b's2' * 1000)
+
             # Test dynamic etagged content
             num_calls = [0]
 
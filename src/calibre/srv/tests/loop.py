@@ -101,6 +101,65 @@ def test_workers(self):
             w.join()
         self.ae(0, sum(int(w.is_alive()) for w in server.loop.pool.workers))
 
+    def test_worker_pool(self):
+        ' Test worker pool lanes, limits and scaling '
+        from calibre.srv.pool import FILE_IO, GENERATION, METADATA, ThreadPool
+        from calibre.utils.logging import ThreadSafeLog
+        from polyglot.queue import Empty
+        notified = Event()
+        pool = ThreadPool(ThreadSafeLog(), notified.set, count=1, max_count=2, idle_timeout=0.1)
+        self.ae(pool.lane_limits, {METADATA: 2, FILE_IO: 1, GENERATION: 1})
+        pool.start()
+        block = Event()
+        results = {}
+
+        def wait_for_result(job_id):
+            st = monotonic()
+            while job_id not in results and monotonic() - st < 5:
+                notified.wait(0.05)
+                notified.clear()
+                while True:
+                    try:
+                        jid, ok, result = pool.get_nowait()
+                    except Empty:
+                        break
+                    results[jid] = result
+            return results.get(job_id)
+
+        pool.put_nowait(1, block.wait, lane=GENERATION)
+        pool.put_nowait(2, lambda: 'gen2', lane=GENERATION)
+        pool.put_nowait(3, lambda: 'meta', lane=METADATA)
+        # The metadata request must not wait behind the generation lane
+        self.ae(wait_for_result(3), 'meta')
+        self.ae(len(pool.workers), 2)
+        self.assertNotIn(2, results)
+        stats = pool.stats()
+        self.ae(stats['lanes'][GENERATION]['queued'], 1)
+        self.ae(stats['lanes'][GENERATION]['running'], 1)
+        self.ae(stats['lanes'][METADATA]['processed'], 1)
+        block.set()
+        self.ae(wait_for_result(2), 'gen2')
+        self.assertTrue(wait_for_result(1))
+        self.assertGreater(pool.stats()['lanes'][GENERATION]['max_wait'], 0)
+
+        # Per endpoint concurrency limits
+        block.clear()
+        pool.put_nowait(4, block.wait, limit_key='x', limit=1)
+        pool.put_nowait(5, lambda: 'x', limit_key='x', limit=1)
+        pool.put_nowait(6, lambda: 'y', limit_key='y', limit=1)
+        self.ae(wait_for_result(6), 'y')
+        self.assertNotIn(5, results)
+        block.set()
+        self.ae(wait_for_result(5), 'x')
+
+        # Extra workers exit when idle
+        st = monotonic()
+        while len(pool.workers) > 1 and monotonic() - st < 5:
+            time.sleep(0.05)
+        self.ae(len(pool.workers), 1)
+        pool.stop(monotonic() + 1)
+        self.ae(pool.workers, [])
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         with TestServer(lambda data:(data.path[0] + data.read()), listen_on='1.1.1.1', fallback_to_detected_interface=True) as server:
@@ -193,6 +252,48 @@ def set(data, rpos, wpos, state):
         set(b'123456\n7', 4, 2, READ)
         self.ae(buf.readline(), b'56\n')
 
+    def test_timer_wheel(self):
+        'Test the timer wheel used for inactivity timeouts'
+        from calibre.srv.loop import TimerWheel
+        w = TimerWheel(1)
+        w.schedule(1, 10), w.schedule(2, 10.5), w.schedule(3, 20)
+        self.ae(len(w), 3)
+        self.ae(w.expired(10.9), [])
+        self.ae(w.expired(11.2), [1])
+        w.discard(2)
+        self.ae(w.expired(12), [])
+        self.ae(len(w), 1)
+        self.assertAlmostEqual(w.time_to_next_expiry(12, 100), 9.125, places=6)
+        self.ae(w.time_to_next_expiry(12, 5), 5)
+        w.schedule(3, 30)
+        self.ae(w.expired(22), [])
+        self.ae(w.expired(32), [3])
+        self.ae(len(w), 0)
+
+    def test_many_idle_connections(self):
+        'Test that idle connections neither block nor slow down active ones'
+        with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), timeout=1) as server:
+            idle = [socket.create_connection(server.address) for i in range(100)]
+            try:
+                conn = server.connect(timeout=5)
+                for i in range(5):
+                    conn.request('GET', '/test', 'body')
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), b'testbody')
+                    if i == 0:
+                        self.ae(server.loop.num_active_connections, len(idle) + 1)
+                conn.close()
+                # Inactive connections must be closed by the timer wheel
+                st = monotonic()
+                while server.loop.num_active_connections and monotonic() - st < 5:
+                    time.sleep(0.05)
+                self.ae(server.loop.num_active_connections, 0)
+                self.ae(len(server.loop.timer_wheel), 0)
+            finally:
+                for s in idle:
+                    s.close()
+
     def test_ssl(self):
         'Test serving over SSL'
         address = '127.0.0.1'
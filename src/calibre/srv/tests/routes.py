@@ -65,6 +65,7 @@ def emr(route):
 
     def test_route_finding(self):
         'Test route finding'
+        from calibre.srv.pool import FILE_IO, METADATA
         from calibre.srv.routes import HTTPNotFound, Router, endpoint
         router = Router()
 
@@ -98,7 +99,7 @@ def soak_opt(ctx, dest, rest):
         def quoting(ctx, dest, x):
             pass
 
-        @endpoint('/get/{a}/{b=None}')
+        @endpoint('/get/{a}/{b=None}', lane=lambda a, b: FILE_IO if a == 'pdf' else METADATA, max_concurrency=2)
         def get(ctx, dest, a, b):
             pass
 
@@ -133,3 +134,11 @@ def get(ctx, dest, a, b):
         self.ae(router.url_for('/needs quoting', x='a/b c'), '/needs quoting/a%2Fb%20c')
         self.ae(router.url_for(None), '/')
         self.ae(router.url_for('/get', a='1', b='xxx'), '/get/1/xxx')
+
+        class Data:
+            def __init__(self, path):
+                self.path = list(filter(None, path.split('/')))
+        self.ae(router.classify(Data('/get/pdf/1')), (FILE_IO, '/get', 2))
+        self.ae(router.classify(Data('/get/cover/1')), (METADATA, '/get', 2))
+        self.ae(router.classify(Data('/varpath/x/y')), (METADATA, '/varpath', None))
+        self.ae(router.classify(Data('/does-not-exist/x/y')), (METADATA, None, None))
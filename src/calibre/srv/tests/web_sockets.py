@@ -7,6 +7,7 @@
 import os
 import socket
 import struct
+import time
 from collections import deque, namedtuple
 from functools import partial
 from hashlib import sha1
@@ -332,6 +333,28 @@ def test_websocket_basic(self):
             for code in (0,999,1004,1005,1006,1012,1013,1014,1015,1016,1100,2000,2999):
                 simple_test([(CLOSE, struct.pack(b'!H', code))], send_close=False, close_code=PROTOCOL_ERROR)
 
+    def test_websocket_push(self):
+        'Test sending messages from other threads to idle clients'
+        from threading import Thread
+
+        from calibre.srv.web_socket import EchoHandler
+        handler = EchoHandler()
+        with WSTestServer(lambda: handler) as server, server.connect() as client:
+            st = monotonic()
+            while not handler.ws_connections and monotonic() - st < 5:
+                time.sleep(0.01)
+            conn = handler.conn(next(iter(handler.ws_connections)))
+            # Let the connection go idle, waiting only for reads
+            time.sleep(0.1)
+            for msg in ('pushed', b'\xfe' * 65536):
+                t = Thread(target=conn.send_websocket_message, args=(msg,))
+                t.start(), t.join()
+                frames = [client.read_frame()]
+                while not frames[-1].fin:
+                    frames.append(client.read_frame())
+                self.ae(b''.join(f.payload for f in frames), msg.encode('utf-8') if isinstance(msg, str) else msg)
+                self.ae(frames[0].opcode, TEXT if isinstance(msg, str) else BINARY)
+
     def test_websocket_perf(self):
         from calibre.srv.web_socket import EchoHandler
         with WSTestServer(EchoHandler) as server:
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+import os
+import tempfile
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import suppress
+from threading import Event, Lock, Thread
+
+from calibre.utils.date import timestampfromdt
+from calibre.utils.filenames import atomic_rename
+
+
+def write_thumbnail(path, data):
+    ' Write the thumbnail atomically, so that a partially written thumbnail is never served '
+    base = os.path.dirname(path)
+    os.makedirs(base, exist_ok=True)
+    fd, tpath = tempfile.mkstemp(suffix='.tmp', dir=base)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        atomic_rename(tpath, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tpath)
+        raise
+
+
+def generate_thumbnails(tasks, compression_quality=70):
+    '''
+    Generate thumbnails, usually in a worker process. tasks is a list of
+    (cover_path, [(thumbnail_path, width, height), ...]). Returns a list of
+    (thumbnail_path, size of thumbnail) for the generated thumbnails. Covers
+    that cannot be read or scaled are skipped.
+    '''
+    from calibre.utils.img import scale_image
+    ans = []
+    for cover_path, thumbnails in tasks:
+        try:
+            with open(cover_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue
+        for path, width, height in thumbnails:
+            try:
+                tdata = scale_image(data, width=width, height=height, compression_quality=compression_quality)[-1]
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                break
+            write_thumbnail(path, tdata)
+            ans.append((path, len(tdata)))
+    return ans
+
+
+class CoverListener:
+
+    ' Registered with the database to be told when covers change or books are removed '
+
+    def __init__(self, store, db):
+        self.store, self.db = store, weakref.ref(db)
+
+    def invalidate(self, book_ids):
+        # Called with the database write lock held, so must not use the
+        # database
+        self.store.covers_changed(self.db, tuple(book_ids))
+
+
+class ThumbnailStore:
+
+    '''
+    Persistent store of cover thumbnails in multiple sizes, keyed by (book_id,
+    cover timestamp, size). As the key includes the timestamp of the cover,
+    thumbnails of an old cover are never served. When covers change,
+    thumbnails in the sizes clients have recently requested are generated in
+    the background, using the worker processes of the server, if available.
+    The least recently used thumbnails are removed once the store grows
+    larger than max_size. Only one batch of covers is staged at a time, the
+    next batch waits for the thumbnails of the previous one to be generated.
+    '''
+
+    jobs_manager = None
+    max_recent_sizes = 8
+    batch_size = 50
+
+    def __init__(self, location=None, max_size=256, compression_quality=70):
+        self.location = location
+        self.max_size = max_size * 1024 * 1024
+        self.compression_quality = compression_quality
+        self.lock = Lock()
+        self.listeners = weakref.WeakKeyDictionary()
+        self.recent_sizes = OrderedDict()
+        self.entries = None
+        self.total_size = 0
+        self.pending = OrderedDict()
+        self.worker = None
+
+    def watch(self, db):
+        ' Start listening for cover changes in db. Must be called without any database locks held. '
+        if db in self.listeners:
+            return
+        with self.lock:
+            if db in self.listeners:
+                return
+            self.listeners[db] = listener = CoverListener(self, db)
+        db.add_cover_cache(listener)
+
+    def path_for(self, db, book_id, timestamp, width, height):
+        if not isinstance(timestamp, (int, float)):
+            timestamp = timestampfromdt(timestamp)
+        return os.path.join(
+            self.location, db.library_id, (f'{book_id:x}')[-3:], f'{book_id}-{timestamp:.3f}-{width}x{height}.jpg')
+
+    def size_requested(self, width, height):
+        with self.lock:
+            key = width, height
+            self.recent_sizes.pop(key, None)
+            self.recent_sizes[key] = True
+            if len(self.recent_sizes) > self.max_recent_sizes:
+                self.recent_sizes.popitem(last=False)
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        items, now = [], time.time()
+        for dirpath, dirnames, filenames in os.walk(self.location):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with suppress(OSError):
+                    st = os.stat(path)
+                    if name.endswith('.jpg'):
+                        items.append((st.st_mtime, path, st.st_size))
+                    elif name.endswith('.tmp') and now - st.st_mtime > 3600:
+                        # Left over from a previous run that crashed
+                        os.remove(path)
+        items.sort()
+        self.entries = OrderedDict((path, size) for mtime, path, size in items)
+        self.total_size = sum(self.entries.values())
+
+    def touch(self, path):
+        with self.lock:
+            self._load()
+            size = self.entries.pop(path, None)
+            if size is not None:
+                self.entries[path] = size
+
+    def add(self, path, size):
+        with self.lock:
+            self._load()
+            self.total_size += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            expired = []
+            while self.max_size > 0 and self.total_size > self.max_size and len(self.entries) > 1:
+                epath, esize = self.entries.popitem(last=False)
+                self.total_size -= esize
+                expired.append(epath)
+        for epath in expired:
+            with suppress(OSError):
+                os.remove(epath)
+
+    def remove_thumbnails(self, db, book_id, keep_timestamp=None):
+        base = os.path.dirname(self.path_for(db, book_id, 0, 0, 0))
+        prefix = f'{book_id}-'
+        keep = None if keep_timestamp is None else f'{prefix}{keep_timestamp:.3f}-'
+        try:
+            names = os.listdir(base)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(prefix) and (keep is None or not name.startswith(keep)):
+                path = os.path.join(base, name)
+                with self.lock:
+                    if self.entries is not None:
+                        self.total_size -= self.entries.pop(path, 0)
+                with suppress(OSError):
+                    os.remove(path)
+
+    def covers_changed(self, dbref, book_ids):
+        with self.lock:
+            for book_id in book_ids:
+                self.pending[(dbref, book_id)] = True
+            if self.pending and self.worker is None:
+                self.worker = Thread(target=self.run, name='ThumbnailStore', daemon=True)
+                self.worker.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending or self.location is None:
+                    self.pending.clear()
+                    self.worker = None
+                    return
+                batch = []
+                while self.pending and len(batch) < self.batch_size:
+                    batch.append(self.pending.popitem(last=False)[0])
+                sizes = tuple(self.recent_sizes)
+            try:
+                self.process_batch(batch, sizes)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def process_batch(self, batch, sizes):
+        tasks, staged = [], []
+        staging = os.path.join(self.location, 'staging')
+        os.makedirs(staging, exist_ok=True)
+        for dbref, book_id in batch:
+            db = dbref()
+            if db is None:
+                continue
+            mtime = db.cover_last_modified(book_id)
+            if mtime is None:
+                self.remove_thumbnails(db, book_id)
+                continue
+            timestamp = timestampfromdt(mtime)
+            self.remove_thumbnails(db, book_id, keep_timestamp=timestamp)
+            thumbnails = [(self.path_for(db, book_id, timestamp, w, h), w, h) for w, h in sizes]
+            thumbnails = [t for t in thumbnails if not os.path.exists(t[0])]
+            if not thumbnails:
+                continue
+            fd, cover_path = tempfile.mkstemp(suffix='.tmp', dir=staging)
+            with os.fdopen(fd, 'wb') as f:
+                db.copy_cover_to(book_id, f)
+            staged.append(cover_path)
+            tasks.append((cover_path, thumbnails))
+        if not tasks:
+            return
+        job_id, done = None, Event()
+        if self.jobs_manager is not None:
+            job_id = self.jobs_manager.start_job(
+                'Generate cover thumbnails', 'calibre.srv.thumbnails', 'generate_thumbnails', args=(tasks, self.compression_quality),
+                job_done_callback=self.job_done, job_data=(staged, done))
+        if job_id is None:
+            try:
+                self.thumbnails_generated(generate_thumbnails(tasks, self.compression_quality))
+            finally:
+                self.remove_staged(staged)
+            return
+        while not done.wait(1):
+            if self.jobs_manager.job_status(job_id)[0] is None:
+                break  # the server is shutting down, so the job may never run
+
+    def job_done(self, job):
+        staged, done = job.data
+        try:
+            self.remove_staged(staged)
+            if job.result:
+                self.thumbnails_generated(job.result)
+        finally:
+            done.set()
+
+    def thumbnails_generated(self, results):
+        for path, size in results:
+            self.add(path, size)
+
+    def remove_staged(self, paths):
+        for path in paths:
+            with suppress(OSError):
+                os.remove(path)
@@ -418,21 +418,23 @@ def getvalue(self):
 # }}}
 
 
-def get_db(ctx, rd, library_id):
+def get_db(ctx, rd, library_id, for_reading=False):
     db = ctx.get_library(rd, library_id)
     if db is None:
         raise HTTPNotFound(f'Library {library_id!r} not found')
+    if for_reading and rd.opts.snapshot_reads:
+        db = db.read_snapshot()
     return db
 
 
-def get_library_data(ctx, rd, strict_library_id=False):
+def get_library_data(ctx, rd, strict_library_id=False, for_reading=False):
     library_id = rd.query.get('library_id')
     library_map, default_library = ctx.library_info(rd)
     if library_id not in library_map:
         if strict_library_id and library_id:
             raise HTTPNotFound(f'No library with id: {library_id}')
         library_id = default_library
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, for_reading=for_reading)
     return db, library_id, library_map, default_library
 
 
@@ -11,7 +11,7 @@
 from math import ceil
 
 from calibre import force_unicode, isbytestring, prints, sanitize_file_name
-from calibre.constants import filesystem_encoding, ismacos, iswindows, preferred_encoding
+from calibre.constants import filesystem_encoding, islinux, ismacos, iswindows, preferred_encoding
 from calibre.utils.localization import _, get_udc
 from polyglot.builtins import iteritems, itervalues
 
@@ -487,6 +487,21 @@ def hardlink_file(src, dest):
     os.link(src, dest)
 
 
+def reflink_file(src, dest):
+    '''
+    Make the contents of dest a copy-on-write clone of the contents of src,
+    without copying any data. src and dest must be file objects open on the
+    same filesystem. Raises OSError if the filesystem does not support
+    reflinks.
+    '''
+    if not islinux:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    import fcntl
+    FICLONE = 0x40049409
+    dest.flush()
+    fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+
+
 def nlinks_file(path):
     ' Return number of hardlinks to the file '
     if iswindows:
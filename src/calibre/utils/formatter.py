@@ -977,7 +977,7 @@ def error(self, message, line_number):
         raise ValueError(m)
 
     def program(self, funcs, parent, prog, val, is_call=False, args=None,
-                global_vars=None, break_reporter=None):
+                global_vars=None, break_reporter=None, compiled=None):
         self.parent = parent
         self.parent_kwargs = parent.kwargs
         self.parent_book = parent.book
@@ -996,6 +996,8 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
             if is_call:
                 # prog is an instance of the function definition class
                 ret = self.do_node_stored_template_call(StoredTemplateCallNode(1, prog.name, prog, None), args=args)
+            elif compiled is not None and self.break_reporter is None:
+                ret = compiled(self)
             else:
                 ret = self.expression_list(prog)
         except ReturnExecuted as e:
@@ -1624,6 +1626,245 @@ def expr(self, prog):
                        prog.line_number)
 
 
+class _Compiler:
+
+    '''
+    Turns the tree created by :class:`_Parser` for a General Program Mode
+    template into nested closures, so that evaluating the template does not
+    need to dispatch on the type of every node every time. Each closure takes
+    the :class:`_Interpreter` as its only argument. Node types that are not
+    compiled, such as loops and local functions, are evaluated by the
+    interpreter, so the results are always the same as those of
+    :meth:`_Interpreter.expression_list`. The closures do not call the break
+    reporter, so they must only be used when there is none.
+    '''
+
+    def compile_program(self, prog):
+        return self.compile_list(prog)
+
+    def compile_list(self, prog):
+        exprs = tuple(self.compile(p) for p in prog)
+        if len(exprs) == 1:
+            only = exprs[0]
+
+            def one(I):
+                try:
+                    return only(I)
+                except (BreakExecuted, ContinueExecuted) as e:
+                    e.set_value('')
+                    raise e
+            return one
+
+        def expression_list(I):
+            val = ''
+            try:
+                for expr in exprs:
+                    val = expr(I)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+        return expression_list
+
+    def compile(self, prog):
+        if isinstance(prog, list):
+            return self.compile_list(prog)
+        method = self.COMPILERS.get(prog.node_type)
+        if method is None:
+            op = _Interpreter.NODE_OPS[prog.node_type]
+            return self.guard(lambda I: op(I, prog), prog.line_number)
+        return method(self, prog)
+
+    def guard(self, func, line_number):
+        # The same error handling as _Interpreter.expr()
+        def guarded(I):
+            try:
+                return func(I)
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                if (DEBUG):
+                    traceback.print_exc()
+                I.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), line_number)
+        return guarded
+
+    def compile_constant(self, prog):
+        value = prog.value
+        return lambda I: value
+
+    def compile_rvalue(self, prog):
+        name, line_number = prog.name, prog.line_number
+
+        def rvalue(I):
+            try:
+                return I.locals[name]
+            except Exception:
+                I.error(_("Unknown identifier '{0}'").format(name), line_number)
+        return rvalue
+
+    def compile_assign(self, prog):
+        name, right = prog.left, self.compile(prog.right)
+
+        def assign(I):
+            I.locals[name] = t = right(I)
+            return t
+        return self.guard(assign, prog.line_number)
+
+    def compile_func(self, prog):
+        name, args = prog.name.strip(), tuple(self.compile(arg) for arg in prog.expression_list)
+
+        def func(I):
+            vals = [arg(I) for arg in args]
+            return I.funcs[name].eval_(I.parent, I.parent_kwargs, I.parent_book, I.locals, *vals)
+        return self.guard(func, prog.line_number)
+
+    def compile_if(self, prog):
+        condition, then_part = self.compile(prog.condition), self.compile_list(prog.then_part)
+        else_part = self.compile_list(prog.else_part) if prog.else_part else None
+
+        def if_(I):
+            if condition(I):
+                return then_part(I)
+            if else_part is not None:
+                return else_part(I)
+            return ''
+        return self.guard(if_, prog.line_number)
+
+    def compile_field(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+
+        def field(I):
+            try:
+                name = expression(I)
+                try:
+                    return I.parent.get_value(name, [], I.parent_kwargs)
+                except StopException:
+                    raise
+                except Exception:
+                    I.error(_("Unknown field '{0}'").format(name), line_number)
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                I.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return self.guard(field, line_number)
+
+    def compile_first_non_empty(self, prog):
+        exprs = tuple(self.compile(expr) for expr in prog.expression_list)
+
+        def first_non_empty(I):
+            for expr in exprs:
+                v = expr(I)
+                if v:
+                    return v
+            return ''
+        return self.guard(first_non_empty, prog.line_number)
+
+    def compile_switch_if(self, prog):
+        exprs = tuple(self.compile(expr) for expr in prog.expression_list)
+        pairs = tuple((exprs[i], exprs[i+1]) for i in range(0, len(exprs)-1, 2))
+        default = exprs[-1]
+
+        def switch_if(I):
+            for test, value in pairs:
+                if test(I):
+                    return value(I)
+            return default(I)
+        return self.guard(switch_if, prog.line_number)
+
+    def compile_strcat(self, prog):
+        exprs = tuple(self.compile(expr) for expr in prog.expression_list)
+        return self.guard(lambda I: ''.join([expr(I) for expr in exprs]), prog.line_number)
+
+    def operator_error(self, message, prog, func):
+        # The same error handling as the do_node_*() methods for operators
+        line_number, message = prog.line_number, message.format(prog.operator)
+
+        def operator(I):
+            try:
+                return func(I)
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                I.error(message, line_number)
+        return operator
+
+    def compile_string_infix(self, prog):
+        op = _Interpreter.INFIX_STRING_COMPARE_OPS.get(prog.operator)
+        if op is None:  # inlist_field
+            op = _Interpreter.NODE_OPS[prog.node_type]
+            return self.guard(lambda I: op(I, prog), prog.line_number)
+        left, right = self.compile(prog.left), self.compile(prog.right)
+        return self.operator_error(_("Error during string comparison: operator '{0}'"), prog,
+                                   lambda I: '1' if op(left(I), right(I)) else '')
+
+    def compile_numeric_infix(self, prog):
+        op = _Interpreter.INFIX_NUMERIC_COMPARE_OPS[prog.operator]
+        left, right = self.compile(prog.left), self.compile(prog.right)
+
+        def numeric_infix(I):
+            fv = I.float_deal_with_none
+            return '1' if op(fv(left(I)), fv(right(I))) else ''
+        return self.operator_error(_("Value used in comparison is not a number: operator '{0}'"), prog, numeric_infix)
+
+    def compile_logop(self, prog):
+        if prog.operator not in ('and', 'or'):
+            op = _Interpreter.NODE_OPS[prog.node_type]
+            return self.guard(lambda I: op(I, prog), prog.line_number)
+        left, right, is_and = self.compile(prog.left), self.compile(prog.right), prog.operator == 'and'
+
+        def logop(I):
+            res = (left(I) and right(I)) if is_and else (left(I) or right(I))
+            return '1' if res else ''
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), prog, logop)
+
+    def compile_logop_unary(self, prog):
+        op, expr = _Interpreter.LOGICAL_UNARY_OPS[prog.operator], self.compile(prog.expr)
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), prog,
+                                   lambda I: '1' if op(expr(I)) else '')
+
+    def compile_binary_arithop(self, prog):
+        op = _Interpreter.ARITHMETIC_BINARY_OPS[prog.operator]
+        left, right = self.compile(prog.left), self.compile(prog.right)
+
+        def binary_arithop(I):
+            fv = I.float_deal_with_none
+            answer = op(fv(left(I)), fv(right(I)))
+            return str(answer if modf(answer)[0] != 0 else int(answer))
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), prog, binary_arithop)
+
+    def compile_unary_arithop(self, prog):
+        op, expr = _Interpreter.ARITHMETIC_UNARY_OPS[prog.operator], self.compile(prog.expr)
+
+        def unary_arithop(I):
+            answer = op(float(expr(I)))
+            return str(answer if modf(answer)[0] != 0 else int(answer))
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), prog, unary_arithop)
+
+    def compile_stringops(self, prog):
+        left, right = self.compile(prog.left), self.compile(prog.right)
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), prog,
+                                   lambda I: left(I) + right(I))
+
+    COMPILERS = {
+        Node.NODE_CONSTANT:          compile_constant,
+        Node.NODE_RVALUE:            compile_rvalue,
+        Node.NODE_ASSIGN:            compile_assign,
+        Node.NODE_FUNC:              compile_func,
+        Node.NODE_IF:                compile_if,
+        Node.NODE_FIELD:             compile_field,
+        Node.NODE_FIRST_NON_EMPTY:   compile_first_non_empty,
+        Node.NODE_SWITCH_IF:         compile_switch_if,
+        Node.NODE_STRCAT:            compile_strcat,
+        Node.NODE_COMPARE_STRING:    compile_string_infix,
+        Node.NODE_COMPARE_NUMERIC:   compile_numeric_infix,
+        Node.NODE_BINARY_LOGOP:      compile_logop,
+        Node.NODE_UNARY_LOGOP:       compile_logop_unary,
+        Node.NODE_BINARY_ARITHOP:    compile_binary_arithop,
+        Node.NODE_UNARY_ARITHOP:     compile_unary_arithop,
+        Node.NODE_BINARY_STRINGOP:   compile_stringops,
+    }
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -1720,15 +1961,24 @@ def _explode_format_string(self, fmt):
         ], flags=re.DOTALL)
 
     def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
+        compiled = None
         if column_name is not None and self.template_cache is not None:
             tree = self.template_cache.get(column_name, None)
             if not tree:
                 tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
                 self.template_cache[column_name] = tree
+            if break_reporter is None:
+                # Templates with a column name are evaluated many times, so
+                # compile them once and reuse the result
+                key = column_name + '::compiled'
+                compiled = self.template_cache.get(key)
+                if compiled is None or compiled[0] is not tree:
+                    compiled = self.template_cache[key] = tree, _Compiler().compile_program(tree)
+                compiled = compiled[1]
         else:
             tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
         return self.gpm_interpreter.program(self.funcs, self, tree, val,
-                                global_vars=global_vars, break_reporter=break_reporter)
+                                global_vars=global_vars, break_reporter=break_reporter, compiled=compiled)
 
     def _eval_sfm_call(self, template_name, args, global_vars):
         func = self.funcs[template_name]
@@ -233,6 +233,10 @@ class FormatterFunction:
     arg_count = 0
     aliases = []
     object_type = StoredObjectType.PythonFunction
+    # False if the result can depend on something other than the arguments and
+    # the metadata of the book, for example the date or the GUI state. Results
+    # of templates that use such functions must not be reused.
+    is_deterministic = True
 
     def evaluate(self, formatter, kwargs, mi, locals, *args):
         raise NotImplementedError()
@@ -564,6 +568,7 @@ class BuiltinTemplate(BuiltinFormatterFunction):
     name = 'template'
     arg_count = 1
     category = RECURSION
+    is_deterministic = False
 
     __doc__ = doc = _(
 r'''
@@ -587,6 +592,7 @@ class BuiltinEval(BuiltinFormatterFunction):
     name = 'eval'
     arg_count = 1
     category = RECURSION
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``eval(string)`` -- evaluates the string as a program, passing the local
@@ -1756,6 +1762,7 @@ class BuiltinAnnotationCount(BuiltinFormatterFunction):
     name = 'annotation_count'
     arg_count = 0
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``annotation_count()`` -- return the total number of annotations of all types
@@ -1772,6 +1779,7 @@ class BuiltinIsMarked(BuiltinFormatterFunction):
     name = 'is_marked'
     arg_count = 0
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``is_marked()`` -- check whether the book is `marked` in calibre.[/] If it is then
@@ -2210,6 +2218,7 @@ class BuiltinToday(BuiltinFormatterFunction):
     name = 'today'
     arg_count = 0
     category = DATE_FUNCTIONS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``today()`` -- return a date+time string for today (now).[/] This value is designed
@@ -2355,6 +2364,7 @@ class BuiltinCurrentLibraryName(BuiltinFormatterFunction):
     name = 'current_library_name'
     arg_count = 0
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``current_library_name()`` -- return the last name on the path to the current calibre library.
@@ -2369,6 +2379,7 @@ class BuiltinCurrentLibraryPath(BuiltinFormatterFunction):
     name = 'current_library_path'
     arg_count = 0
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``current_library_path()`` -- return the full path to the current calibre
@@ -2420,6 +2431,7 @@ class BuiltinVirtualLibraries(BuiltinFormatterFunction):
     name = 'virtual_libraries'
     arg_count = 0
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``virtual_libraries()`` -- return a comma-separated list of Virtual libraries that
@@ -2442,6 +2454,7 @@ class BuiltinCurrentVirtualLibraryName(BuiltinFormatterFunction):
     name = 'current_virtual_library_name'
     arg_count = 0
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``current_virtual_library_name()`` -- return the name of the current
@@ -2461,6 +2474,7 @@ class BuiltinUserCategories(BuiltinFormatterFunction):
     name = 'user_categories'
     arg_count = 0
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``user_categories()`` -- return a comma-separated list of the user categories that
@@ -2498,6 +2512,7 @@ class BuiltinGetLink(BuiltinFormatterFunction):
     name = 'get_link'
     arg_count = 2
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``get_link(field_name, field_value)`` -- fetch the link for field ``field_name``
@@ -2596,6 +2611,7 @@ class BuiltinConnectedDeviceName(BuiltinFormatterFunction):
     name = 'connected_device_name'
     arg_count = 1
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``connected_device_name(storage_location_key)`` -- if a device is connected then
@@ -2632,6 +2648,7 @@ class BuiltinConnectedDeviceUUID(BuiltinFormatterFunction):
     name = 'connected_device_uuid'
     arg_count = 1
     category = GET_FROM_METADATA
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``connected_device_uuid(storage_location_key)`` -- if a device is connected then
@@ -2902,6 +2919,7 @@ class BuiltinBookCount(BuiltinFormatterFunction):
     name = 'book_count'
     arg_count = 2
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``book_count(query, use_vl)`` -- returns the count of books found by searching
@@ -2967,6 +2985,7 @@ class BuiltinBookValues(BuiltinFormatterFunction):
     name = 'book_values'
     arg_count = 4
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``book_values(column, query, sep, use_vl)`` -- returns a list of the unique
@@ -3009,6 +3028,7 @@ class BuiltinHasExtraFiles(BuiltinFormatterFunction):
     name = 'has_extra_files'
     arg_count = -1
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``has_extra_files([pattern])`` -- returns the count of extra files, otherwise ''
@@ -3040,6 +3060,7 @@ class BuiltinExtraFileNames(BuiltinFormatterFunction):
     name = 'extra_file_names'
     arg_count = -1
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``extra_file_names(sep [, pattern])`` -- returns a ``sep``-separated list of
@@ -3072,6 +3093,7 @@ class BuiltinExtraFileSize(BuiltinFormatterFunction):
     name = 'extra_file_size'
     arg_count = 1
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``extra_file_size(file_name)`` -- returns the size in bytes of the extra file
@@ -3098,6 +3120,7 @@ class BuiltinExtraFileModtime(BuiltinFormatterFunction):
     name = 'extra_file_modtime'
     arg_count = 2
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``extra_file_modtime(file_name, format_string)`` -- returns the modification
@@ -3130,6 +3153,7 @@ class BuiltinGetNote(BuiltinFormatterFunction):
     name = 'get_note'
     arg_count = 3
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``get_note(field_name, field_value, plain_text)`` -- fetch the note for field
@@ -3196,6 +3220,7 @@ class BuiltinHasNote(BuiltinFormatterFunction):
     name = 'has_note'
     arg_count = 2
     category = DB_FUNCS
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``has_note(field_name, field_value)``. Check if a field has a note.[/]
@@ -3249,6 +3274,7 @@ class BuiltinIsDarkMode(BuiltinFormatterFunction):
     name = 'is_dark_mode'
     arg_count = 0
     category = OTHER
+    is_deterministic = False
     __doc__ = doc = _(
 r'''
 ``is_dark_mode()`` -- returns ``'1'`` if calibre is running in dark mode, ``''``
@@ -3668,6 +3694,8 @@ def val_with_suffix(val, test_val):
 
 class FormatterUserFunction(FormatterFunction):
 
+    is_deterministic = False
+
     def __init__(self, name, doc, arg_count, program_text, object_type):
         self.object_type = object_type
         self.name = name